@@ -0,0 +1,206 @@
+import collections
+import threading
+import time
+import zlib
+from collections.abc import Callable, Iterable
+from typing import NamedTuple
+
+import numpy as np
+from pydantic import BaseModel, computed_field
+
+from src.comment_prefilter import comment_skeleton
+from src.normalize import normalize_text
+
+# MinHash のハッシュ関数 (a * x + b) mod p に使うメルセンヌ素数。a, b, x が p 未満なら積は 64 bit に収まる
+_MERSENNE_PRIME = (1 << 31) - 1
+
+
+class ChatClusterStats(BaseModel):
+    """ChatClusterer の統計情報"""
+
+    # 受け取ったコメントの数
+    messages: int
+    # 作ったクラスタの数と、既存のクラスタに入ったコメントの数
+    clusters: int
+    clustered: int
+    # 時間窓の中にあるクラスタの数と、その最大の大きさ
+    active_clusters: int
+    largest_active_cluster: int
+
+    @computed_field  # type: ignore[prop-decorator]
+    @property
+    def clustered_rate(self) -> float:
+        """既存のクラスタに入った(回答を使い回せる)割合"""
+        return self.clustered / self.messages if self.messages else 0.0
+
+
+class ChatClusterAssignment(NamedTuple):
+    """コメントを入れたクラスタ"""
+
+    cluster_id: int
+    # クラスタの代表(最初のコメント)のメッセージ ID
+    representative_id: str
+    # 新しく作ったクラスタか
+    is_new: bool
+
+
+class _Cluster:
+    def __init__(self, cluster_id: int, message_id: str, signature: np.ndarray, keywords: frozenset[str], now: float):
+        self.cluster_id = cluster_id
+        self.representative_id = message_id
+        self.signature = signature
+        self.keywords = keywords
+        self.size = 1
+        self.last_seen = now
+        self.bucket_keys: list[tuple[int, bytes]] = []
+
+
+class ChatClusterer:
+    """ライブチャットのコメントのうち、ほぼ同じ質問をクラスタにまとめる
+
+    コメントの骨格(comment_skeleton)の文字 shingle_size-gram の MinHash を求め、LSH(bands 個の帯)で候補を絞ったうえで、
+    推定した Jaccard 係数が threshold 以上のクラスタのうち最も近いものに入れる。
+    keywords(コメントから話題を表す語を抜く関数。名詞など)を渡した場合は、抜いた語の集合が代表と同じクラスタにのみ入れる
+    (「消費税はどうしますか？」と「所得税はどうしますか？」のように、文字はほぼ同じでも話題が違う質問をまとめないため)。
+    クラスタは最後にコメントが入ってから window_sec 経つと破棄する(時間窓)。
+
+    スレッドセーフ
+    """
+
+    def __init__(
+        self,
+        *,
+        threshold: float = 0.7,
+        window_sec: float = 60.0,
+        num_perm: int = 128,
+        bands: int = 32,
+        shingle_size: int = 2,
+        seed: int = 0,
+        keywords: Callable[[str], Iterable[str]] | None = None,
+    ):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be divisible by bands.")
+        self._threshold = threshold
+        self._keywords = keywords
+        self._window_sec = window_sec
+        self._rows = num_perm // bands
+        self._bands = bands
+        self._shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._lock = threading.Lock()
+        # クラスタ(最後にコメントが入った順)
+        self._clusters: collections.OrderedDict[int, _Cluster] = collections.OrderedDict()
+        # LSH の帯ごとのバケツ
+        self._buckets: dict[tuple[int, bytes], set[int]] = collections.defaultdict(set)
+        self._next_id = 0
+        self._messages = 0
+        self._clustered = 0
+
+    def add(self, message_id: str, text: str) -> ChatClusterAssignment:
+        """コメントをクラスタに入れる。近いクラスタが無ければ新しく作る"""
+        signature, keywords = self.signature(text), self._extract_keywords(text)
+        now = time.monotonic()
+        with self._lock:
+            assignment = self._join(signature, keywords, now)
+            if assignment is not None:
+                return assignment
+
+            self._messages += 1
+            cluster = _Cluster(self._next_id, message_id, signature, keywords, now)
+            self._next_id += 1
+            self._clusters[cluster.cluster_id] = cluster
+            for key in self._band_keys(signature):
+                self._buckets[key].add(cluster.cluster_id)
+                cluster.bucket_keys.append(key)
+            return ChatClusterAssignment(cluster_id=cluster.cluster_id, representative_id=message_id, is_new=True)
+
+    def join(self, text: str) -> ChatClusterAssignment | None:
+        """近いクラスタがあればコメントを入れる。無ければ何もせずに None を返す"""
+        signature, keywords = self.signature(text), self._extract_keywords(text)
+        with self._lock:
+            return self._join(signature, keywords, time.monotonic())
+
+    def remove(self, representative_id: str) -> None:
+        """代表のメッセージ ID からクラスタを破棄する(以降のコメントはこのクラスタに入らない)"""
+        with self._lock:
+            for cluster in self._clusters.values():
+                if cluster.representative_id == representative_id:
+                    self._discard(cluster)
+                    return
+
+    def signature(self, text: str) -> np.ndarray:
+        """コメントの MinHash"""
+        skeleton = comment_skeleton(text)
+        n = self._shingle_size
+        # 短いコメントは全体を一つの shingle とする
+        shingles = {skeleton[i : i + n] for i in range(len(skeleton) - n + 1)} or {skeleton}
+        hashes = np.fromiter((zlib.crc32(shingle.encode()) & _MERSENNE_PRIME for shingle in shingles), dtype=np.uint64, count=len(shingles))
+        # (ハッシュ関数の数, shingle の数) の行列で全てのハッシュを一度に求め、ハッシュ関数ごとの最小値を取る
+        return ((self._a[:, None] * hashes[None, :] + self._b[:, None]) % _MERSENNE_PRIME).min(axis=1)
+
+    @property
+    def stats(self) -> ChatClusterStats:
+        """統計情報"""
+        with self._lock:
+            self._expire(time.monotonic())
+            return ChatClusterStats(
+                messages=self._messages,
+                clusters=self._next_id,
+                clustered=self._clustered,
+                active_clusters=len(self._clusters),
+                largest_active_cluster=max((cluster.size for cluster in self._clusters.values()), default=0),
+            )
+
+    def _band_keys(self, signature: np.ndarray) -> list[tuple[int, bytes]]:
+        return [(band, signature[band * self._rows : (band + 1) * self._rows].tobytes()) for band in range(self._bands)]
+
+    def _extract_keywords(self, text: str) -> frozenset[str]:
+        return frozenset(self._keywords(normalize_text(text))) if self._keywords is not None else frozenset()
+
+    def _join(self, signature: np.ndarray, keywords: frozenset[str], now: float) -> ChatClusterAssignment | None:
+        # self._lock を取得した状態で呼ぶこと
+        self._expire(now)
+        cluster = self._find(signature, keywords)
+        if cluster is None:
+            return None
+        self._messages += 1
+        cluster.size += 1
+        cluster.last_seen = now
+        self._clusters.move_to_end(cluster.cluster_id)
+        self._clustered += 1
+        return ChatClusterAssignment(cluster_id=cluster.cluster_id, representative_id=cluster.representative_id, is_new=False)
+
+    def _find(self, signature: np.ndarray, keywords: frozenset[str]) -> _Cluster | None:
+        # self._lock を取得した状態で呼ぶこと
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates |= self._buckets.get(key, set())
+        best, best_similarity = None, self._threshold
+        for cluster_id in candidates:
+            cluster = self._clusters[cluster_id]
+            if cluster.keywords != keywords:
+                continue
+            # 一致した MinHash の割合が Jaccard 係数の推定値になる
+            similarity = float(np.mean(cluster.signature == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = cluster, similarity
+        return best
+
+    def _expire(self, now: float) -> None:
+        # self._lock を取得した状態で呼ぶこと
+        while self._clusters:
+            cluster = next(iter(self._clusters.values()))
+            if cluster.last_seen + self._window_sec > now:
+                break
+            self._discard(cluster)
+
+    def _discard(self, cluster: _Cluster) -> None:
+        # self._lock を取得した状態で呼ぶこと
+        del self._clusters[cluster.cluster_id]
+        for key in cluster.bucket_keys:
+            bucket = self._buckets[key]
+            bucket.discard(cluster.cluster_id)
+            if not bucket:
+                del self._buckets[key]
@@ -0,0 +1,51 @@
+import logging
+
+import click
+
+from src.cli.wrap.sync import sync
+from src.gpt import DEFAULT_NG_MESSAGE, DocumentRetrievalType, _make_reply_prompt
+from src.llm import count_tokens
+from src.logger import setup_logger
+from src.prompts import ALL_PROMPTS, REPLY_PROMPT
+
+setup_logger()
+
+LOGGER = logging.getLogger(__name__)
+
+# 各プロンプトのプレフィックスの変数に、実際の呼び出しで使っている値を入れる
+PREFIX_KWARGS = {
+    "reply": {"ng_message": DEFAULT_NG_MESSAGE},
+    "best_knowledge": {"top_k": 15},
+    "n_best_knowledge": {"top_k": 5, "top_n": 5},
+}
+
+
+@click.command()
+@click.option("--query", "-q", type=str, help="Question to build the variable sections of the reply prompt from (runs the retrieval)", default=None)
+@click.option("--doc-retrieval-type", "-d", type=DocumentRetrievalType, help="Document retrieval type", default=DocumentRetrievalType.multi)
+@click.option("--offline", is_flag=True, help="Only count characters without calling the token counting API", default=False)
+@sync
+async def main(query: str | None, doc_retrieval_type: DocumentRetrievalType, offline: bool):
+    """プロンプトのセクションごとの文字数とトークン数を表示する
+
+    prefix はリクエストによらない静的な部分(system_instruction)、suffix はリクエストごとに送る部分で、変数を空にしたもの
+    """
+    rows: list[tuple[str, str, str]] = []
+    for prompt in ALL_PROMPTS:
+        rows.append((prompt.name, "prefix", prompt.prefix(**PREFIX_KWARGS.get(prompt.name, {}))))
+        rows.append((prompt.name, "suffix", prompt.suffix(**dict.fromkeys(prompt.suffix_variables, ""))))
+
+    if query is not None:
+        _, rag_qa, rag_knowledge, _ = await _make_reply_prompt(query, doc_retrieval_type=doc_retrieval_type)
+        for name, value in (("rag_qa", rag_qa), ("rag_knowledge", rag_knowledge), ("question", query)):
+            rows.append((REPLY_PROMPT.name, f"suffix.{name}", value))
+
+    print("| prompt | section | chars | tokens |")
+    print("| --- | --- | --- | --- |")
+    for prompt_name, section, text in rows:
+        tokens = "-" if offline or not text else str(await count_tokens(text))
+        print(f"| {prompt_name} | {section} | {len(text)} | {tokens} |")
+
+
+if __name__ == "__main__":
+    main()
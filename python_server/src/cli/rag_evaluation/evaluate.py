@@ -8,20 +8,19 @@ import re
 import typing
 
 import click
-import google.generativeai as genai
 from pydantic import BaseModel
 
 from src.cli.loaders.qa_dataset import load_qa_dataset, split_qa_data_train_test
 from src.cli.wrap.sync import sync
 from src.config import settings
 from src.gpt import DocumentRetrievalType, generate_response
+from src.llm import generate_content
 from src.logger import setup_logger
 
 setup_logger()
 
 LOGGER = logging.getLogger(__name__)
 
-genai.configure(api_key=settings.GOOGLE_API_KEY)
 os.environ["GOOGLE_API_KEY"] = settings.GOOGLE_API_KEY
 
 
@@ -173,6 +172,11 @@ async def _evaluate(
         print(f"評価理由: {judge_result.reason}")
         print("#################")
 
+    # 検索ロジック同士を比較しやすいよう、平均点も表示する
+    print(f"検索ロジック: {doc_retrieval_type.value}")
+    print(f"テキストの評価(平均): {_format_average([r.eval_text_score for r in judge_results])}")
+    print(f"スライドの評価(平均): {_format_average([r.eval_slide_score for r in judge_results])}")
+
     # 結果を CSV or MD に書き込む
     result_dicts = [
         {
@@ -244,8 +248,7 @@ async def _evaluate_row(judge_input: JudgeInput, doc_retrieval_type: DocumentRet
 
 
 async def _async_generate_response(prompt: str):
-    model = genai.GenerativeModel("gemini-1.5-pro", generation_config={"response_mime_type": "application/json"})
-    response = await model.generate_content_async(prompt)
+    response = await generate_content(prompt)
     json_reply = response.text
     try:
         return json.loads(json_reply).get("response", "")
@@ -324,6 +327,13 @@ def _escape_md_table_value(value):
     return value
 
 
+def _format_average(scores: list[float]) -> str:
+    """平均点を表示用の文字列にする(評価結果が無い場合は N/A)"""
+    if not scores:
+        return "N/A"
+    return f"{sum(scores) / len(scores):.2f}"
+
+
 def _write_list_dict_to_md_table(data: list[dict], f: typing.TextIO):
     if not data:
         return
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+
+from pydantic import BaseModel
+
+from src.normalize import normalize_text
+from src.ttl_cache import CacheStats, TTLCache
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CommentFilterStats(BaseModel):
+    """CommentFilter の統計情報"""
+
+    # filter に渡されたコメントの数
+    comments: int
+    # 判定結果のキャッシュを使った数
+    cache_hits: int
+    # 他の呼び出し元が判定中の同じコメントの結果を待った数
+    coalesced: int
+    # LLM で判定したコメントの数と、LLM の呼び出し回数
+    classified: int
+    llm_calls: int
+
+
+class CommentFilter:
+    """コメントが回答の対象か(質問・要望や応援か)を判定する
+
+    * 判定結果はコメント(正規化したテキスト)ごとにキャッシュし、判定したことのないコメントだけを LLM に送る
+    * 同時に来た複数の呼び出し元のコメントは、window_sec の間まとめて一度の LLM の呼び出しで判定する
+    """
+
+    def __init__(
+        self,
+        *,
+        classify: Callable[[list[str]], Awaitable[list[bool]]],
+        window_sec: float,
+        max_batch_size: int,
+        cache_max_size: int,
+        cache_ttl_sec: float,
+    ):
+        self._classify = classify
+        self._window_sec = window_sec
+        self._max_batch_size = max_batch_size
+        self._cache: TTLCache[bool] = TTLCache(max_size=cache_max_size, ttl_sec=cache_ttl_sec)
+        # 判定待ち・判定中のコメント
+        self._pending: dict[str, asyncio.Future[bool]] = {}
+        self._queue: list[tuple[str, str]] = []
+        self._flush_task: asyncio.Task[None] | None = None
+        # 実行中のタスクが破棄されないよう参照を持っておく
+        self._tasks: set[asyncio.Task[None]] = set()
+        self._comments = 0
+        self._cache_hits = 0
+        self._coalesced = 0
+        self._classified = 0
+        self._llm_calls = 0
+
+    async def filter(self, comments: list[str]) -> list[str]:
+        """回答の対象となるコメントを、渡された順に返す"""
+        keys = [normalize_text(comment) for comment in comments]
+        decisions: dict[str, bool] = {}
+        waiting: dict[str, asyncio.Future[bool]] = {}
+        for key, comment in zip(keys, comments, strict=True):
+            self._comments += 1
+            if key in decisions or key in waiting:
+                continue
+            accepted = self._cache.get(key)
+            if accepted is not None:
+                self._cache_hits += 1
+                decisions[key] = accepted
+            elif key in self._pending:
+                self._coalesced += 1
+                waiting[key] = self._pending[key]
+            else:
+                waiting[key] = self._enqueue(key, comment)
+
+        if waiting:
+            # 一つの呼び出し元がキャンセルされても、同じバッチの他の呼び出し元の判定は続ける
+            results = await asyncio.shield(asyncio.gather(*waiting.values()))
+            decisions.update(zip(waiting, results, strict=True))
+        return [comment for key, comment in zip(keys, comments, strict=True) if decisions[key]]
+
+    @property
+    def stats(self) -> CommentFilterStats:
+        """統計情報"""
+        return CommentFilterStats(
+            comments=self._comments,
+            cache_hits=self._cache_hits,
+            coalesced=self._coalesced,
+            classified=self._classified,
+            llm_calls=self._llm_calls,
+        )
+
+    @property
+    def cache_stats(self) -> CacheStats:
+        """判定結果のキャッシュの統計情報"""
+        return self._cache.stats
+
+    def _enqueue(self, key: str, comment: str) -> asyncio.Future[bool]:
+        future: asyncio.Future[bool] = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        self._queue.append((key, comment))
+        if len(self._queue) >= self._max_batch_size:
+            self._start(self._flush())
+        elif self._flush_task is None:
+            self._flush_task = self._start(self._flush_after_window())
+        return future
+
+    def _start(self, coroutine) -> asyncio.Task[None]:
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _flush_after_window(self) -> None:
+        try:
+            await asyncio.sleep(self._window_sec)
+        finally:
+            self._flush_task = None
+        while self._queue:
+            await self._flush()
+
+    async def _flush(self) -> None:
+        batch = self._queue[: self._max_batch_size]
+        del self._queue[: self._max_batch_size]
+        if not batch:
+            return
+        self._llm_calls += 1
+        self._classified += len(batch)
+        LOGGER.debug("Classify %d comments in one request.", len(batch))
+        try:
+            results = await self._classify([comment for _, comment in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"Expected {len(batch)} results, got {len(results)}.")
+        except Exception as e:
+            for key, _ in batch:
+                future = self._pending.pop(key)
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (key, _), accepted in zip(batch, results, strict=True):
+            self._cache.set(key, accepted)
+            future = self._pending.pop(key)
+            if not future.done():
+                future.set_result(accepted)
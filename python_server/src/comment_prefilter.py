@@ -0,0 +1,213 @@
+import collections
+import contextlib
+import logging
+import re
+import threading
+import time
+from collections.abc import Iterator
+from enum import Enum
+
+from pydantic import BaseModel, computed_field
+
+from src.normalize import normalize_text
+
+LOGGER = logging.getLogger(__name__)
+
+# 配信そのものに関するコメントの接頭辞。返答対象として採用しない（仕様）
+EXCLUDED_PREFIXES = ("#", "＃")
+
+_URL_PATTERN = re.compile(r"https?://\S+|www\.\S+")
+# 文字・数字(かな・漢字を含む)以外と長音記号。絵文字や記号、空白はここに含まれる
+_NON_WORD_PATTERN = re.compile(r"[\W_ー]+")
+# 同じ文字の繰り返し(「wwww」「8888」など)
+_REPEATED_CHAR_PATTERN = re.compile(r"(.)\1+")
+
+
+class DropReason(str, Enum):
+    """コメントを LLM に送らずに落とした理由"""
+
+    # 「#」「＃」から始まる
+    prefix = "prefix"
+    # URL のみ
+    url_only = "url_only"
+    # 絵文字や記号のみ
+    no_text = "no_text"
+    # 短すぎる・長すぎる
+    length = "length"
+    # 直近の(もしくは同じ呼び出しの)コメントとほぼ同じ
+    duplicate = "duplicate"
+    # 同じ投稿者のコメントが多すぎる
+    author_spam = "author_spam"
+
+
+class CommentPrefilterStats(BaseModel):
+    """CommentPrefilter の統計情報"""
+
+    # filter に渡されたコメントの数と、LLM に送ったコメントの数
+    comments: int
+    passed: int
+    # 理由ごとの落としたコメントの数
+    dropped: dict[str, int]
+
+    @computed_field  # type: ignore[prop-decorator]
+    @property
+    def dropped_rate(self) -> float:
+        """落としたコメントの割合"""
+        return (self.comments - self.passed) / self.comments if self.comments else 0.0
+
+
+def comment_skeleton(comment: str) -> str:
+    """重複の判定に使う、コメントの骨格
+
+    正規化したうえで URL・絵文字・記号・空白・長音記号を除き、同じ文字の繰り返しを一文字にまとめる
+    (「こんにちは！！」「こんにちはーー😊」は同じ骨格になる)
+    """
+    return _skeleton(normalize_text(comment))
+
+
+def _skeleton(normalized: str) -> str:
+    text = _URL_PATTERN.sub("", normalized)
+    text = _NON_WORD_PATTERN.sub("", text)
+    return _REPEATED_CHAR_PATTERN.sub(r"\1", text)
+
+
+class _Changes:
+    """CommentPrefilter の一度の呼び出しで記録したもの(取り消すために使う)"""
+
+    def __init__(self):
+        self.time = 0.0
+        # 新しく記録したコメントの骨格
+        self.skeletons: list[str] = []
+        # 時刻を記録した投稿者(記録した回数だけ含む)
+        self.authors: list[str] = []
+
+
+class CommentPrefilter:
+    """LLM で判定する前に、規則で明らかに回答の対象にならないコメントを落とす
+
+    * 「#」「＃」から始まるコメント、URL のみ・絵文字や記号のみのコメント
+    * 骨格が min_length 文字未満、もしくは(正規化したうえで) max_length 文字より長いコメント
+    * window_sec 以内に来た(もしくは同じ呼び出しの)コメントと骨格が同じコメント
+    * window_sec 以内に同じ投稿者から max_comments_per_author より多く来たコメント(投稿者が分かる場合のみ)
+
+    通したコメントのその後の判定(LLM)に失敗した場合に、同じコメントが送り直されても落とさないよう、
+    判定は filtering の with の中で行うこと(例外が発生した場合は、その呼び出しで記録したコメントを記録しなかったことにする)
+
+    スレッドセーフ
+    """
+
+    def __init__(self, *, min_length: int, max_length: int, window_sec: float, max_comments_per_author: int):
+        self._min_length = min_length
+        self._max_length = max_length
+        self._window_sec = window_sec
+        self._max_comments_per_author = max_comments_per_author
+        self._lock = threading.Lock()
+        # 直近のコメントの骨格と、最後に来た時刻(古い順)
+        self._recent: collections.OrderedDict[str, float] = collections.OrderedDict()
+        # 投稿者ごとの直近のコメントの時刻
+        self._author_history: dict[str, collections.deque[float]] = {}
+        self._comments = 0
+        self._passed = 0
+        self._dropped = dict.fromkeys((reason.value for reason in DropReason), 0)
+
+    def filter(self, comments: list[str], authors: list[str] | None = None) -> list[str]:
+        """落とさなかったコメントを、渡された順に返す
+
+        authors はコメントと同じ順の投稿者(チャンネル ID など)。渡さなかった場合は投稿者ごとの制限を行わない
+        """
+        return self._filter(comments, authors, _Changes())
+
+    @contextlib.contextmanager
+    def filtering(self, comments: list[str], authors: list[str] | None = None) -> Iterator[list[str]]:
+        """filter と同じく、落とさなかったコメントを返す
+
+        with の中で例外が発生した場合は、この呼び出しで記録したコメントの骨格と投稿者ごとの時刻を取り消す
+        (送り直されたコメントを重複や連投として落とさないため)
+        """
+        changes = _Changes()
+        passed = self._filter(comments, authors, changes)
+        try:
+            yield passed
+        except BaseException:
+            self._rollback(changes)
+            raise
+
+    def _filter(self, comments: list[str], authors: list[str] | None, changes: _Changes) -> list[str]:
+        if authors is not None and len(authors) != len(comments):
+            raise ValueError("authors must have the same length as comments.")
+
+        now = time.monotonic()
+        changes.time = now
+        passed = []
+        dropped: collections.Counter[str] = collections.Counter()
+        with self._lock:
+            self._expire(now)
+            for i, comment in enumerate(comments):
+                reason = self._check(comment, None if authors is None else authors[i], now, changes)
+                if reason is None:
+                    passed.append(comment)
+                else:
+                    dropped[reason.value] += 1
+            self._comments += len(comments)
+            self._passed += len(passed)
+            for reason, count in dropped.items():
+                self._dropped[reason] += count
+
+        if dropped:
+            LOGGER.info("Prefilter dropped %d of %d comments: %s", len(comments) - len(passed), len(comments), dict(dropped))
+        return passed
+
+    @property
+    def stats(self) -> CommentPrefilterStats:
+        """統計情報"""
+        with self._lock:
+            return CommentPrefilterStats(comments=self._comments, passed=self._passed, dropped=dict(self._dropped))
+
+    def _check(self, comment: str, author: str | None, now: float, changes: _Changes) -> DropReason | None:
+        # self._lock を取得した状態で呼ぶこと
+        if comment.lstrip().startswith(EXCLUDED_PREFIXES):
+            return DropReason.prefix
+        normalized = normalize_text(comment)
+        skeleton = _skeleton(normalized)
+        if not skeleton:
+            return DropReason.url_only if _URL_PATTERN.search(normalized) else DropReason.no_text
+        if len(skeleton) < self._min_length or len(normalized) > self._max_length:
+            return DropReason.length
+        if author is not None:
+            history = self._author_history.setdefault(author, collections.deque())
+            if len(history) >= self._max_comments_per_author:
+                return DropReason.author_spam
+            history.append(now)
+            changes.authors.append(author)
+        if skeleton in self._recent:
+            self._recent.move_to_end(skeleton)
+            self._recent[skeleton] = now
+            return DropReason.duplicate
+        self._recent[skeleton] = now
+        changes.skeletons.append(skeleton)
+        return None
+
+    def _rollback(self, changes: _Changes) -> None:
+        with self._lock:
+            for skeleton in changes.skeletons:
+                # 後の呼び出しが同じコメントを記録し直した場合はそのままにする
+                if self._recent.get(skeleton) == changes.time:
+                    del self._recent[skeleton]
+            for author in changes.authors:
+                history = self._author_history.get(author)
+                if history is not None and changes.time in history:
+                    history.remove(changes.time)
+                    if not history:
+                        del self._author_history[author]
+
+    def _expire(self, now: float) -> None:
+        # self._lock を取得した状態で呼ぶこと
+        threshold = now - self._window_sec
+        while self._recent and next(iter(self._recent.values())) < threshold:
+            self._recent.popitem(last=False)
+        for author in list(self._author_history):
+            history = self._author_history[author]
+            while history and history[0] < threshold:
+                history.popleft()
+            if not history:
+                del self._author_history[author]
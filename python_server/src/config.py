@@ -1,5 +1,5 @@
 import pathlib
-from typing import Any, Optional
+from typing import Any, Literal, Optional
 from zoneinfo import ZoneInfo
 
 from dotenv import load_dotenv
@@ -24,6 +24,87 @@ class Settings(BaseSettings):
     FAISS_QA_DB_DIR: pathlib.Path = PYTHON_SERVER_ROOT / "faiss_qa_db"
     FAISS_KNOWLEDGE_DB_DIR: pathlib.Path = PYTHON_SERVER_ROOT / "faiss_knowledge_manifest_demo_csv_db"
     BM25_KNOWLEDGE_DB_DIR: pathlib.Path = PYTHON_SERVER_ROOT / "bm25_knowledge_manifest_demo_csv_db"
+    # FAISS のインデックスファイルの更新を確認する間隔(秒)
+    FAISS_INDEX_RELOAD_CHECK_INTERVAL_SEC: float = 5.0
+    # クエリの埋め込みのキャッシュ
+    EMBEDDING_CACHE_MAX_SIZE: int = 4096
+    EMBEDDING_CACHE_TTL_SEC: float = 60 * 60 * 24
+    # ハイブリッド検索(BM25 + ベクトル検索)のスコア統合
+    HYBRID_FUSION_METHOD: Literal["rrf", "weighted"] = "rrf"
+    HYBRID_BM25_WEIGHT: float = 0.5
+    HYBRID_VECTOR_WEIGHT: float = 0.5
+    # 検索処理を並行して実行するスレッド数
+    RETRIEVAL_MAX_WORKERS: int = 8
+    # LLM を使わないリランク(DocumentRetrievalType.local_rerank)の特徴量の重みと、採用する最低スコア
+    LOCAL_RERANK_FUSED_WEIGHT: float = 0.4
+    LOCAL_RERANK_VECTOR_WEIGHT: float = 0.2
+    LOCAL_RERANK_COVERAGE_WEIGHT: float = 0.3
+    LOCAL_RERANK_TITLE_WEIGHT: float = 0.1
+    LOCAL_RERANK_MIN_SCORE: float = 0.2
+    # LLM によるリランクの結果のキャッシュ
+    RERANK_CACHE_MAX_SIZE: int = 1024
+    RERANK_CACHE_TTL_SEC: float = 60 * 60 * 24
+    # 質問の埋め込みで引く回答のキャッシュ(POST /reply で使う)
+    SEMANTIC_REPLY_CACHE_ENABLED: bool = True
+    SEMANTIC_REPLY_CACHE_THRESHOLD: float = 0.95
+    SEMANTIC_REPLY_CACHE_TTL_SEC: float = 60 * 60
+    SEMANTIC_REPLY_CACHE_MAX_SIZE: int = 1024
+    # Postgres に保存する、質問文の完全一致で引く回答のキャッシュ(プロセス内の L1 キャッシュ付き)
+    PERSISTENT_REPLY_CACHE_ENABLED: bool = True
+    PERSISTENT_REPLY_CACHE_TTL_SEC: float = 60 * 60 * 24
+    PERSISTENT_REPLY_CACHE_L1_MAX_SIZE: int = 1024
+    PERSISTENT_REPLY_CACHE_L1_TTL_SEC: float = 60 * 10
+    # NG ワードの CSV の更新を確認する間隔(秒)
+    NG_WORDS_RELOAD_CHECK_INTERVAL_SEC: float = 5.0
+    # ハルシネーションのチェックの前に、回答と検索した知識の語彙の重なりを見る事前チェック
+    # 閾値を全て満たす回答は知識に基づいているとみなし、LLM によるチェックを省く
+    GROUNDING_CHECK_ENABLED: bool = True
+    GROUNDING_MIN_TOKEN_COVERAGE: float = 0.8
+    GROUNDING_MIN_NGRAM_COVERAGE: float = 0.6
+    GROUNDING_MAX_UNKNOWN_PROPER_NOUNS: int = 0
+    # LLM・埋め込みの API 呼び出しの同時実行数とレート(プロセスごと)
+    # LLM_RESERVED_CONCURRENCY_FOR_LIVE 個は配信中のコメントへの回答のために空けておく。レートが 0 以下なら制限しない
+    LLM_MAX_CONCURRENCY: int = 8
+    LLM_RESERVED_CONCURRENCY_FOR_LIVE: int = 2
+    LLM_RATE_LIMIT_PER_SEC: float = 10.0
+    LLM_RATE_LIMIT_BURST: int = 20
+    # /reply の所要時間の予算(Unity のクライアントは 20 秒でタイムアウトする)。使い切った場合は定型の回答を返す
+    REPLY_BUDGET_SEC: float = 15.0
+    # LLM によるリランクがこの秒数を超えたら、ハイブリッド検索の最上位の結果を使う
+    REPLY_RERANK_TIMEOUT_SEC: float = 5.0
+    # 回答の生成が直近の所要時間の REPLY_HEDGE_PERCENTILE 分位点(記録が少ないうちは DEFAULT_DELAY)を過ぎても終わらなければ、
+    # 同じリクエストをもう一つ送り、先に返ってきた方を使う
+    REPLY_HEDGE_ENABLED: bool = True
+    REPLY_HEDGE_PERCENTILE: float = 0.9
+    REPLY_HEDGE_MIN_DELAY_SEC: float = 2.0
+    REPLY_HEDGE_DEFAULT_DELAY_SEC: float = 6.0
+    # /filter のコメントの判定。COMMENT_FILTER_BATCH_WINDOW_SEC の間に来たコメントはまとめて一度の LLM の呼び出しで判定する
+    COMMENT_FILTER_BATCH_WINDOW_SEC: float = 0.2
+    COMMENT_FILTER_MAX_BATCH_SIZE: int = 50
+    # コメントごとの判定結果のキャッシュ
+    COMMENT_FILTER_CACHE_MAX_SIZE: int = 10000
+    COMMENT_FILTER_CACHE_TTL_SEC: float = 60 * 60 * 6
+    # /filter で LLM に送る前に規則で落とすコメント。骨格(URL・絵文字・記号を除いたもの)が短すぎる・長すぎるもの、
+    # COMMENT_PREFILTER_WINDOW_SEC 以内の重複、同じ投稿者から COMMENT_PREFILTER_MAX_COMMENTS_PER_AUTHOR より多く来たもの
+    COMMENT_PREFILTER_MIN_LENGTH: int = 2
+    COMMENT_PREFILTER_MAX_LENGTH: int = 200
+    COMMENT_PREFILTER_WINDOW_SEC: float = 60.0
+    COMMENT_PREFILTER_MAX_COMMENTS_PER_AUTHOR: int = 5
+    # POST /youtube/chat_message で受け取ったコメントについて、裏で回答と音声を用意しておく(GET /prefetch/next で取り出す)
+    # 全てのコメントについて LLM と音声合成を呼ぶため、GET /prefetch/next で取り出すクライアントを使う場合のみ有効にする
+    REPLY_PREFETCH_ENABLED: bool = False
+    REPLY_PREFETCH_MAX_QUEUE_SIZE: int = 200
+    REPLY_PREFETCH_BATCH_SIZE: int = 20
+    # 同時に用意する回答の数
+    REPLY_PREFETCH_CONCURRENCY: int = 2
+    REPLY_PREFETCH_MAX_READY: int = 50
+    REPLY_PREFETCH_TTL_SEC: float = 60 * 10
+    # 音声の合成に使う /voice のエンドポイント("": ElevenLabs, "v2": Azure TTS -> ElevenLabs STS, "azure", "male")
+    REPLY_PREFETCH_VOICE: Literal["", "v2", "azure", "male"] = ""
+    # 回答の事前準備で、CHAT_CLUSTER_WINDOW_SEC 以内に来たほぼ同じ質問(名詞が同じで、文字 2-gram の Jaccard 係数が CHAT_CLUSTER_THRESHOLD 以上)には回答を使い回す
+    CHAT_CLUSTERING_ENABLED: bool = True
+    CHAT_CLUSTER_THRESHOLD: float = 0.7
+    CHAT_CLUSTER_WINDOW_SEC: float = 60.0
 
     GOOGLE_DRIVE_FOLDER_ID: Optional[str] = None
     GOOGLE_API_KEY: Optional[str] = None
@@ -52,5 +133,10 @@ class Settings(BaseSettings):
 
     LOCAL_TZ: ZoneInfo = ZoneInfo("Asia/Tokyo")
 
+    @property
+    def REPLY_CACHE_ENABLED(self) -> bool:  # noqa: N802
+        """回答のキャッシュ(SEMANTIC_REPLY_CACHE・PERSISTENT_REPLY_CACHE)のいずれかが有効か"""
+        return self.SEMANTIC_REPLY_CACHE_ENABLED or self.PERSISTENT_REPLY_CACHE_ENABLED
+
 
 settings = Settings()
@@ -1,7 +1,9 @@
+from .reply_caches import ReplyCacheModel
 from .youtube_chat_message_cursors import YoutubeChatMessageCursorModel
 from .youtube_chat_messages import YoutubeChatMessageModel
 
 __all__ = [
+    "ReplyCacheModel",
     "YoutubeChatMessageModel",
     "YoutubeChatMessageCursorModel",
 ]
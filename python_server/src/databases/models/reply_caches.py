@@ -0,0 +1,36 @@
+from sqlalchemy import Column, DateTime, Integer, String, UniqueConstraint, func
+
+from src.databases.engine import Base
+from src.databases.models.utils import default_func
+
+
+class ReplyCacheModel(Base):
+    """生成した回答のキャッシュ
+
+    正規化した質問文と回答の作り方(namespace)ごとに最新の回答を 1 件持つ
+    """
+
+    __tablename__ = "reply_caches"
+
+    __table_args__ = (UniqueConstraint("namespace", "normalized_text", name="unique_namespace_normalized_text"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    # 検索ロジックなど回答の作り方
+    namespace = Column(String, nullable=False)
+    # neologdn で正規化した質問文
+    normalized_text = Column(String, nullable=False)
+    # 回答を生成したときの QA とナレッジのインデックスのバージョン
+    index_version = Column(String, nullable=False)
+
+    reply = Column(String, nullable=False)
+    image_filename = Column(String, nullable=False)
+
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+    created_at = Column(  # type: ignore[assignment]
+        DateTime(timezone=True),
+        default=default_func.local_now,
+        server_default=func.now(),
+        nullable=False,
+    )
@@ -0,0 +1,102 @@
+import asyncio
+import collections
+import threading
+import time
+from collections.abc import Awaitable, Callable
+from typing import TypeVar
+
+T = TypeVar("T")
+
+
+class Deadline:
+    """リクエストごとの所要時間の予算
+
+    予算に応じて処理を打ち切ったり省いたりした場合は、その内容を fallbacks に記録する(対話ログに残す)
+    """
+
+    def __init__(self, budget_sec: float):
+        self._expires_at = time.monotonic() + budget_sec
+        self.fallbacks: list[str] = []
+
+    def remaining(self) -> float:
+        """残りの秒数(超過している場合は 0)"""
+        return max(0.0, self._expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        """予算を使い切ったか"""
+        return self.remaining() <= 0
+
+
+class LatencyTracker:
+    """直近の所要時間を記録し、そのパーセンタイルを求める"""
+
+    def __init__(self, *, window: int = 200, min_samples: int = 20):
+        self._latencies: collections.deque[float] = collections.deque(maxlen=window)
+        self._min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def record(self, latency_sec: float) -> None:
+        """所要時間を記録する"""
+        with self._lock:
+            self._latencies.append(latency_sec)
+
+    def percentile(self, q: float) -> float | None:
+        """直近の所要時間の q 分位点(0~1)。記録が min_samples 未満の場合は None"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self._min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+# 結果を使わなかった call(終わるまで所要時間を記録するために実行し続ける)
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def hedged(call: Callable[[], Awaitable[T]], *, delay_sec: float, latency_tracker: LatencyTracker | None = None) -> tuple[T, bool]:
+    """call を実行し、delay_sec 経っても終わらなければ同じ call をもう一つ実行して、先に成功した方の結果を返す
+
+    戻り値は (結果, もう一つ実行したか)。両方失敗した場合は後に失敗した方の例外を送出する。
+    latency_tracker を渡した場合は、成功した call の所要時間を最初の call を実行した時点から測って記録する。
+    遅かった方の所要時間も記録するため、結果を返した後も残った方はキャンセルせずに実行し続ける
+    (分位点を遅延の判断に使う場合、速かった方だけを記録すると分位点が下がっていき、もう一つ実行することが増えていくため)
+    """
+    start = time.monotonic()
+
+    def on_done(task: asyncio.Task[T]) -> None:
+        if task.cancelled() or task.exception() is not None:
+            return
+        if latency_tracker is not None:
+            latency_tracker.record(time.monotonic() - start)
+
+    def submit() -> asyncio.Task[T]:
+        task = asyncio.ensure_future(call())
+        task.add_done_callback(on_done)
+        return task
+
+    first = submit()
+    tasks = {first}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay_sec)
+        if done:
+            return first.result(), False
+        tasks.add(submit())
+        error: BaseException | None = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    # 残った方は所要時間を記録するために実行し続ける
+                    for pending in tasks:
+                        _background_tasks.add(pending)
+                        pending.add_done_callback(_background_tasks.discard)
+                    tasks = set()
+                    return task.result(), True
+                error = task.exception()
+        assert error is not None
+        raise error
+    finally:
+        # 呼び出し元がキャンセルされた場合などは、実行中の call をキャンセルする
+        for task in tasks:
+            task.cancel()
@@ -1,31 +1,63 @@
-import functools
+import asyncio
+import contextvars
 import json
 import logging
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 
-import google.generativeai as genai
-import MeCab
 import pandas as pd
-from langchain.retrievers.ensemble import EnsembleRetriever
 from langchain.schema.document import Document
 from langchain.text_splitter import CharacterTextSplitter
-from langchain_community.retrievers import BM25Retriever
-from langchain_community.vectorstores import FAISS
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 
 from src.config import settings
+from src.llm import generate_content, llm_scheduler
+from src.llm_scheduler import ScheduledEmbeddings
+from src.prompts import BEST_KNOWLEDGE_PROMPT, N_BEST_KNOWLEDGE_PROMPT
+from src.retrieval.bm25 import BM25Corpus, BM25CorpusRegistry
+from src.retrieval.embeddings import EMBEDDING_MODEL_NAME, CachedQueryEmbeddings
+from src.retrieval.faiss_registry import FaissIndexRegistry
+from src.retrieval.hybrid import FusionMethod, HybridRetriever
+from src.retrieval.rerank import LocalReranker
+from src.retrieval.rerank_cache import RerankDecisionCache
+from src.retrieval.tokenizer import JapaneseTokenizer
+from src.retrieval.vector_search import similarity_search_with_score_by_vectors
+from src.schema.retrieval import IndexSearchResult, ScoredDocument
 
 LOGGER = logging.getLogger(__name__)
 
-genai.configure(api_key=settings.GOOGLE_API_KEY)
 os.environ["GOOGLE_API_KEY"] = settings.GOOGLE_API_KEY
 
+QA_INDEX_NAME = "qa"
+KNOWLEDGE_INDEX_NAME = "knowledge"
 
-@functools.lru_cache(maxsize=1)
-def _create_bm25_knowledge_db():
-    knowledge_file_path = settings.PYTHON_SERVER_ROOT / "faiss_knowledge" / "manifesto_demo_slides.csv"
+# 配信では同じ質問が繰り返されることが多いので、クエリの埋め込みは全ての検索で共有してキャッシュする
+query_embeddings = CachedQueryEmbeddings(
+    embeddings=ScheduledEmbeddings(GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL_NAME), scheduler=llm_scheduler),
+    model_name=EMBEDDING_MODEL_NAME,
+    query_task_type="RETRIEVAL_QUERY",
+    max_size=settings.EMBEDDING_CACHE_MAX_SIZE,
+    ttl_sec=settings.EMBEDDING_CACHE_TTL_SEC,
+)
 
+# FAISS のインデックスはプロセス内で使い回す
+faiss_index_registry = FaissIndexRegistry(
+    embeddings=query_embeddings,
+    check_interval_sec=settings.FAISS_INDEX_RELOAD_CHECK_INTERVAL_SEC,
+)
+faiss_index_registry.register(QA_INDEX_NAME, settings.FAISS_QA_DB_DIR)
+faiss_index_registry.register(KNOWLEDGE_INDEX_NAME, settings.FAISS_KNOWLEDGE_DB_DIR)
+
+# LLM によるリランクの結果(選んだ文書の番号)を、質問・候補の文書・インデックスのバージョンごとにキャッシュする
+rerank_decision_cache = RerankDecisionCache(max_size=settings.RERANK_CACHE_MAX_SIZE, ttl_sec=settings.RERANK_CACHE_TTL_SEC)
+
+
+KNOWLEDGE_FILE_PATH = settings.PYTHON_SERVER_ROOT / "faiss_knowledge" / "manifesto_demo_slides.csv"
+
+
+def load_knowledge_documents(knowledge_file_path=KNOWLEDGE_FILE_PATH) -> list[Document]:
+    """ナレッジの CSV を読み込んでチャンクに分割する"""
     docs = []
     manifests = pd.read_csv(knowledge_file_path)
     for i, row in enumerate(manifests.to_dict(orient="records")):
@@ -43,91 +75,204 @@ def _create_bm25_knowledge_db():
         chunk_size=300,  # チャンクの文字数
         chunk_overlap=0,  # チャンクオーバーラップの文字数
     )
-    documents = text_splitter.split_documents(docs)
-    bm25_search = BM25Retriever.from_documents(documents, preprocess_func=preprocess)
-    return bm25_search
+    return text_splitter.split_documents(docs)
+
+
+def _create_bm25_knowledge_db() -> BM25Corpus:
+    """BM25 のインデックスを読み込む
+
+    事前に save_faiss_knowledge_db で作成したものを使う。存在しない場合はその場で作成する。
+    ナレッジの FAISS のインデックスが読み込み直された場合は、BM25 のインデックスも読み込み直す
+    """
+    return bm25_knowledge_registry.get(knowledge_index_version())
+
+
+def knowledge_index_version() -> str:
+    """ナレッジのインデックスのバージョン
+
+    BM25 のインデックスは FAISS のインデックスと同時に同じ文書から作り、FAISS のインデックスのバージョンが変わると読み込み直すので、
+    FAISS のインデックスのバージョンを使う
+    """
+    return faiss_index_registry.version(KNOWLEDGE_INDEX_NAME)
+
+
+def retrieval_index_version() -> str:
+    """QA とナレッジのインデックスのバージョン(いずれかが更新されると変わる)"""
+    return f"{faiss_index_registry.version(QA_INDEX_NAME)}/{knowledge_index_version()}"
 
 
-@functools.lru_cache(maxsize=1)
-def load_stopwords() -> list[str]:
+def warm_up_retrieval() -> None:
+    """検索に使うインデックスを全て読み込んでおく"""
+    faiss_index_registry.warm_up()
+    try:
+        _create_bm25_knowledge_db()
+    except Exception:
+        LOGGER.exception("Failed to load the BM25 index.")
+
+
+japanese_tokenizer = JapaneseTokenizer.from_stopwords_file(settings.PYTHON_SERVER_ROOT / "src" / "stopwords-ja.txt")
+
+bm25_knowledge_registry = BM25CorpusRegistry(path=settings.BM25_KNOWLEDGE_DB_DIR, tokenizer=japanese_tokenizer, build_documents=load_knowledge_documents)
+
+
+def load_stopwords() -> frozenset[str]:
     """ストップワードを読み込む"""
-    stopword_path = settings.PYTHON_SERVER_ROOT / "src" / "stopwords-ja.txt"
-    with open(stopword_path) as f:
-        stopwords = f.read().split("\n")
-    return stopwords
+    return japanese_tokenizer.stopwords
 
 
 def extract_nouns_verbs(text):
     """名詞動詞形状詞のみ抜く"""
-    parser = MeCab.Tagger()
-    parsed_text = parser.parse(text)
-    lines = parsed_text.split("\n")
-    nouns_verbs = []
-    for line in lines:
-        if "名詞" in line or "動詞" in line or "形状詞" in line:
-            parts = line.split("\t")
-            word = parts[0]
-            if not word.isascii():
-                nouns_verbs.append(word)
-    return nouns_verbs
+    return japanese_tokenizer.extract_content_words(text)
+
+
+def tokenize(text) -> list[str]:
+    """BM25 用にテキストを分かち書きする"""
+    return japanese_tokenizer.tokenize(text)
 
 
 def preprocess(text):
     """前処理適用関数"""
-    stopwords = load_stopwords()
-    token_list = [token for token in extract_nouns_verbs(text) if token not in stopwords]
-    return " ".join(token_list)
+    return " ".join(tokenize(text))
+
+
+def search_bm25_knowledge(query: str, top_k: int = 5) -> list[ScoredDocument]:
+    """bm25での検索(スコアの高い順)"""
+    corpus = _create_bm25_knowledge_db()
+    doc_ids, scores = corpus.index.search(japanese_tokenizer.tokenize_query(query), top_k)
+    return [
+        ScoredDocument(page_content=corpus.documents[doc_id].page_content, metadata=corpus.documents[doc_id].metadata, score=float(score))
+        for doc_id, score in zip(doc_ids, scores, strict=True)
+    ]
+
+
+def search_bm25_knowledge_batch(queries: list[str], top_k: int = 5) -> list[list[ScoredDocument]]:
+    """複数のクエリでまとめて bm25 での検索を行う(それぞれスコアの高い順)"""
+    corpus = _create_bm25_knowledge_db()
+    results = corpus.index.search_batch([japanese_tokenizer.tokenize_query(query) for query in queries], top_k)
+    return [
+        [
+            ScoredDocument(page_content=corpus.documents[doc_id].page_content, metadata=corpus.documents[doc_id].metadata, score=float(score))
+            for doc_id, score in zip(doc_ids, scores, strict=True)
+        ]
+        for doc_ids, scores in results
+    ]
 
 
 def get_bm25_knowledge(query, top_k=5):
     """bm25での検索"""
-    bm25_retriever = _create_bm25_knowledge_db()
-    bm25_retriever.k = top_k
-    context_docs = bm25_retriever.get_relevant_documents(query)
-    print(f"len={len(context_docs)}")
-    top_docs = context_docs[:top_k]
+    top_docs = search_bm25_knowledge(query, top_k=top_k)
+    LOGGER.debug("BM25 knowledge: len=%d", len(top_docs))
     return [(doc.page_content, doc.metadata) for doc in top_docs]
 
 
-def get_hybrid_knowledge(query, top_k=5):
-    """ハイブリッド検索"""
-    bm25_retriever = _create_bm25_knowledge_db()
-    bm25_retriever.k = top_k
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-    vector = FAISS.load_local(
-        settings.FAISS_KNOWLEDGE_DB_DIR,
-        embeddings,
-        allow_dangerous_deserialization=True,
-    )
-    faiss_retriever = vector.as_retriever(search_kwargs={"k": top_k})
-    ensemble_retriever = EnsembleRetriever(retrievers=[bm25_retriever, faiss_retriever], weights=[0.5, 0.5])
-    context_docs = ensemble_retriever.get_relevant_documents(query)
-    print(f"len={len(context_docs)}")
-    top_docs = context_docs[:top_k]
+def search_hybrid_knowledge(query: str, top_k: int = 5, vector: list[float] | None = None) -> list[ScoredDocument]:
+    """ハイブリッド検索(統合後のスコアの高い順)
+
+    vector を渡した場合は、クエリを埋め込み直さずにそのベクトルでベクトル検索を行う
+    """
+    return hybrid_knowledge_retriever.search(query, top_k, vector=vector)
+
+
+def get_hybrid_knowledge(query, top_k=5, vector=None):
+    """ハイブリッド検索
+
+    vector を渡した場合は、クエリを埋め込み直さずにそのベクトルでベクトル検索を行う
+    """
+    top_docs = search_hybrid_knowledge(query, top_k=top_k, vector=vector)
+    LOGGER.debug("Hybrid knowledge: len=%d", len(top_docs))
     return [(doc.page_content, doc.metadata) for doc in top_docs]
 
 
+def search_hybrid_knowledge_batch(queries: list[str], top_k: int = 5, vectors: list[list[float]] | None = None) -> list[list[ScoredDocument]]:
+    """複数のクエリでまとめてハイブリッド検索を行う
+
+    埋め込み・ベクトル検索・BM25 をそれぞれ全クエリについて一度に行ってから、クエリごとにスコアを統合する
+    """
+    if vectors is None:
+        vectors = embed_queries(queries)
+    keyword_future = _retrieval_executor.submit(contextvars.copy_context().run, search_bm25_knowledge_batch, queries, top_k)
+    vector_results = search_index_by_vectors(KNOWLEDGE_INDEX_NAME, vectors, top_k=top_k)
+    keyword_results = keyword_future.result()
+    return [hybrid_knowledge_retriever.fuse(keyword_docs, vector_docs)[:top_k] for keyword_docs, vector_docs in zip(keyword_results, vector_results, strict=True)]
+
+
+def embed_query(query: str) -> list[float]:
+    """クエリを埋め込む(キャッシュ付き)"""
+    return query_embeddings.embed_query(query)
+
+
+def embed_queries(queries: list[str]) -> list[list[float]]:
+    """複数のクエリをまとめて埋め込む(キャッシュ付き)"""
+    return query_embeddings.embed_queries(queries)
+
+
+def search_indexes(query: str, *, top_k: int | dict[str, int] = 5, vector: list[float] | None = None) -> IndexSearchResult:
+    """クエリを一度だけ埋め込み、登録されている全てのインデックスをベクトルで検索する
+
+    top_k に dict を渡した場合は、そのキーのインデックスのみをそれぞれの件数で検索する
+    """
+    if vector is None:
+        vector = embed_query(query)
+    top_ks = top_k if isinstance(top_k, dict) else dict.fromkeys(faiss_index_registry.names, top_k)
+    results = {name: search_index_by_vector(name, vector, top_k=k) for name, k in top_ks.items()}
+    return IndexSearchResult(vector=vector, results=results)
+
+
+def search_index_by_vector(index_name: str, vector: list[float], *, top_k: int) -> list[ScoredDocument]:
+    """ベクトルでインデックスを検索し、関連度とともに返す"""
+    store = faiss_index_registry.get(index_name)
+    # 距離を 0~1 の関連度に変換する関数(距離の種類によって異なる)
+    relevance_score_fn = store._select_relevance_score_fn()
+    docs_and_scores = store.similarity_search_with_score_by_vector(vector, k=top_k)
+    return [ScoredDocument(page_content=doc.page_content, metadata=doc.metadata, score=relevance_score_fn(score)) for doc, score in docs_and_scores]
+
+
+def search_index_by_vectors(index_name: str, vectors: list[list[float]], *, top_k: int) -> list[list[ScoredDocument]]:
+    """複数のベクトルでインデックスを一度に検索し、ベクトルごとの結果を関連度とともに返す"""
+    store = faiss_index_registry.get(index_name)
+    relevance_score_fn = store._select_relevance_score_fn()
+    return [
+        [ScoredDocument(page_content=doc.page_content, metadata=doc.metadata, score=relevance_score_fn(score)) for doc, score in docs_and_scores]
+        for docs_and_scores in similarity_search_with_score_by_vectors(store, vectors, k=top_k)
+    ]
+
+
+# BM25 とベクトル検索の並行実行に使う
+_retrieval_executor = ThreadPoolExecutor(max_workers=settings.RETRIEVAL_MAX_WORKERS, thread_name_prefix="retrieval")
+
+hybrid_knowledge_retriever = HybridRetriever(
+    keyword_search=search_bm25_knowledge,
+    vector_search=lambda vector, top_k: search_index_by_vector(KNOWLEDGE_INDEX_NAME, vector, top_k=top_k),
+    embed_query=embed_query,
+    executor=_retrieval_executor,
+    keyword_weight=settings.HYBRID_BM25_WEIGHT,
+    vector_weight=settings.HYBRID_VECTOR_WEIGHT,
+    method=FusionMethod(settings.HYBRID_FUSION_METHOD),
+)
+
+local_reranker = LocalReranker(
+    tokenizer=japanese_tokenizer,
+    weights={
+        "fused": settings.LOCAL_RERANK_FUSED_WEIGHT,
+        "vector": settings.LOCAL_RERANK_VECTOR_WEIGHT,
+        "coverage": settings.LOCAL_RERANK_COVERAGE_WEIGHT,
+        "title": settings.LOCAL_RERANK_TITLE_WEIGHT,
+    },
+    min_score=settings.LOCAL_RERANK_MIN_SCORE,
+)
+
+
 def get_qa(query):
     """回答例を一つ取得する"""
     result = get_multiple_qa(query=query, top_k=1)
     return result[0]
 
 
-def get_multiple_qa(*, query, top_k=5):
+def get_multiple_qa(*, query, top_k=5, vector=None):
     """回答例を取得する"""
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-    vector = FAISS.load_local(
-        settings.FAISS_QA_DB_DIR,
-        embeddings,
-        allow_dangerous_deserialization=True,
-    )
-
-    retriever = vector.as_retriever()
-
-    context_docs = retriever.get_relevant_documents(query)
-    print(f"len={len(context_docs)}")
-
-    top_docs = context_docs[:top_k]
+    result = search_indexes(query, top_k={QA_INDEX_NAME: top_k}, vector=vector)
+    top_docs = result.results[QA_INDEX_NAME]
+    LOGGER.debug("QA: len=%d", len(top_docs))
     return [doc.page_content for doc in top_docs]
 
 
@@ -137,77 +282,140 @@ def get_knowledge(query):
     return result[0]
 
 
-def get_multiple_knowledge(*, query, top_k=10):
+def get_multiple_knowledge(*, query, top_k=10, vector=None):
     """RAGナレッジを取得する"""
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-    vector = FAISS.load_local(
-        settings.FAISS_KNOWLEDGE_DB_DIR,
-        embeddings,
-        allow_dangerous_deserialization=True,
-    )
+    result = search_indexes(query, top_k={KNOWLEDGE_INDEX_NAME: top_k}, vector=vector)
+    top_docs = result.results[KNOWLEDGE_INDEX_NAME]
+    LOGGER.debug("Knowledge: len=%d, metadata=%s", len(top_docs), [doc.metadata for doc in top_docs])
+    return [(doc.page_content, doc.metadata) for doc in top_docs]
+
+
+async def aembed_query(query: str) -> list[float]:
+    """クエリを埋め込む(キャッシュ付き)の非同期版"""
+    return await query_embeddings.aembed_query(query)
+
+
+# 以下は検索関数の非同期版。
+# クエリの埋め込みは非同期に行い、インデックスの読み込みや検索(CPU処理)はスレッドで実行してイベントループを止めないようにする
+
+
+async def aknowledge_index_version() -> str:
+    """knowledge_index_version の非同期版"""
+    return await asyncio.to_thread(knowledge_index_version)
+
 
-    retriever = vector.as_retriever(search_kwargs={"k": top_k})
+async def aretrieval_index_version() -> str:
+    """retrieval_index_version の非同期版"""
+    return await asyncio.to_thread(retrieval_index_version)
 
-    context_docs = retriever.get_relevant_documents(query)
-    print(f"len={len(context_docs)}")
 
-    top_docs = context_docs[:top_k]
-    for doc in top_docs:
-        print(f"metadata={doc.metadata}")
+async def asearch_indexes(query: str, *, top_k: int | dict[str, int] = 5, vector: list[float] | None = None) -> IndexSearchResult:
+    """search_indexes の非同期版"""
+    if vector is None:
+        vector = await aembed_query(query)
+    return await asyncio.to_thread(search_indexes, query, top_k=top_k, vector=vector)
+
+
+async def aembed_queries(queries: list[str]) -> list[list[float]]:
+    """embed_queries の非同期版"""
+    return await asyncio.to_thread(embed_queries, queries)
+
+
+async def asearch_index_by_vectors(index_name: str, vectors: list[list[float]], *, top_k: int) -> list[list[ScoredDocument]]:
+    """search_index_by_vectors の非同期版"""
+    return await asyncio.to_thread(search_index_by_vectors, index_name, vectors, top_k=top_k)
+
+
+async def asearch_hybrid_knowledge_batch(queries: list[str], top_k: int = 5, vectors: list[list[float]] | None = None) -> list[list[ScoredDocument]]:
+    """search_hybrid_knowledge_batch の非同期版"""
+    return await asyncio.to_thread(search_hybrid_knowledge_batch, queries, top_k, vectors)
+
+
+async def asearch_hybrid_knowledge(query: str, top_k: int = 5, vector: list[float] | None = None) -> list[ScoredDocument]:
+    """search_hybrid_knowledge の非同期版"""
+    if vector is None:
+        vector = await aembed_query(query)
+    return await asyncio.to_thread(search_hybrid_knowledge, query, top_k, vector)
+
+
+async def aget_hybrid_knowledge(query, top_k=5, vector=None):
+    """get_hybrid_knowledge の非同期版"""
+    top_docs = await asearch_hybrid_knowledge(query, top_k=top_k, vector=vector)
+    LOGGER.debug("Hybrid knowledge: len=%d", len(top_docs))
     return [(doc.page_content, doc.metadata) for doc in top_docs]
 
 
-DEFAULT_FALLBACK_KNOWLEDGE_METADATA = {"row": 1, "image": "slide_1.png"}
+async def aget_qa(query, vector=None):
+    """get_qa の非同期版"""
+    result = await aget_multiple_qa(query=query, top_k=1, vector=vector)
+    return result[0]
 
 
-async def get_best_knowledge(query, top_k=15):
-    """RAGナレッジを取得した上でLLMで評価する"""
-    top_docs = get_multiple_knowledge(query=query, top_k=top_k)
-    docs = ""
-    for idx, (doc, metadata) in enumerate(top_docs, 1):
-        print(f"metadata={metadata}")
-        print(doc)
-        docs += f"[ドキュメント id={idx}]\n{doc}\n\n"
+async def aget_multiple_qa(*, query, top_k=5, vector=None):
+    """get_multiple_qa の非同期版"""
+    if vector is None:
+        vector = await aembed_query(query)
+    return await asyncio.to_thread(get_multiple_qa, query=query, top_k=top_k, vector=vector)
 
-    system_prompt = f"""
-以下のドキュメントの中から最も入力に関連のある1から{top_k}までのドキュメントのidを答えてください。
-もし関連のあるドキュメントがない場合は0を出力してください。
-回答は答えの数字のみでお願いします。理由など他の情報は不要です。
 
-[出力例]
-0
+async def aget_knowledge(query, vector=None):
+    """get_knowledge の非同期版"""
+    result = await aget_multiple_knowledge(query=query, top_k=1, vector=vector)
+    return result[0]
 
-[入力]
-{query}
 
-{docs}
+async def aget_multiple_knowledge(*, query, top_k=10, vector=None):
+    """get_multiple_knowledge の非同期版"""
+    if vector is None:
+        vector = await aembed_query(query)
+    return await asyncio.to_thread(get_multiple_knowledge, query=query, top_k=top_k, vector=vector)
 
-"""
-    LOGGER.debug("Ask the AI to find the best knowledge (top_k=%d, found_docs=%d, query=%s)", top_k, len(top_docs), query)
-    model = genai.GenerativeModel("gemini-1.5-pro", generation_config={"response_mime_type": "application/json"})
-    response = model.generate_content(system_prompt)
-    reply = response.text
 
-    LOGGER.warning("AI response: %s", reply)
-    LOGGER.warning("文書数: %s", len(top_docs))
-    number_match = re.search(r"[\d]+", reply)
-    if not number_match:
-        LOGGER.warning("No number found in the AI response.")
-        return "該当する知識は存在しません。政策に関係しない話題には回答を差し控えてください。", DEFAULT_FALLBACK_KNOWLEDGE_METADATA
+DEFAULT_FALLBACK_KNOWLEDGE_METADATA = {"row": 1, "image": "slide_1.png"}
+
+
+async def get_best_knowledge(query, top_k=15, vector=None):
+    """RAGナレッジを取得した上でLLMで評価する"""
+    top_docs = await aget_multiple_knowledge(query=query, top_k=top_k, vector=vector)
+    docs = ""
+    for idx, (doc, metadata) in enumerate(top_docs, 1):
+        LOGGER.debug("Candidate %d: metadata=%s\n%s", idx, metadata, doc)
+        docs += f"[ドキュメント id={idx}]\n{doc}\n\n"
+
+    system_instruction = BEST_KNOWLEDGE_PROMPT.prefix(top_k=top_k)
+    contents = BEST_KNOWLEDGE_PROMPT.suffix(query=query, docs=docs)
+    cache_key = rerank_decision_cache.key(f"best:{top_k}", query, (doc for doc, _ in top_docs), await aknowledge_index_version())
+    cached_decision = rerank_decision_cache.get(cache_key)
+    if cached_decision is not None:
+        number = cached_decision[0]
+        reply = str(number)
+        LOGGER.debug("Use the cached rerank decision: %d (query=%s)", number, query)
     else:
-        number = int(number_match[0])
-        LOGGER.info("Picked up the index:%d for %d docs", number, len(top_docs))
+        LOGGER.debug("Ask the AI to find the best knowledge (top_k=%d, found_docs=%d, query=%s)", top_k, len(top_docs), query)
+        response = await generate_content(contents, system_instruction=system_instruction)
+        reply = response.text
+
+        LOGGER.warning("AI response: %s", reply)
+        LOGGER.warning("文書数: %s", len(top_docs))
+        number_match = re.search(r"[\d]+", reply)
+        if not number_match:
+            LOGGER.warning("No number found in the AI response.")
+            return "該当する知識は存在しません。政策に関係しない話題には回答を差し控えてください。", DEFAULT_FALLBACK_KNOWLEDGE_METADATA
+        else:
+            number = int(number_match[0])
+            LOGGER.info("Picked up the index:%d for %d docs", number, len(top_docs))
+            rerank_decision_cache.set(cache_key, [number])
 
     if number == 0 or number > top_k:
         LOGGER.warning("The number is out of range.")
         return "該当する知識は存在しません。政策に関係しない話題には回答を差し控えてください。", DEFAULT_FALLBACK_KNOWLEDGE_METADATA
     elif number > len(top_docs):
         # This should not happen but just in case
-        LOGGER.warning(f"Number is out of range: {number} > {len(top_docs)}. This was from this prompt: {system_prompt}.\nThe answer to this prompt was: {reply}")
+        LOGGER.warning(f"Number is out of range: {number} > {len(top_docs)}. This was from this prompt: {system_instruction}\n{contents}.\nThe answer to this prompt was: {reply}")
         return "ドキュメントの中から知識をうまく抽出出来ませんでした。自身がまだ学習中であり、その質問にまだ回答できない旨を回答して下さい", DEFAULT_FALLBACK_KNOWLEDGE_METADATA
     elif number < 0:
         # This should not happen but just in case
-        LOGGER.warning(f"Number is out of range: {number} < 0. This was from this prompt: {system_prompt}\nThe answer to this prompt was: {reply}")
+        LOGGER.warning(f"Number is out of range: {number} < 0. This was from this prompt: {system_instruction}\n{contents}\nThe answer to this prompt was: {reply}")
         return "ドキュメントの中から知識をうまく抽出出来ませんでした。自身がまだ学習中であり、その質問にまだ回答できない旨を回答して下さい", DEFAULT_FALLBACK_KNOWLEDGE_METADATA
     else:
         rel_doc = top_docs[number - 1]
@@ -215,68 +423,54 @@ async def get_best_knowledge(query, top_k=15):
         return rel_doc
 
 
-async def get_best_knowledge_with_score(query):
+async def get_best_knowledge_with_score(query, vector=None):
     """RAGナレッジを一つ、類似度とともに取得する"""
     LOGGER.debug("Get the best knowledge with score. Query=%s", query)
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-    vector = FAISS.load_local(
-        settings.FAISS_KNOWLEDGE_DB_DIR,
-        embeddings,
-        allow_dangerous_deserialization=True,
-    )
-
-    docs_and_scores = await vector.asimilarity_search_with_relevance_scores(query=query, k=1)
-    doc, score = docs_and_scores[0]
-    doc_in_prompt = f"関連度（-1.0 ~ +1.0）: {score}\n関連情報本文: {doc.page_content}"
+    search_result = await asearch_indexes(query, top_k={KNOWLEDGE_INDEX_NAME: 1}, vector=vector)
+    doc = search_result.results[KNOWLEDGE_INDEX_NAME][0]
+    doc_in_prompt = f"関連度（-1.0 ~ +1.0）: {doc.score}\n関連情報本文: {doc.page_content}"
     return doc_in_prompt, doc.metadata
 
 
-async def get_n_best_knowledge(query, top_k=5, top_n=5):
+async def get_n_best_knowledge(query, top_k=5, top_n=5, vector=None):
     """RAGナレッジを取得した上でLLMで評価し、最大top_n個を返す"""
-    top_docs = get_hybrid_knowledge(query=query, top_k=top_k)
+    top_docs = await aget_hybrid_knowledge(query=query, top_k=top_k, vector=vector)
     docs = ""
     for idx, (doc, metadata) in enumerate(top_docs, 1):
-        print(f"metadata={metadata}")
-        print(doc)
+        LOGGER.debug("Candidate %d: metadata=%s\n%s", idx, metadata, doc)
         docs += f"[ドキュメント id={idx}]\n{doc}\n\n"
 
-    system_prompt = f"""
-質問と、その質問に対して関連性が高いと判定された{top_k}件のドキュメントを与えるので、その中から関連度の高い{top_n}件のドキュメントのidをjsonで出力して下さい。
-
-* 抽象的な質問の場合は、なるべくその内容が包含されるようなドキュメントを選定して下さい
-    * e.g. 政策について質問された場合は、5つの政策全体について記載されたドキュメントを関連度が高いものと判断して下さい
-* idは配列に格納し、配列の要素は関連度の高い順に並べてください。
-* 該当するドキュメントが存在しない場合は空の配列を出力してください
-* 前提として、このシステムはyoutubeライブのコメントの自動返信や、電話での自動応答に利用されます
-    * それらのユーザーの質問に返答する際に有用なドキュメントを選定して下さい
-* 以下のjson形式で出力してください。リストの各要素はintを徹底してください。
-
-[出力例]
-{{
-    "results": [7, 3, 6]
-}}
-
-[質問]
-{query}
+    system_instruction = N_BEST_KNOWLEDGE_PROMPT.prefix(top_k=top_k, top_n=top_n)
+    contents = N_BEST_KNOWLEDGE_PROMPT.suffix(query=query, docs=docs)
+    cache_key = rerank_decision_cache.key(f"n_best:{top_k}:{top_n}", query, (doc for doc, _ in top_docs), await aknowledge_index_version())
+    results = rerank_decision_cache.get(cache_key)
+    if results is not None:
+        LOGGER.debug("Use the cached rerank decision: %s (query=%s)", results, query)
+    else:
+        LOGGER.debug("Ask the AI to find the best knowledge (top_k=%d, found_docs=%d, query=%s)", top_k, len(top_docs), query)
+        response = await generate_content(contents, system_instruction=system_instruction)
+        reply = response.text
+
+        try:
+            obj = json.loads(reply)
+            results = [int(i) for i in obj.get("results", [])]
+        except Exception as e:
+            LOGGER.warning("Failed to parse the JSON response: %s", reply)
+            LOGGER.exception(e)
+            return [("ドキュメントの中から知識をうまく抽出出来ませんでした。自身がまだ学習中であり、その質問に回答できない旨を回答して下さい", DEFAULT_FALLBACK_KNOWLEDGE_METADATA)]
+        rerank_decision_cache.set(cache_key, results)
 
-{docs}
+    rel_docs = [top_docs[i - 1] for i in results if 0 < i <= len(top_docs)]
+    if len(rel_docs) == 0:
+        return [("ドキュメントの中から知識をうまく抽出出来ませんでした。自身がまだ学習中であり、その質問に回答できない旨を回答して下さい", DEFAULT_FALLBACK_KNOWLEDGE_METADATA)]
+    return rel_docs
 
-"""
-    LOGGER.debug("Ask the AI to find the best knowledge (top_k=%d, found_docs=%d, query=%s)", top_k, len(top_docs), query)
-    model = genai.GenerativeModel("gemini-1.5-pro", generation_config={"response_mime_type": "application/json"})
-    response = model.generate_content(system_prompt)
-    reply = response.text
 
-    try:
-        obj = json.loads(reply)
-        results = obj.get("results", [])
-        if results and isinstance(results[0], str):
-            results = [int(i) for i in results]
-        rel_docs = [top_docs[i - 1] for i in results if 0 < i <= top_k]
-        if len(rel_docs) == 0:
-            return [("ドキュメントの中から知識をうまく抽出出来ませんでした。自身がまだ学習中であり、その質問に回答できない旨を回答して下さい", DEFAULT_FALLBACK_KNOWLEDGE_METADATA)]
-        return rel_docs
-    except Exception as e:
-        LOGGER.warning("Failed to parse the JSON response: %s", reply)
-        LOGGER.exception(e)
+async def get_n_best_knowledge_local(query, top_k=5, top_n=5, vector=None):
+    """get_n_best_knowledge の LLM を使わない版。ハイブリッド検索の結果を特徴量で並べ替えて最大top_n個を返す"""
+    candidates = await asearch_hybrid_knowledge(query, top_k=top_k, vector=vector)
+    rel_docs = local_reranker.rerank(query, candidates, top_n)
+    LOGGER.debug("Local rerank (top_k=%d, found_docs=%d, selected=%d, query=%s)", top_k, len(candidates), len(rel_docs), query)
+    if len(rel_docs) == 0:
         return [("ドキュメントの中から知識をうまく抽出出来ませんでした。自身がまだ学習中であり、その質問に回答できない旨を回答して下さい", DEFAULT_FALLBACK_KNOWLEDGE_METADATA)]
+    return [(doc.page_content, doc.metadata) for doc in rel_docs]
@@ -0,0 +1,119 @@
+import re
+import threading
+from collections.abc import Iterable
+from typing import NamedTuple
+
+from pydantic import BaseModel, computed_field
+
+from src.normalize import normalize_text
+from src.retrieval.tokenizer import JapaneseTokenizer
+
+# n-gram を作る前に取り除く空白と記号
+_IGNORED_CHARS = re.compile(r"[\s\W_]+")
+
+
+class GroundingScore(NamedTuple):
+    """回答が検索した知識に基づいているかの指標"""
+
+    # 回答の内容語のうち、知識に含まれるものの割合
+    token_coverage: float
+    # 回答の文字 n-gram のうち、知識に含まれるものの割合
+    ngram_coverage: float
+    # 回答に含まれ、知識に含まれない固有名詞
+    unknown_proper_nouns: list[str]
+    # 上記が全て閾値を満たしているか(満たしていれば LLM によるハルシネーションのチェックを省く)
+    grounded: bool
+
+
+class GroundingStats(BaseModel):
+    """ハルシネーションの事前チェックの統計情報"""
+
+    # 事前チェックした回答の数
+    checked: int
+    # 知識に基づいていると判定し、LLM によるチェックを省いた数
+    grounded: int
+    # LLM によるチェックに回した数
+    escalated: int
+    # LLM によるチェックに回したうち、ハルシネーションと判定された数
+    escalated_hallucinated: int
+
+    @computed_field  # type: ignore[prop-decorator]
+    @property
+    def llm_check_avoided_rate(self) -> float:
+        """LLM によるチェックを省いた割合"""
+        return self.grounded / self.checked if self.checked else 0.0
+
+
+class GroundingChecker:
+    """LLM を使わずに、回答が検索した知識に基づいているかを語彙の重なりで判定する
+
+    内容語と文字 n-gram の重なりが十分にあり、知識にない固有名詞を含まない回答は「知識に基づいている」とみなす。
+    それ以外は判定できないので、LLM によるハルシネーションのチェックに回す。
+    """
+
+    def __init__(
+        self,
+        *,
+        tokenizer: JapaneseTokenizer,
+        min_token_coverage: float = 0.8,
+        min_ngram_coverage: float = 0.6,
+        max_unknown_proper_nouns: int = 0,
+        ngram_size: int = 3,
+    ):
+        self._tokenizer = tokenizer
+        self._min_token_coverage = min_token_coverage
+        self._min_ngram_coverage = min_ngram_coverage
+        self._max_unknown_proper_nouns = max_unknown_proper_nouns
+        self._ngram_size = ngram_size
+        self._lock = threading.Lock()
+        self._checked = 0
+        self._grounded = 0
+        self._escalated_hallucinated = 0
+
+    def score(self, reply: str, sources: Iterable[str]) -> GroundingScore:
+        """回答が sources(検索したナレッジや想定 FAQ)に基づいているかを判定する"""
+        source_text = normalize_text("\n".join(sources))
+        reply_text = normalize_text(reply)
+
+        tokens = set(self._tokenizer.tokenize(reply_text))
+        # 分かち書きの違いに左右されないよう、知識の側は部分文字列で探す
+        token_coverage = sum(token in source_text for token in tokens) / len(tokens) if tokens else 1.0
+
+        ngrams = self._ngrams(reply_text)
+        ngram_coverage = len(ngrams & self._ngrams(source_text)) / len(ngrams) if ngrams else 1.0
+
+        unknown_proper_nouns = sorted({word for word in self._tokenizer.extract_proper_nouns(reply_text) if word not in source_text})
+
+        grounded = token_coverage >= self._min_token_coverage and ngram_coverage >= self._min_ngram_coverage and len(unknown_proper_nouns) <= self._max_unknown_proper_nouns
+        return GroundingScore(token_coverage=token_coverage, ngram_coverage=ngram_coverage, unknown_proper_nouns=unknown_proper_nouns, grounded=grounded)
+
+    def check(self, reply: str, sources: Iterable[str]) -> GroundingScore:
+        """score と同じ。判定の結果を統計情報に記録する"""
+        grounding_score = self.score(reply, sources)
+        with self._lock:
+            self._checked += 1
+            if grounding_score.grounded:
+                self._grounded += 1
+        return grounding_score
+
+    def record_llm_result(self, hallucinated: bool) -> None:
+        """LLM によるチェックに回した回答の判定結果を記録する(閾値の調整に使う)"""
+        if hallucinated:
+            with self._lock:
+                self._escalated_hallucinated += 1
+
+    @property
+    def stats(self) -> GroundingStats:
+        """統計情報"""
+        with self._lock:
+            return GroundingStats(
+                checked=self._checked,
+                grounded=self._grounded,
+                escalated=self._checked - self._grounded,
+                escalated_hallucinated=self._escalated_hallucinated,
+            )
+
+    def _ngrams(self, text: str) -> set[str]:
+        text = _IGNORED_CHARS.sub("", text)
+        n = self._ngram_size
+        return {text[i : i + n] for i in range(len(text) - n + 1)}
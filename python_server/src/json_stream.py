@@ -0,0 +1,71 @@
+import re
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class JsonStringFieldExtractor:
+    """断片ごとに届く JSON から、指定したフィールドの文字列の値を届いた分だけ取り出す
+
+    LLM の JSON 出力({"response": "..."})をストリーミングで受け取りながら、回答の文章を逐次取り出すのに使う。
+    エスケープシーケンスが断片の境目で切れている場合は、次の断片が届くまで取り出さない。
+    """
+
+    def __init__(self, field: str):
+        self._key_pattern = re.compile(rf'"{re.escape(field)}"\s*:\s*"')
+        self._buffer = ""
+        # 値の未処理部分の開始位置(値の開始がまだ届いていない場合は None)
+        self._pos: int | None = None
+        self._done = False
+
+    def feed(self, chunk: str) -> str:
+        """断片を追加し、新たに取り出せた値の文字列を返す"""
+        self._buffer += chunk
+        if self._done:
+            return ""
+        if self._pos is None:
+            match = self._key_pattern.search(self._buffer)
+            if match is None:
+                return ""
+            self._pos = match.end()
+
+        buffer = self._buffer
+        i = self._pos
+        decoded: list[str] = []
+        while i < len(buffer):
+            char = buffer[i]
+            if char == '"':
+                self._done = True
+                i += 1
+                break
+            if char != "\\":
+                decoded.append(char)
+                i += 1
+                continue
+            if i + 1 >= len(buffer):
+                break
+            escape = buffer[i + 1]
+            if escape != "u":
+                decoded.append(_ESCAPES.get(escape, escape))
+                i += 2
+                continue
+            if i + 6 > len(buffer):
+                break
+            code = int(buffer[i + 2 : i + 6], 16)
+            if 0xD800 <= code < 0xDC00:
+                # サロゲートペアは下位の \uXXXX まで揃ってから取り出す
+                if i + 12 > len(buffer):
+                    break
+                if buffer[i + 6 : i + 8] == "\\u":
+                    low = int(buffer[i + 8 : i + 12], 16)
+                    decoded.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                    i += 12
+                    continue
+            decoded.append(chr(code))
+            i += 6
+        self._pos = i
+        return "".join(decoded)
+
+    @property
+    def done(self) -> bool:
+        """値の終わりまで取り出したか"""
+        return self._done
@@ -0,0 +1,105 @@
+import asyncio
+import functools
+from collections.abc import AsyncIterator
+
+import google.generativeai as genai
+from google.generativeai.types import ContentsType, GenerateContentResponse
+
+from src.config import settings
+from src.llm_scheduler import LLMScheduler
+
+# 2024/08/31現在、生のAPIでないとjson modeが使えない
+# geminiはVertexではなくGoogle AI Studio経由で利用する。
+genai.configure(api_key=settings.GOOGLE_API_KEY)
+
+DEFAULT_MODEL_NAME = "gemini-1.5-pro"
+
+# Gemini と埋め込みの API 呼び出しは全てこのスケジューラを通す
+llm_scheduler = LLMScheduler(
+    max_concurrency=settings.LLM_MAX_CONCURRENCY,
+    reserved_concurrency=settings.LLM_RESERVED_CONCURRENCY_FOR_LIVE,
+    rate_per_sec=settings.LLM_RATE_LIMIT_PER_SEC,
+    burst=settings.LLM_RATE_LIMIT_BURST,
+)
+
+
+# stream_content で生成が終わったことを表す
+_END_OF_STREAM = object()
+
+
+def get_model(model_name: str = DEFAULT_MODEL_NAME, *, json_mode: bool = True, system_instruction: str | None = None) -> genai.GenerativeModel:
+    """モデルを取得する
+
+    モデルはプロセス内で使い回す。API のクライアント(接続)は google.generativeai がプロセス内で共有している
+    system_instruction には、リクエストによらない静的なプロンプト(prompts.SplitPrompt のプレフィックス)を渡す
+    """
+    # 引数の渡し方によらず同じキーになるよう、位置引数に揃えてからキャッシュを引く
+    return _get_model(model_name, json_mode, system_instruction)
+
+
+@functools.cache
+def _get_model(model_name: str, json_mode: bool, system_instruction: str | None) -> genai.GenerativeModel:
+    generation_config = {"response_mime_type": "application/json"} if json_mode else None
+    return genai.GenerativeModel(model_name, generation_config=generation_config, system_instruction=system_instruction)
+
+
+async def generate_content(
+    contents: ContentsType,
+    *,
+    model_name: str = DEFAULT_MODEL_NAME,
+    json_mode: bool = True,
+    system_instruction: str | None = None,
+) -> GenerateContentResponse:
+    """LLM で文章を生成する
+
+    イベントループを止めないよう、非同期のクライアントで呼び出す
+    優先度は llm_scheduler.llm_priority で指定する
+    """
+    model = get_model(model_name, json_mode=json_mode, system_instruction=system_instruction)
+    async with llm_scheduler.slot():
+        return await model.generate_content_async(contents)
+
+
+async def stream_content(
+    contents: ContentsType,
+    *,
+    model_name: str = DEFAULT_MODEL_NAME,
+    json_mode: bool = True,
+    system_instruction: str | None = None,
+) -> AsyncIterator[str]:
+    """LLM で文章を生成し、生成された順に断片を返す
+
+    llm_scheduler の枠は生成が終わった時点で返す(呼び出し元が断片を読むのが遅くても、他の呼び出しを待たせない)。
+    そのため生成された断片は、読まれるまで溜めておく
+    """
+    model = get_model(model_name, json_mode=json_mode, system_instruction=system_instruction)
+    chunks: asyncio.Queue[str | BaseException | object] = asyncio.Queue()
+
+    async def generate() -> None:
+        try:
+            async with llm_scheduler.slot():
+                response = await model.generate_content_async(contents, stream=True)
+                async for chunk in response:
+                    chunks.put_nowait(chunk.text)
+        except Exception as e:
+            chunks.put_nowait(e)
+        else:
+            chunks.put_nowait(_END_OF_STREAM)
+
+    # タスクは作成時のコンテキスト(優先度)を引き継ぐ
+    generating = asyncio.ensure_future(generate())
+    try:
+        while (chunk := await chunks.get()) is not _END_OF_STREAM:
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+    finally:
+        # 途中で読むのをやめた場合は生成も止める
+        generating.cancel()
+
+
+async def count_tokens(contents: ContentsType, *, model_name: str = DEFAULT_MODEL_NAME) -> int:
+    """入力のトークン数を数える"""
+    async with llm_scheduler.slot():
+        response = await get_model(model_name, json_mode=False).count_tokens_async(contents)
+    return response.total_tokens
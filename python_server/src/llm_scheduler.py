@@ -0,0 +1,244 @@
+import asyncio
+import collections
+import contextlib
+import heapq
+import itertools
+import threading
+import time
+from collections.abc import AsyncIterator, Callable, Iterator
+from contextvars import ContextVar
+from enum import IntEnum
+
+from langchain_core.embeddings import Embeddings
+from pydantic import BaseModel
+
+
+class LLMPriority(IntEnum):
+    """LLM・埋め込みの API 呼び出しの優先度(値が小さいほど優先する)"""
+
+    # 配信中のコメントへの回答
+    live_reply = 0
+    # 読み上げる回答の事前準備
+    tts_prep = 1
+    # コメントのフィルタリング
+    filter = 2
+    # 評価やインデックスの作成などのバッチ処理
+    batch = 3
+
+
+_current_priority: ContextVar[LLMPriority] = ContextVar("llm_priority", default=LLMPriority.batch)
+
+
+@contextlib.contextmanager
+def llm_priority(priority: LLMPriority) -> Iterator[None]:
+    """このブロック内(から呼び出した処理)での API 呼び出しの優先度を設定する
+
+    指定しない場合は batch として扱う
+    """
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def current_llm_priority() -> LLMPriority:
+    """現在の API 呼び出しの優先度"""
+    return _current_priority.get()
+
+
+class WaitTimeStats(BaseModel):
+    """待ち時間の統計情報(直近の呼び出しについて)"""
+
+    count: int
+    mean_sec: float
+    p50_sec: float
+    p95_sec: float
+    max_sec: float
+
+
+class LLMSchedulerStats(BaseModel):
+    """LLMScheduler の統計情報"""
+
+    in_flight: int
+    max_concurrency: int
+    # 優先度ごとの待っている呼び出しの数
+    queue_depth: dict[str, int]
+    # 優先度ごとの待ち時間
+    wait_time: dict[str, WaitTimeStats]
+
+
+class _Waiter:
+    def __init__(self, priority: LLMPriority, wake: Callable[[], None]):
+        self.priority = priority
+        self.wake = wake
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.cancelled = False
+
+
+class LLMScheduler:
+    """LLM・埋め込みの API 呼び出しの同時実行数とレートを制限し、優先度の高いものから実行する
+
+    * 同時に実行する呼び出しは max_concurrency まで。そのうち reserved_concurrency は live_reply のために空けておく
+    * トークンバケットで、1 秒あたり rate_per_sec 回(最大 burst 回まで連続)に制限する。rate_per_sec が 0 以下なら制限しない
+    * 待っている呼び出しは優先度の高い順、同じ優先度なら来た順に実行する
+
+    スレッドセーフで、イベントループ上の処理(slot)と別スレッドの処理(slot_sync)の両方から使える。
+    """
+
+    # 待ち時間の統計に使う直近の呼び出しの数(優先度ごと)
+    WAIT_TIME_WINDOW = 1000
+
+    def __init__(self, *, max_concurrency: int, reserved_concurrency: int = 0, rate_per_sec: float = 0.0, burst: int = 1):
+        self._max_concurrency = max_concurrency
+        self._reserved_concurrency = min(reserved_concurrency, max_concurrency - 1)
+        self._rate_per_sec = rate_per_sec
+        self._burst = max(burst, 1)
+        self._lock = threading.Lock()
+        self._queue: list[tuple[int, int, _Waiter]] = []
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._tokens = float(self._burst)
+        self._refilled_at = time.monotonic()
+        self._timer: threading.Timer | None = None
+        self._wait_times = {priority: collections.deque(maxlen=self.WAIT_TIME_WINDOW) for priority in LLMPriority}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: LLMPriority | None = None) -> AsyncIterator[None]:
+        """実行できるまで待ってからブロックを実行する(イベントループ上の処理用)"""
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[None] = loop.create_future()
+        waiter = _Waiter(current_llm_priority() if priority is None else priority, lambda: loop.call_soon_threadsafe(_set_done, future))
+        self._enqueue(waiter)
+        if not waiter.granted:
+            try:
+                await future
+            except asyncio.CancelledError:
+                if not self._cancel(waiter):
+                    self._release()
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    @contextlib.contextmanager
+    def slot_sync(self, priority: LLMPriority | None = None) -> Iterator[None]:
+        """実行できるまで待ってからブロックを実行する(別スレッドの処理用。イベントループ上では呼ばないこと)"""
+        event = threading.Event()
+        waiter = _Waiter(current_llm_priority() if priority is None else priority, event.set)
+        self._enqueue(waiter)
+        event.wait()
+        try:
+            yield
+        finally:
+            self._release()
+
+    @property
+    def stats(self) -> LLMSchedulerStats:
+        """統計情報"""
+        with self._lock:
+            queue_depth = dict.fromkeys((priority.name for priority in LLMPriority), 0)
+            for _, _, waiter in self._queue:
+                if not waiter.cancelled:
+                    queue_depth[waiter.priority.name] += 1
+            wait_time = {priority.name: _wait_time_stats(list(wait_times)) for priority, wait_times in self._wait_times.items()}
+            return LLMSchedulerStats(in_flight=self._in_flight, max_concurrency=self._max_concurrency, queue_depth=queue_depth, wait_time=wait_time)
+
+    def _enqueue(self, waiter: _Waiter) -> None:
+        with self._lock:
+            heapq.heappush(self._queue, (waiter.priority, next(self._sequence), waiter))
+            self._dispatch()
+
+    def _cancel(self, waiter: _Waiter) -> bool:
+        """待っている呼び出しを取り消す。既に実行が許可されていた場合は False"""
+        with self._lock:
+            if waiter.granted:
+                return False
+            waiter.cancelled = True
+            return True
+
+    def _release(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            self._dispatch()
+
+    def _on_timer(self) -> None:
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+
+    def _dispatch(self) -> None:
+        # self._lock を取得した状態で呼ぶこと
+        now = time.monotonic()
+        if self._rate_per_sec > 0:
+            self._tokens = min(self._burst, self._tokens + (now - self._refilled_at) * self._rate_per_sec)
+            self._refilled_at = now
+        while self._queue:
+            _, _, waiter = self._queue[0]
+            if waiter.cancelled:
+                heapq.heappop(self._queue)
+                continue
+            limit = self._max_concurrency if waiter.priority == LLMPriority.live_reply else self._max_concurrency - self._reserved_concurrency
+            if self._in_flight >= limit:
+                break
+            if self._rate_per_sec > 0 and self._tokens < 1:
+                if self._timer is None:
+                    self._timer = threading.Timer((1 - self._tokens) / self._rate_per_sec, self._on_timer)
+                    self._timer.daemon = True
+                    self._timer.start()
+                break
+            heapq.heappop(self._queue)
+            if self._rate_per_sec > 0:
+                self._tokens -= 1
+            self._in_flight += 1
+            waiter.granted = True
+            self._wait_times[waiter.priority].append(now - waiter.enqueued_at)
+            waiter.wake()
+
+
+class ScheduledEmbeddings(Embeddings):
+    """埋め込みの API 呼び出しを LLMScheduler を通して行う Embeddings"""
+
+    def __init__(self, embeddings: Embeddings, *, scheduler: LLMScheduler):
+        self._embeddings = embeddings
+        self._scheduler = scheduler
+
+    def embed_documents(self, texts: list[str], **kwargs) -> list[list[float]]:
+        """ドキュメントを埋め込む"""
+        with self._scheduler.slot_sync():
+            return self._embeddings.embed_documents(texts, **kwargs)
+
+    def embed_query(self, text: str) -> list[float]:
+        """クエリを埋め込む"""
+        with self._scheduler.slot_sync():
+            return self._embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        """ドキュメントを埋め込む"""
+        async with self._scheduler.slot():
+            return await self._embeddings.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        """クエリを埋め込む"""
+        async with self._scheduler.slot():
+            return await self._embeddings.aembed_query(text)
+
+
+def _set_done(future: asyncio.Future[None]) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+def _wait_time_stats(wait_times: list[float]) -> WaitTimeStats:
+    if not wait_times:
+        return WaitTimeStats(count=0, mean_sec=0.0, p50_sec=0.0, p95_sec=0.0, max_sec=0.0)
+    wait_times.sort()
+    return WaitTimeStats(
+        count=len(wait_times),
+        mean_sec=sum(wait_times) / len(wait_times),
+        p50_sec=wait_times[int(0.5 * (len(wait_times) - 1))],
+        p95_sec=wait_times[int(0.95 * (len(wait_times) - 1))],
+        max_sec=wait_times[-1],
+    )
@@ -26,6 +26,7 @@ class JsonFormatter(logging.Formatter):
             "question": record.question,
             "response": record.response,
             "latency": record.latency,
+            "fallbacks": record.fallbacks,
         }
         return json.dumps(log_entry, ensure_ascii=False)
 
@@ -47,6 +48,7 @@ class CsvFormatter(logging.Formatter):
             record.question,
             record.response,
             record.latency,
+            ",".join(record.fallbacks),
         ]
 
         csv_writer.writerow(log_entry)
@@ -64,6 +66,8 @@ class GPTLogRecord(logging.LogRecord):
     question: str
     response: str
     latency: float
+    # 予算に応じて行ったフォールバック(リランクの打ち切りなど)
+    fallbacks: list[str]
 
 
 class BaseGPTLogRecordTimedRotatingFileHandler(TimedRotatingFileHandler):
@@ -134,6 +138,7 @@ class GPTLogRecordCSVTimedRotatingFileHandler(BaseGPTLogRecordTimedRotatingFileH
         "question",
         "response",
         "latency",
+        "fallbacks",
     ]
 
     def custom_rotator(self, source: str, dest: str) -> None:
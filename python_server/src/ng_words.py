@@ -0,0 +1,163 @@
+import collections
+import csv
+import logging
+import pathlib
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from typing import NamedTuple
+
+LOGGER = logging.getLogger(__name__)
+
+# NG ワードを含んでいても、これらの語の一部である場合は NG としない(例: 「核」に対する「核家族」)
+DEFAULT_NG_WHITELIST = ("核家族", "中核", "核心")
+
+
+class AhoCorasick:
+    """複数のパターンを一度の走査で探す Aho-Corasick のオートマトン
+
+    照合にかかる時間はテキストの長さ(と見つかった数)にのみ比例し、パターンの数によらない
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self._patterns = list(patterns)
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        # その状態で見つかるパターンの id(fail を辿った先のものも含む)
+        self._outputs: list[list[int]] = [[]]
+        for pattern_id, pattern in enumerate(self._patterns):
+            if pattern:
+                self._add(pattern, pattern_id)
+        self._build_fail_links()
+
+    def iter_matches(self, text: str) -> Iterator[tuple[int, int, int]]:
+        """見つかったパターンの (開始位置, 終了位置, パターンの id) を終了位置の順に返す"""
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for pattern_id in self._outputs[state]:
+                yield end - len(self._patterns[pattern_id]), end, pattern_id
+
+    def _add(self, pattern: str, pattern_id: int) -> None:
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append([])
+            state = next_state
+        self._outputs[state].append(pattern_id)
+
+    def _build_fail_links(self) -> None:
+        # 浅い状態から順に、最長の接尾辞にあたる状態を fail に設定する
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._outputs[next_state] = self._outputs[next_state] + self._outputs[self._fail[next_state]]
+
+
+class NGWord(NamedTuple):
+    """NG ワードとそれを含む質問への返答(空の場合はデフォルトの返答)"""
+
+    ng: str
+    reply: str
+
+
+class NGWordMatcher:
+    """NG ワードの一覧をコンパイルした照合器
+
+    大文字小文字は区別しない。複数の NG ワードを含む場合は一覧で先にあるものを返す。
+    whitelist の語の中に現れる NG ワードは無視する。
+    """
+
+    def __init__(self, ng_words: Iterable[NGWord], *, whitelist: Iterable[str] = DEFAULT_NG_WHITELIST):
+        self._ng_words = [ng_word for ng_word in ng_words if ng_word.ng]
+        self._whitelist = list(whitelist)
+        # パターンの id は NG ワードの順、その後に whitelist の語
+        patterns = [ng_word.ng.lower() for ng_word in self._ng_words] + [word.lower() for word in self._whitelist]
+        self._automaton = AhoCorasick(patterns)
+
+    def __len__(self) -> int:
+        return len(self._ng_words)
+
+    def match(self, text: str) -> NGWord | None:
+        """テキストに含まれる NG ワードを返す。含まれない場合は None"""
+        n_ng_words = len(self._ng_words)
+        ng_matches: list[tuple[int, int, int]] = []
+        whitelisted: list[tuple[int, int]] = []
+        for start, end, pattern_id in self._automaton.iter_matches(text.lower()):
+            if pattern_id < n_ng_words:
+                ng_matches.append((start, end, pattern_id))
+            else:
+                whitelisted.append((start, end))
+        hits = [pattern_id for start, end, pattern_id in ng_matches if not any(w_start <= start and end <= w_end for w_start, w_end in whitelisted)]
+        if not hits:
+            return None
+        return self._ng_words[min(hits)]
+
+
+def load_ng_words(path: pathlib.Path) -> list[NGWord]:
+    """NG ワードの CSV (ng,reply の列) を読み込む"""
+    with path.open(encoding="utf8", newline="") as f:
+        return [NGWord(ng=row["ng"] or "", reply=row.get("reply") or "") for row in csv.DictReader(f)]
+
+
+class _LoadedMatcher(NamedTuple):
+    matcher: NGWordMatcher
+    signature: tuple[int, int]
+    checked_at: float
+
+
+class NGWordList:
+    """CSV から読み込んだ NG ワードの照合器を保持し、CSV が更新されたら読み込み直す
+
+    読み込みに失敗した場合は、それまでの照合器を使い続ける
+    """
+
+    def __init__(self, *, path: pathlib.Path, whitelist: Iterable[str] = DEFAULT_NG_WHITELIST, check_interval_sec: float = 5.0):
+        self._path = path
+        self._whitelist = list(whitelist)
+        self._check_interval_sec = check_interval_sec
+        self._loaded: _LoadedMatcher | None = None
+        self._lock = threading.Lock()
+
+    def match(self, text: str) -> NGWord | None:
+        """テキストに含まれる NG ワードを返す。含まれない場合は None"""
+        return self.matcher().match(text)
+
+    def matcher(self) -> NGWordMatcher:
+        """最新の CSV から作った照合器"""
+        loaded = self._loaded
+        now = time.monotonic()
+        if loaded is not None and now - loaded.checked_at < self._check_interval_sec:
+            return loaded.matcher
+        with self._lock:
+            loaded = self._loaded
+            try:
+                stat = self._path.stat()
+                signature = (stat.st_mtime_ns, stat.st_size)
+                if loaded is None or signature != loaded.signature:
+                    matcher = NGWordMatcher(load_ng_words(self._path), whitelist=self._whitelist)
+                    if loaded is not None:
+                        LOGGER.info("Reloaded the NG words: %s (%d words)", self._path, len(matcher))
+                    loaded = _LoadedMatcher(matcher=matcher, signature=signature, checked_at=now)
+                else:
+                    loaded = loaded._replace(checked_at=now)
+            except Exception:
+                if loaded is None:
+                    raise
+                LOGGER.exception("Failed to reload the NG words: %s", self._path)
+                loaded = loaded._replace(checked_at=now)
+            self._loaded = loaded
+            return loaded.matcher
@@ -0,0 +1,9 @@
+import neologdn
+
+
+def normalize_text(text: str) -> str:
+    """キャッシュのキーなどに使うため、表記ゆれを吸収したテキストを返す
+
+    全角・半角や長音記号などを neologdn で正規化し、前後の空白を除いて小文字にそろえる
+    """
+    return neologdn.normalize(text).strip().lower()
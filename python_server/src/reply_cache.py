@@ -0,0 +1,200 @@
+import datetime
+import logging
+import threading
+import time
+from collections.abc import Callable
+from contextlib import AbstractContextManager
+from typing import NamedTuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from src.databases.models.utils.default_func import aware_now
+from src.normalize import normalize_text
+from src.repository.reply_cache import ReplyCacheRepository
+from src.schema.reply_cache import CachedReply
+from src.ttl_cache import CacheStats, TTLCache
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _Entry(NamedTuple):
+    namespace: str
+    query: str
+    reply: str
+    image_filename: str
+    expires_at: float
+
+
+class SemanticReplyCache:
+    """質問の埋め込みで引く回答のキャッシュ
+
+    言い回しが少し違うだけの質問には同じ回答を返す。コサイン類似度が threshold 以上の質問の回答があればそれを返す。
+    namespace(検索ロジックなど回答の作り方)が異なる回答は使わない。
+    インデックスのバージョンが変わった場合は全て破棄する。
+    """
+
+    def __init__(self, *, threshold: float, ttl_sec: float, max_size: int):
+        self._threshold = threshold
+        self._ttl_sec = ttl_sec
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._version: str | None = None
+        self._entries: list[_Entry] = []
+        # 正規化した質問の埋め込み(行が _entries に対応する)
+        self._vectors: list[np.ndarray] = []
+        self._matrix: np.ndarray | None = None
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def lookup(self, vector: list[float], *, namespace: str, version: str) -> CachedReply | None:
+        """最も類似した質問の回答を返す。類似度が threshold 未満の場合は None"""
+        query_vector = _normalize(vector)
+        with self._lock:
+            self._ensure_version(version)
+            self._remove_expired()
+            matrix = self._get_matrix()
+            if matrix is None or matrix.shape[1] != len(query_vector):
+                self._misses += 1
+                return None
+            similarities = matrix @ query_vector
+            similarities[[entry.namespace != namespace for entry in self._entries]] = -np.inf
+            best = int(np.argmax(similarities))
+            if similarities[best] < self._threshold:
+                self._misses += 1
+                return None
+            self._hits += 1
+            entry = self._entries[best]
+            return CachedReply(query=entry.query, reply=entry.reply, image_filename=entry.image_filename, similarity=float(similarities[best]))
+
+    def store(self, query: str, vector: list[float], *, namespace: str, version: str, reply: str, image_filename: str) -> None:
+        """回答を保存する。上限を超えた場合は古いものから破棄する"""
+        entry = _Entry(namespace=namespace, query=query, reply=reply, image_filename=image_filename, expires_at=time.monotonic() + self._ttl_sec)
+        with self._lock:
+            self._ensure_version(version)
+            self._entries.append(entry)
+            self._vectors.append(_normalize(vector))
+            overflow = len(self._entries) - self._max_size
+            if overflow > 0:
+                del self._entries[:overflow]
+                del self._vectors[:overflow]
+                self._evictions += overflow
+            self._matrix = None
+
+    def clear(self) -> None:
+        """全て削除する"""
+        with self._lock:
+            self._entries.clear()
+            self._vectors.clear()
+            self._matrix = None
+
+    @property
+    def stats(self) -> CacheStats:
+        """統計情報"""
+        with self._lock:
+            return CacheStats(
+                size=len(self._entries),
+                max_size=self._max_size,
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                expirations=self._expirations,
+            )
+
+    def _ensure_version(self, version: str) -> None:
+        if version != self._version:
+            self._version = version
+            self._entries.clear()
+            self._vectors.clear()
+            self._matrix = None
+
+    def _remove_expired(self) -> None:
+        # 保存した順に並んでいるので、先頭から期限切れのものを取り除く
+        now = time.monotonic()
+        expired = 0
+        while expired < len(self._entries) and self._entries[expired].expires_at <= now:
+            expired += 1
+        if expired:
+            del self._entries[:expired]
+            del self._vectors[:expired]
+            self._expirations += expired
+            self._matrix = None
+
+    def _get_matrix(self) -> np.ndarray | None:
+        if not self._vectors:
+            return None
+        if self._matrix is None:
+            self._matrix = np.vstack(self._vectors)
+        return self._matrix
+
+
+class PersistentReplyCache:
+    """Postgres に保存する、正規化した質問文の完全一致で引く回答のキャッシュ
+
+    デプロイし直したプロセスや他のワーカーでも使えるよう DB に保存し、プロセス内の L1 キャッシュを前段に置く。
+    DB に接続できない場合はキャッシュがないものとして扱う。
+    """
+
+    def __init__(
+        self,
+        *,
+        session_factory: Callable[[], AbstractContextManager[Session]],
+        ttl_sec: float,
+        l1_max_size: int,
+        l1_ttl_sec: float,
+    ):
+        self._session_factory = session_factory
+        self._ttl_sec = ttl_sec
+        self._l1: TTLCache[CachedReply] = TTLCache(max_size=l1_max_size, ttl_sec=min(l1_ttl_sec, ttl_sec))
+
+    def get(self, text: str, *, namespace: str, version: str) -> CachedReply | None:
+        """質問に対する回答を返す。存在しない場合は None"""
+        normalized_text = normalize_text(text)
+        key = (namespace, normalized_text, version)
+        cached = self._l1.get(key)
+        if cached is not None:
+            return cached
+        try:
+            with self._session_factory() as session:
+                cached = ReplyCacheRepository(session).find_one(namespace=namespace, normalized_text=normalized_text, index_version=version, now=aware_now())
+        except Exception:
+            LOGGER.warning("Failed to read the reply cache from the database.", exc_info=True)
+            return None
+        if cached is not None:
+            self._l1.set(key, cached)
+        return cached
+
+    def set(self, text: str, *, namespace: str, version: str, reply: str, image_filename: str) -> None:
+        """回答を保存する"""
+        normalized_text = normalize_text(text)
+        self._l1.set((namespace, normalized_text, version), CachedReply(query=normalized_text, reply=reply, image_filename=image_filename, similarity=1.0))
+        try:
+            with self._session_factory() as session:
+                ReplyCacheRepository(session).save(
+                    namespace=namespace,
+                    normalized_text=normalized_text,
+                    index_version=version,
+                    reply=reply,
+                    image_filename=image_filename,
+                    expires_at=aware_now() + datetime.timedelta(seconds=self._ttl_sec),
+                )
+        except Exception:
+            LOGGER.warning("Failed to write the reply cache to the database.", exc_info=True)
+
+    def purge(self, *, version: str) -> int:
+        """期限切れの回答と、現在とは異なるインデックスで生成した回答を DB から削除する"""
+        with self._session_factory() as session:
+            return ReplyCacheRepository(session).delete_stale(index_version=version, now=aware_now())
+
+    @property
+    def stats(self) -> CacheStats:
+        """L1 キャッシュの統計情報"""
+        return self._l1.stats
+
+
+def _normalize(vector: list[float]) -> np.ndarray:
+    array = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(array)
+    return array / norm if norm > 0 else array
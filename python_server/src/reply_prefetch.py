@@ -0,0 +1,329 @@
+import asyncio
+import collections
+import logging
+from collections.abc import Awaitable, Callable
+from typing import NamedTuple
+
+from pydantic import BaseModel
+
+from src.chat_clustering import ChatClusterer
+from src.comment_prefilter import EXCLUDED_PREFIXES, comment_skeleton
+from src.llm_scheduler import LLMPriority, llm_priority
+from src.ttl_cache import TTLCache
+
+LOGGER = logging.getLogger(__name__)
+
+
+class PrefetchedReply(BaseModel):
+    """コメントに対して事前に用意した回答"""
+
+    message_id: str
+    question: str
+    response_text: str
+    image_filename: str
+    # 音声を合成できたか(できなかった場合は /voice で合成すること)
+    has_audio: bool
+    # この回答で答えるコメント(ほぼ同じ質問をまとめた場合は複数)のメッセージ ID と投稿者。先頭は message_id のもの
+    message_ids: list[str]
+    authors: list[str]
+
+
+class ReplyPrefetchStats(BaseModel):
+    """ReplyPrefetcher の統計情報"""
+
+    # 受け取ったコメントの数と、キューが一杯で捨てた数
+    submitted: int
+    dropped: int
+    # ほぼ同じ質問に対する回答を使い回した数
+    clustered: int
+    # フィルタリングで回答の対象外になった数
+    filtered_out: int
+    # 回答を用意できた数と、失敗した数
+    prefetched: int
+    failed: int
+    # 取り出されるのを待っている回答の数
+    ready: int
+    # フィルタリングを待っているコメントの数
+    queue_size: int
+
+
+class PrefetchBundle(NamedTuple):
+    """事前に用意した回答と、その音声(WAV)"""
+
+    reply: PrefetchedReply
+    audio: bytes | None
+
+
+class _Member(NamedTuple):
+    """回答で答えるコメント"""
+
+    message_id: str
+    author: str
+    text: str
+
+
+class ReplyPrefetcher:
+    """チャットのコメントを受け取った時点で、裏で回答と音声を用意しておく
+
+    submit されたコメントを batch_size 件ずつ filter_comments で判定し、回答の対象となったものについて
+    generate_reply で回答(文章と画像のファイル名)を生成し、synthesize で音声を合成して保存する。
+    用意できた回答は pop_next で古い順に取り出し、get でメッセージ ID から音声と合わせて取得できる。
+
+    clusterer を渡した場合は、フィルタリングを通ったコメントとほぼ同じ質問には新たに回答を用意せず、そのコメントの回答を使い回す
+    (回答の message_ids・authors にまとめた全てのコメントを入れる)。回答を用意できなかった場合は、まとめたコメントの回答を改めて用意する。
+
+    回答の生成と音声の合成は tts_prep、フィルタリングは filter の優先度で行うため、配信中の回答(live_reply)を妨げない
+    """
+
+    def __init__(
+        self,
+        *,
+        filter_comments: Callable[[list[str], list[str]], Awaitable[list[str]]],
+        generate_reply: Callable[[str], Awaitable[tuple[str, str]]],
+        synthesize: Callable[[str], Awaitable[bytes]],
+        max_queue_size: int,
+        batch_size: int,
+        concurrency: int,
+        max_ready: int,
+        ttl_sec: float,
+        clusterer: ChatClusterer | None = None,
+    ):
+        self._filter_comments = filter_comments
+        self._generate_reply = generate_reply
+        self._synthesize = synthesize
+        self._max_queue_size = max_queue_size
+        self._batch_size = batch_size
+        self._concurrency = concurrency
+        self._bundles: TTLCache[PrefetchBundle] = TTLCache(max_size=max_ready, ttl_sec=ttl_sec)
+        # 受け取ったことのあるメッセージ ID(同じメッセージが何度も送られてくることがあるため)
+        self._seen: TTLCache[bool] = TTLCache(max_size=max_queue_size + max_ready, ttl_sec=ttl_sec)
+        self._clusterer = clusterer
+        # 回答を用意するコメントのメッセージ ID ごとの、その回答で答えるコメント(先頭は回答を用意するコメント)
+        self._members: TTLCache[list[_Member]] = TTLCache(max_size=max_queue_size + max_ready, ttl_sec=ttl_sec)
+        # 他のコメントの回答を使い回すコメントの、回答を用意するコメントのメッセージ ID
+        self._representatives: TTLCache[str] = TTLCache(max_size=max_queue_size + max_ready, ttl_sec=ttl_sec)
+        # まだ取り出されていない回答のメッセージ ID(古い順)
+        self._ready: collections.deque[str] = collections.deque(maxlen=max_ready)
+        self._queue: asyncio.Queue[tuple[str, str, str]] | None = None
+        self._worker: asyncio.Task[None] | None = None
+        self._tasks: set[asyncio.Task[None]] = set()
+        self._semaphore: asyncio.Semaphore | None = None
+        self._submitted = 0
+        self._dropped = 0
+        self._clustered = 0
+        self._filtered_out = 0
+        self._prefetched = 0
+        self._failed = 0
+
+    def start(self) -> None:
+        """コメントを処理するワーカーを起動する(イベントループ上で呼ぶこと)"""
+        self._queue = asyncio.Queue(maxsize=self._max_queue_size)
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+        self._worker = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        """ワーカーと処理中の回答の生成を止める"""
+        tasks = [*self._tasks, *([self._worker] if self._worker is not None else [])]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker = None
+        self._queue = None
+
+    def submit(self, message_id: str, text: str, author: str) -> bool:
+        """コメントを受け取る。処理の対象にした場合は True
+
+        ワーカーが起動していない場合、受け取ったことのあるメッセージの場合、キューが一杯の場合は何もしない
+        """
+        if self._queue is None or self._seen.get(message_id) is not None:
+            return False
+        self._seen.set(message_id, True)
+        self._submitted += 1
+        try:
+            self._queue.put_nowait((message_id, text, author))
+        except asyncio.QueueFull:
+            self._dropped += 1
+            LOGGER.warning("Prefetch queue is full. Dropped message %s.", message_id)
+            return False
+        return True
+
+    def pop_next(self) -> PrefetchedReply | None:
+        """用意できた回答のうち、まだ取り出されていない最も古いものを取り出す。無い場合は None
+
+        取り出した回答も、期限が切れるまでは get で取得できる
+        """
+        while self._ready:
+            message_id = self._ready.popleft()
+            bundle = self._bundles.get(message_id)
+            if bundle is not None:
+                return self._attribute(message_id, bundle.reply)
+        return None
+
+    def get(self, message_id: str) -> PrefetchBundle | None:
+        """メッセージ ID から用意できた回答と音声を取得する。無い場合は None
+
+        他のコメントの回答を使い回すコメントの場合は、そのコメントの回答を返す
+        """
+        message_id = self._representatives.get(message_id) or message_id
+        bundle = self._bundles.get(message_id)
+        if bundle is None:
+            return None
+        return bundle._replace(reply=self._attribute(message_id, bundle.reply))
+
+    @property
+    def stats(self) -> ReplyPrefetchStats:
+        """統計情報"""
+        return ReplyPrefetchStats(
+            submitted=self._submitted,
+            dropped=self._dropped,
+            clustered=self._clustered,
+            filtered_out=self._filtered_out,
+            prefetched=self._prefetched,
+            failed=self._failed,
+            ready=len(self._ready),
+            queue_size=0 if self._queue is None else self._queue.qsize(),
+        )
+
+    async def _run(self) -> None:
+        assert self._queue is not None
+        while True:
+            # 溜まっているコメントは、まとめてフィルタリングする
+            batch = [await self._queue.get()]
+            while len(batch) < self._batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            # フィルタリングを通った先のコメントとほぼ同じ質問は、フィルタリングもせずにその回答を使い回す
+            targets = [item for item in batch if not self._join_cluster(*item)]
+            # 同じバッチの骨格が同じコメントは、最初のコメントだけをフィルタリングし、その結果に従う
+            # (フィルタリングでは重複として落とされ、回答にまとめられなくなるため)
+            targets, duplicates = self._group_duplicates(targets)
+            if not targets:
+                continue
+
+            try:
+                with llm_priority(LLMPriority.filter):
+                    passed = collections.Counter(await self._filter_comments([text for _, text, _ in targets], [author for _, _, author in targets]))
+            except Exception:
+                LOGGER.warning("Failed to filter %d comments for prefetch.", len(targets), exc_info=True)
+                self._failed += len(targets) + sum(len(items) for items in duplicates.values())
+                continue
+
+            for message_id, text, author in targets:
+                if passed[text] <= 0:
+                    self._filtered_out += 1 + len(duplicates.get(message_id, []))
+                    continue
+                passed[text] -= 1
+                if not self._add_to_cluster(message_id, text, author):
+                    self._start_prefetch(message_id, text, author)
+                for item in duplicates.get(message_id, []):
+                    if not self._add_to_cluster(*item):
+                        self._start_prefetch(*item)
+
+    def _group_duplicates(self, items: list[tuple[str, str, str]]) -> tuple[list[tuple[str, str, str]], dict[str, list[tuple[str, str, str]]]]:
+        """骨格が同じコメントのうち最初のものと、そのメッセージ ID ごとの残りのコメントに分ける(回答を使い回す場合のみ)"""
+        if self._clusterer is None:
+            return items, {}
+        heads: dict[str, str] = {}
+        targets = []
+        duplicates: dict[str, list[tuple[str, str, str]]] = collections.defaultdict(list)
+        for message_id, text, author in items:
+            # 「#」から始まるコメントは回答しないため、まとめない(骨格は「#」を除いたコメントと同じになる)
+            if not text.lstrip().startswith(EXCLUDED_PREFIXES):
+                skeleton = comment_skeleton(text)
+                if skeleton in heads:
+                    duplicates[heads[skeleton]].append((message_id, text, author))
+                    continue
+                heads[skeleton] = message_id
+            targets.append((message_id, text, author))
+        return targets, duplicates
+
+    def _start_prefetch(self, message_id: str, text: str, author: str) -> None:
+        task = asyncio.ensure_future(self._prefetch(message_id, text, author))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _join_cluster(self, message_id: str, text: str, author: str) -> bool:
+        """フィルタリングを通ったほぼ同じ質問のコメントがあれば、その回答で答えるコメントに加えて True を返す"""
+        # 「#」から始まるコメントは回答しないため、他のコメントの回答を使い回さない
+        if self._clusterer is None or text.lstrip().startswith(EXCLUDED_PREFIXES):
+            return False
+        assignment = self._clusterer.join(text)
+        return assignment is not None and self._add_member(assignment.representative_id, _Member(message_id, author, text))
+
+    def _add_to_cluster(self, message_id: str, text: str, author: str) -> bool:
+        """フィルタリングを通ったコメントをクラスタに入れる
+
+        同じバッチの先に通ったコメントとほぼ同じ質問であれば、その回答で答えるコメントに加えて True を返す。
+        そうでなければ、このコメントの回答を用意する(False を返す)
+        """
+        if self._clusterer is not None:
+            assignment = self._clusterer.add(message_id, text)
+            if not assignment.is_new and self._add_member(assignment.representative_id, _Member(message_id, author, text)):
+                return True
+        self._members.set(message_id, [_Member(message_id, author, text)])
+        return False
+
+    def _add_member(self, representative_id: str, member: _Member) -> bool:
+        members = self._members.get(representative_id)
+        if members is None:
+            return False
+        members.append(member)
+        self._representatives.set(member.message_id, representative_id)
+        self._clustered += 1
+        return True
+
+    def _release_members(self, message_id: str) -> None:
+        """回答を用意できなかったコメントにまとめたコメントは、その中で最も古いものの回答を改めて用意する"""
+        if self._clusterer is not None:
+            self._clusterer.remove(message_id)
+        members = self._members.get(message_id) or []
+        self._members.delete(message_id)
+        others = [member for member in members if member.message_id != message_id]
+        if not others:
+            return
+        head = others[0]
+        self._members.set(head.message_id, others)
+        self._representatives.delete(head.message_id)
+        for member in others[1:]:
+            self._representatives.set(member.message_id, head.message_id)
+        self._clustered -= 1
+        self._start_prefetch(head.message_id, head.text, head.author)
+
+    def _attribute(self, message_id: str, reply: PrefetchedReply) -> PrefetchedReply:
+        # 回答を用意した後にまとめたコメントも含める
+        members = self._members.get(message_id)
+        if members is None:
+            return reply
+        return reply.model_copy(update={"message_ids": [m.message_id for m in members], "authors": [m.author for m in members]})
+
+    async def _prefetch(self, message_id: str, text: str, author: str) -> None:
+        assert self._semaphore is not None
+        async with self._semaphore:
+            try:
+                with llm_priority(LLMPriority.tts_prep):
+                    response_text, image_filename = await self._generate_reply(text)
+            except Exception:
+                LOGGER.warning("Failed to prefetch a reply for message %s.", message_id, exc_info=True)
+                self._failed += 1
+                self._release_members(message_id)
+                return
+
+            audio = None
+            try:
+                audio = await self._synthesize(response_text)
+            except Exception:
+                LOGGER.warning("Failed to synthesize a prefetched reply for message %s.", message_id, exc_info=True)
+
+        reply = PrefetchedReply(
+            message_id=message_id,
+            question=text,
+            response_text=response_text,
+            image_filename=image_filename,
+            has_audio=audio is not None,
+            message_ids=[message_id],
+            authors=[author],
+        )
+        self._bundles.set(message_id, PrefetchBundle(reply=reply, audio=audio))
+        self._ready.append(message_id)
+        self._prefetched += 1
+        LOGGER.debug("Prefetched a reply for message %s.", message_id)
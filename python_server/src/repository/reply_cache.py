@@ -0,0 +1,78 @@
+import datetime
+
+import sqlalchemy.dialects.postgresql as pg
+from sqlalchemy import delete, or_, select
+from sqlalchemy.orm import Session
+
+from src.databases.models.reply_caches import ReplyCacheModel
+from src.schema.reply_cache import CachedReply
+
+
+class ReplyCacheRepository:
+    """生成した回答のキャッシュのリポジトリ"""
+
+    def __init__(self, session: Session):
+        self._session = session
+
+    def save(
+        self,
+        *,
+        namespace: str,
+        normalized_text: str,
+        index_version: str,
+        reply: str,
+        image_filename: str,
+        expires_at: datetime.datetime,
+    ) -> None:
+        """保存(同じ質問の回答があれば上書きする)"""
+        stmt = pg.Insert(ReplyCacheModel).values(
+            namespace=namespace,
+            normalized_text=normalized_text,
+            index_version=index_version,
+            reply=reply,
+            image_filename=image_filename,
+            expires_at=expires_at,
+        )
+        stmt = stmt.on_conflict_do_update(
+            constraint="unique_namespace_normalized_text",
+            set_={
+                "index_version": stmt.excluded.index_version,
+                "reply": stmt.excluded.reply,
+                "image_filename": stmt.excluded.image_filename,
+                "expires_at": stmt.excluded.expires_at,
+            },
+        )
+        self._session.execute(stmt)
+
+    def find_one(
+        self,
+        *,
+        namespace: str,
+        normalized_text: str,
+        index_version: str,
+        now: datetime.datetime,
+    ) -> CachedReply | None:
+        """有効な回答を 1 件取得(インデックスのバージョンが異なるもの・期限切れのものは除く)"""
+        stmt = select(ReplyCacheModel).where(
+            ReplyCacheModel.namespace == namespace,
+            ReplyCacheModel.normalized_text == normalized_text,
+            ReplyCacheModel.index_version == index_version,
+            now < ReplyCacheModel.expires_at,
+        )
+
+        result = self._session.execute(stmt).scalars().first()
+
+        if not result:
+            return None
+
+        return CachedReply(query=result.normalized_text, reply=result.reply, image_filename=result.image_filename, similarity=1.0)
+
+    def delete_stale(
+        self,
+        *,
+        index_version: str,
+        now: datetime.datetime,
+    ) -> int:
+        """期限切れのものと、インデックスのバージョンが異なるものを削除する"""
+        stmt = delete(ReplyCacheModel).where(or_(ReplyCacheModel.expires_at <= now, ReplyCacheModel.index_version != index_version))
+        return self._session.execute(stmt).rowcount
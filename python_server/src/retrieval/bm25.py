@@ -0,0 +1,233 @@
+import json
+import logging
+import pathlib
+import threading
+from collections import Counter
+from collections.abc import Callable
+from typing import NamedTuple
+
+import numpy as np
+from langchain.schema.document import Document
+
+from src.retrieval.tokenizer import JapaneseTokenizer
+
+LOGGER = logging.getLogger(__name__)
+
+BM25_INDEX_FILENAME = "bm25_index.json"
+
+
+class BM25IndexVersionMismatchError(Exception):
+    """保存済みの BM25 のインデックスが現在の分かち書きと異なる方法で作られている"""
+
+
+class BM25Index:
+    """疎な単語文書行列を使った BM25 (Okapi) の検索エンジン
+
+    単語ごとに「その単語を含む文書の id」と「BM25 の重み」を CSR 形式で持ち、
+    クエリのスコアは該当する行をまとめて np.bincount で足し合わせて求める。
+    作成後は変更しないので、複数のスレッドから同時に検索してよい。
+    スコアは rank_bm25.BM25Okapi と同じになる。
+    """
+
+    def __init__(self, *, vocabulary: dict[str, int], indptr: np.ndarray, doc_ids: np.ndarray, weights: np.ndarray, n_docs: int):
+        self._vocabulary = vocabulary
+        self._indptr = indptr
+        self._doc_ids = doc_ids
+        self._weights = weights
+        self._n_docs = n_docs
+
+    @classmethod
+    def from_tokens(cls, corpus_tokens: list[list[str]], *, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25) -> "BM25Index":
+        """分かち書き済みの文書からインデックスを作る"""
+        n_docs = len(corpus_tokens)
+        vocabulary: dict[str, int] = {}
+        term_ids: list[int] = []
+        posting_doc_ids: list[int] = []
+        term_freqs: list[int] = []
+        for doc_id, tokens in enumerate(corpus_tokens):
+            for term, freq in Counter(tokens).items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                posting_doc_ids.append(doc_id)
+                term_freqs.append(freq)
+
+        term_ids_arr = np.asarray(term_ids, dtype=np.int64)
+        doc_ids_arr = np.asarray(posting_doc_ids, dtype=np.int64)
+        tf = np.asarray(term_freqs, dtype=np.float64)
+        doc_len = np.asarray([len(tokens) for tokens in corpus_tokens], dtype=np.float64)
+        avgdl = doc_len.mean() if n_docs else 0.0
+
+        # idf は単語を含む文書数から求める。負になるものは平均 idf の epsilon 倍にする(BM25Okapi と同じ)
+        doc_freq = np.bincount(term_ids_arr, minlength=len(vocabulary)).astype(np.float64)
+        idf = np.log(n_docs - doc_freq + 0.5) - np.log(doc_freq + 0.5)
+        if len(idf):
+            idf[idf < 0] = epsilon * idf.mean()
+
+        norm = k1 * (1 - b + b * doc_len[doc_ids_arr] / avgdl) if avgdl else np.full(len(tf), k1)
+        weights = idf[term_ids_arr] * tf * (k1 + 1) / (tf + norm)
+
+        # 単語 id 順に並べて CSR 形式にする
+        order = np.argsort(term_ids_arr, kind="stable")
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids_arr, minlength=len(vocabulary)), out=indptr[1:])
+        return cls(vocabulary=vocabulary, indptr=indptr, doc_ids=doc_ids_arr[order], weights=weights[order], n_docs=n_docs)
+
+    @property
+    def n_docs(self) -> int:
+        """文書数"""
+        return self._n_docs
+
+    def scores(self, query_tokens: list[str]) -> np.ndarray:
+        """全文書に対するクエリのスコア"""
+        # 同じ単語がクエリに複数回含まれる場合はその回数分足す(BM25Okapi と同じ)
+        term_ids = [self._vocabulary[token] for token in query_tokens if token in self._vocabulary]
+        if not term_ids:
+            return np.zeros(self._n_docs)
+        postings = [slice(self._indptr[term_id], self._indptr[term_id + 1]) for term_id in term_ids]
+        doc_ids = np.concatenate([self._doc_ids[s] for s in postings])
+        weights = np.concatenate([self._weights[s] for s in postings])
+        return np.bincount(doc_ids, weights=weights, minlength=self._n_docs)
+
+    def scores_batch(self, queries_tokens: list[list[str]]) -> np.ndarray:
+        """複数のクエリのスコアをまとめて求める(クエリ数 x 文書数)
+
+        全クエリの該当する行を連結し、クエリごとに文書の id をずらして一度の np.bincount で足し合わせる
+        """
+        doc_ids: list[np.ndarray] = []
+        weights: list[np.ndarray] = []
+        for query_id, query_tokens in enumerate(queries_tokens):
+            for token in query_tokens:
+                term_id = self._vocabulary.get(token)
+                if term_id is None:
+                    continue
+                posting = slice(self._indptr[term_id], self._indptr[term_id + 1])
+                doc_ids.append(self._doc_ids[posting] + query_id * self._n_docs)
+                weights.append(self._weights[posting])
+        n_cells = len(queries_tokens) * self._n_docs
+        if not doc_ids:
+            return np.zeros(n_cells).reshape(len(queries_tokens), self._n_docs)
+        scores = np.bincount(np.concatenate(doc_ids), weights=np.concatenate(weights), minlength=n_cells)
+        return scores.reshape(len(queries_tokens), self._n_docs)
+
+    def search(self, query_tokens: list[str], top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        """スコアの高い順に最大 top_k 件の文書の id とスコアを返す"""
+        return top_k_scores(self.scores(query_tokens), top_k)
+
+    def search_batch(self, queries_tokens: list[list[str]], top_k: int) -> list[tuple[np.ndarray, np.ndarray]]:
+        """複数のクエリについて、それぞれスコアの高い順に最大 top_k 件の文書の id とスコアを返す"""
+        return [top_k_scores(scores, top_k) for scores in self.scores_batch(queries_tokens)]
+
+
+def top_k_scores(scores: np.ndarray, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+    """スコアの高い順に最大 top_k 件の id とスコアを返す
+
+    全体をソートせず、partition で上位を取り出してからその中だけをソートする。同点の場合は id の小さい順
+    """
+    top_k = min(top_k, len(scores))
+    if top_k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    # 境界で同点の場合も id の小さいものが残るよう、k 番目のスコアより大きいものと同点のものを分けて取り出す
+    kth_score = np.partition(scores, len(scores) - top_k)[len(scores) - top_k]
+    higher = np.flatnonzero(scores > kth_score)
+    ties = np.flatnonzero(scores == kth_score)[: top_k - len(higher)]
+    candidates = np.concatenate([higher, ties])
+    order = np.lexsort((candidates, -scores[candidates]))
+    ids = candidates[order]
+    return ids, scores[ids]
+
+
+class BM25Corpus(NamedTuple):
+    """BM25 のインデックスと、その id に対応する文書"""
+
+    index: BM25Index
+    documents: list[Document]
+
+
+def save_bm25_index(documents: list[Document], tokenizer: JapaneseTokenizer, path: pathlib.Path) -> pathlib.Path:
+    """ドキュメントを分かち書きした結果を BM25 のインデックスとして保存する
+
+    サーバー側で形態素解析をやり直さずに済むよう、分かち書き済みのトークンを保存しておく
+    """
+    path.mkdir(parents=True, exist_ok=True)
+    index_path = path / BM25_INDEX_FILENAME
+    artifact = {
+        "tokenizer_version": tokenizer.VERSION,
+        "documents": [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in documents],
+        "tokens": tokenizer.tokenize_batch(doc.page_content for doc in documents),
+    }
+    # 書き込み途中のファイルを読まれないよう、一時ファイルに書いてから置き換える
+    tmp_path = index_path.with_suffix(".tmp")
+    with tmp_path.open("w", encoding="utf8") as f:
+        json.dump(artifact, f, ensure_ascii=False)
+    tmp_path.replace(index_path)
+    LOGGER.info("Saved the BM25 index: %s (%d documents)", index_path, len(documents))
+    return index_path
+
+
+def load_bm25_corpus(path: pathlib.Path, tokenizer: JapaneseTokenizer) -> BM25Corpus:
+    """保存済みの BM25 のインデックスを読み込む"""
+    with (path / BM25_INDEX_FILENAME).open(encoding="utf8") as f:
+        artifact = json.load(f)
+    if artifact.get("tokenizer_version") != tokenizer.VERSION:
+        raise BM25IndexVersionMismatchError(f"tokenizer version of the index is {artifact.get('tokenizer_version')}, expected {tokenizer.VERSION}")
+    documents = [Document(page_content=doc["page_content"], metadata=doc["metadata"]) for doc in artifact["documents"]]
+    return BM25Corpus(index=BM25Index.from_tokens(artifact["tokens"]), documents=documents)
+
+
+def build_bm25_corpus(documents: list[Document], tokenizer: JapaneseTokenizer) -> BM25Corpus:
+    """ドキュメントから BM25 のインデックスを作る"""
+    tokens = tokenizer.tokenize_batch(doc.page_content for doc in documents)
+    return BM25Corpus(index=BM25Index.from_tokens(tokens), documents=documents)
+
+
+class _LoadedCorpus(NamedTuple):
+    corpus: BM25Corpus
+    key: tuple
+
+
+class BM25CorpusRegistry:
+    """保存済みの BM25 のインデックスをプロセス内に常駐させるレジストリ
+
+    get に渡したバージョン(同じ文書から作った FAISS のインデックスのバージョン)か、保存済みのファイルが変わった場合は読み込み直す。
+    ベクトル検索と BM25 で異なる文書を検索しないよう、FAISS のインデックスと合わせて読み込み直すために使う。
+    保存済みのインデックスが無い・分かち書きの方法が異なる場合は、build_documents の文書からその場で作る
+    """
+
+    def __init__(self, *, path: pathlib.Path, tokenizer: JapaneseTokenizer, build_documents: Callable[[], list[Document]]):
+        self._path = path
+        self._tokenizer = tokenizer
+        self._build_documents = build_documents
+        self._loaded: _LoadedCorpus | None = None
+        self._lock = threading.Lock()
+
+    def get(self, version: str) -> BM25Corpus:
+        """インデックスを取得する"""
+        key = (version, self._signature())
+        loaded = self._loaded
+        if loaded is not None and loaded.key == key:
+            return loaded.corpus
+        with self._lock:
+            # 他のスレッドが先に読み込んでいれば、それを使う
+            loaded = self._loaded
+            if loaded is not None and loaded.key == key:
+                return loaded.corpus
+            corpus = self._load()
+            self._loaded = _LoadedCorpus(corpus=corpus, key=key)
+            return corpus
+
+    def _load(self) -> BM25Corpus:
+        try:
+            corpus = load_bm25_corpus(self._path, self._tokenizer)
+            LOGGER.info("Loaded the BM25 index: %s (%d documents)", self._path, len(corpus.documents))
+            return corpus
+        except FileNotFoundError:
+            LOGGER.warning("BM25 index is not found in %s, build it from the CSV instead.", self._path)
+        except BM25IndexVersionMismatchError as e:
+            LOGGER.warning("BM25 index in %s is outdated (%s), build it from the CSV instead.", self._path, e)
+        return build_bm25_corpus(self._build_documents(), self._tokenizer)
+
+    def _signature(self) -> tuple[int, int] | None:
+        try:
+            stat = (self._path / BM25_INDEX_FILENAME).stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
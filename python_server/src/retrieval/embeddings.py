@@ -0,0 +1,77 @@
+from langchain_core.embeddings import Embeddings
+
+from src.normalize import normalize_text
+from src.ttl_cache import CacheStats, TTLCache
+
+EMBEDDING_MODEL_NAME = "models/text-embedding-004"
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """クエリの埋め込みをキャッシュする Embeddings
+
+    キーは正規化したクエリとモデル名。ドキュメントの埋め込みはキャッシュせずにそのまま委譲する。
+    query_task_type を指定した場合、複数のクエリは embed_documents でまとめて埋め込む
+    (GoogleGenerativeAIEmbeddings の embed_query は task_type="RETRIEVAL_QUERY" の embed_documents と同じ)。
+    """
+
+    def __init__(self, *, embeddings: Embeddings, model_name: str, max_size: int, ttl_sec: float, query_task_type: str | None = None):
+        self._embeddings = embeddings
+        self._model_name = model_name
+        self._query_task_type = query_task_type
+        self._cache: TTLCache[list[float]] = TTLCache(max_size=max_size, ttl_sec=ttl_sec)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """ドキュメントを埋め込む"""
+        return self._embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        """クエリを埋め込む(キャッシュがあればそれを返す)"""
+        key = self._cache_key(text)
+        vector = self._cache.get(key)
+        if vector is None:
+            vector = self._embeddings.embed_query(text)
+            self._cache.set(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        """クエリを埋め込む(キャッシュがあればそれを返す)"""
+        key = self._cache_key(text)
+        vector = self._cache.get(key)
+        if vector is None:
+            vector = await self._embeddings.aembed_query(text)
+            self._cache.set(key, vector)
+        return vector
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """複数のクエリを埋め込む
+
+        キャッシュにないものだけを(重複を除いて)一度のリクエストでまとめて埋め込む
+        """
+        keys = [self._cache_key(text) for text in texts]
+        vectors: dict[tuple[str, str], list[float]] = {}
+        missing: dict[tuple[str, str], str] = {}
+        for key, text in zip(keys, texts, strict=True):
+            if key in vectors or key in missing:
+                continue
+            vector = self._cache.get(key)
+            if vector is None:
+                missing[key] = text
+            else:
+                vectors[key] = vector
+        if missing:
+            if self._query_task_type is None:
+                embedded = [self._embeddings.embed_query(text) for text in missing.values()]
+            else:
+                embedded = self._embeddings.embed_documents(list(missing.values()), task_type=self._query_task_type)  # type: ignore[call-arg]
+            for key, vector in zip(missing, embedded, strict=True):
+                self._cache.set(key, vector)
+                vectors[key] = vector
+        return [vectors[key] for key in keys]
+
+    @property
+    def stats(self) -> CacheStats:
+        """キャッシュの統計情報"""
+        return self._cache.stats
+
+    def _cache_key(self, text: str) -> tuple[str, str]:
+        return (self._model_name, normalize_text(text))
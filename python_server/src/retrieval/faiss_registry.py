@@ -0,0 +1,116 @@
+import hashlib
+import json
+import logging
+import pathlib
+import threading
+import time
+from typing import NamedTuple
+
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+
+LOGGER = logging.getLogger(__name__)
+
+# FAISS.save_local が書き出すファイル
+_INDEX_FILENAMES = ("index.faiss", "index.pkl")
+
+
+class _LoadedIndex(NamedTuple):
+    store: FAISS
+    signature: tuple[int, ...]
+    checked_at: float
+    version: str
+
+
+class FaissIndexRegistry:
+    """FAISS のインデックスをプロセス内に常駐させるレジストリ
+
+    初回アクセス時にディスクから読み込み、以降はメモリ上のインデックスを返す。
+    ディスク上のファイルが更新された場合は読み込み直した上で差し替える。
+    読み込みに失敗した場合は、それまでのインデックスを使い続ける。
+    """
+
+    def __init__(self, *, embeddings: Embeddings, check_interval_sec: float = 5.0):
+        self._embeddings = embeddings
+        self._check_interval_sec = check_interval_sec
+        self._paths: dict[str, pathlib.Path] = {}
+        self._loaded: dict[str, _LoadedIndex] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, path: pathlib.Path) -> None:
+        """インデックスを名前付きで登録する(読み込みは初回アクセス時)"""
+        self._paths[name] = path
+
+    @property
+    def names(self) -> list[str]:
+        """登録済みのインデックス名"""
+        return list(self._paths)
+
+    def get(self, name: str) -> FAISS:
+        """インデックスを取得する"""
+        loaded = self._loaded.get(name)
+        now = time.monotonic()
+        if loaded and now - loaded.checked_at < self._check_interval_sec:
+            return loaded.store
+
+        path = self._paths[name]
+        signature = self._signature(path)
+        if loaded and (signature == loaded.signature or signature is None):
+            if signature is None:
+                LOGGER.warning("FAISS index files are missing, keep using the loaded one: %s", path)
+            self._loaded[name] = loaded._replace(checked_at=now)
+            return loaded.store
+
+        with self._lock:
+            # 他のスレッドが先に読み込んでいれば、それを使う
+            current = self._loaded.get(name)
+            if current and current is not loaded and current.signature == signature:
+                return current.store
+            try:
+                store = FAISS.load_local(path, self._embeddings, allow_dangerous_deserialization=True)
+            except Exception:
+                if not loaded:
+                    raise
+                LOGGER.exception("Failed to reload the FAISS index, keep using the loaded one: %s", path)
+                self._loaded[name] = loaded._replace(checked_at=now)
+                return loaded.store
+            LOGGER.info("Loaded the FAISS index: name=%s, path=%s", name, path)
+            self._loaded[name] = _LoadedIndex(store=store, signature=signature or (), checked_at=now, version=content_version(store))
+            return store
+
+    def version(self, name: str) -> str:
+        """インデックスのバージョン(インデックスの内容から決まる。content_version を参照)"""
+        self.get(name)
+        return self._loaded[name].version
+
+    def warm_up(self) -> None:
+        """登録済みのインデックスを全て読み込んでおく"""
+        for name in self._paths:
+            try:
+                self.get(name)
+            except Exception:
+                LOGGER.exception("Failed to load the FAISS index: %s", name)
+
+    def _signature(self, path: pathlib.Path) -> tuple[int, ...] | None:
+        signature: list[int] = []
+        for filename in _INDEX_FILENAMES:
+            try:
+                stat = (path / filename).stat()
+            except FileNotFoundError:
+                return None
+            signature.extend([stat.st_mtime_ns, stat.st_size])
+        return tuple(signature)
+
+
+def content_version(store: FAISS) -> str:
+    """インデックスの内容から決まるバージョン
+
+    ファイルの更新時刻や、作るたびに変わる文書の id (uuid) は含めず、ベクトルの次元と文書(内容とメタデータ)を並び順どおりにハッシュする。
+    同じ CSV からインデックスを作り直しても(デプロイのたびにイメージをビルドしても)バージョンは変わらない。
+    ベクトルは同じ埋め込みモデルであれば文書から決まるので含めない
+    """
+    digest = hashlib.sha256(f"{store.index.d}:{store.index.ntotal}".encode())
+    for i in range(store.index.ntotal):
+        doc = store.docstore.search(store.index_to_docstore_id[i])
+        digest.update(json.dumps([doc.page_content, doc.metadata], ensure_ascii=False, sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:16]
@@ -0,0 +1,116 @@
+import contextvars
+from collections.abc import Callable
+from concurrent.futures import Executor
+from enum import Enum
+
+import numpy as np
+
+from src.schema.retrieval import ScoredDocument
+
+
+class FusionMethod(str, Enum):
+    """ハイブリッド検索のスコア統合方法"""
+
+    # Reciprocal Rank Fusion: 順位のみを使う
+    rrf = "rrf"
+    # 検索結果ごとにスコアを 0~1 に正規化して重み付きで足し合わせる
+    weighted = "weighted"
+
+
+def fuse_results(
+    result_lists: dict[str, list[ScoredDocument]],
+    *,
+    weights: dict[str, float],
+    method: FusionMethod = FusionMethod.rrf,
+    rrf_c: int = 60,
+) -> list[ScoredDocument]:
+    """複数の検索結果を統合し、統合後のスコアの高い順に返す
+
+    ドキュメントは page_content で同一視する。統合前のスコアは source_scores に検索結果の名前で残す。
+    同点の場合は result_lists に先に現れたものを優先する(langchain の EnsembleRetriever と同じ)。
+    """
+    index_of: dict[str, int] = {}
+    unique_docs: list[ScoredDocument] = []
+    source_scores: list[dict[str, float]] = []
+    for name, results in result_lists.items():
+        for doc in results:
+            if doc.page_content not in index_of:
+                index_of[doc.page_content] = len(unique_docs)
+                unique_docs.append(doc)
+                source_scores.append({})
+            source_scores[index_of[doc.page_content]][name] = doc.score
+
+    fused = np.zeros(len(unique_docs))
+    for name, results in result_lists.items():
+        if not results:
+            continue
+        idx = np.fromiter((index_of[doc.page_content] for doc in results), dtype=np.int64, count=len(results))
+        if method == FusionMethod.rrf:
+            contrib = 1.0 / (np.arange(1, len(results) + 1) + rrf_c)
+        else:
+            contrib = _min_max_normalize(np.fromiter((doc.score for doc in results), dtype=np.float64, count=len(results)))
+        # 同じ検索結果の中で page_content が重複している場合も足し合わせる
+        np.add.at(fused, idx, weights[name] * contrib)
+
+    order = np.lexsort((np.arange(len(unique_docs)), -fused))
+    return [ScoredDocument(page_content=unique_docs[i].page_content, metadata=unique_docs[i].metadata, score=float(fused[i]), source_scores=source_scores[i]) for i in order]
+
+
+def _min_max_normalize(scores: np.ndarray) -> np.ndarray:
+    low, high = scores.min(), scores.max()
+    if high == low:
+        return np.ones_like(scores)
+    return (scores - low) / (high - low)
+
+
+class HybridRetriever:
+    """キーワード検索(BM25)とベクトル検索を並行して実行し、スコアを統合するハイブリッド検索"""
+
+    KEYWORD = "bm25"
+    VECTOR = "vector"
+
+    def __init__(
+        self,
+        *,
+        keyword_search: Callable[[str, int], list[ScoredDocument]],
+        vector_search: Callable[[list[float], int], list[ScoredDocument]],
+        embed_query: Callable[[str], list[float]],
+        executor: Executor,
+        keyword_weight: float = 0.5,
+        vector_weight: float = 0.5,
+        method: FusionMethod = FusionMethod.rrf,
+        rrf_c: int = 60,
+    ):
+        self._keyword_search = keyword_search
+        self._vector_search = vector_search
+        self._embed_query = embed_query
+        self._executor = executor
+        self._weights = {self.KEYWORD: keyword_weight, self.VECTOR: vector_weight}
+        self._method = method
+        self._rrf_c = rrf_c
+
+    def search(self, query: str, top_k: int, vector: list[float] | None = None) -> list[ScoredDocument]:
+        """統合後のスコアの高い順に最大 top_k 件を返す
+
+        vector を渡した場合は、クエリを埋め込み直さずにそのベクトルでベクトル検索を行う
+        """
+        # クエリの埋め込み(ネットワーク)とベクトル検索は別スレッドで行い、その間に BM25 のスコアを計算する
+        # 呼び出し元のコンテキスト(API 呼び出しの優先度など)を引き継ぐ
+        vector_future = self._executor.submit(contextvars.copy_context().run, self._search_by_vector, query, top_k, vector)
+        keyword_results = self._keyword_search(query, top_k)
+        vector_results = vector_future.result()
+        return self.fuse(keyword_results, vector_results)[:top_k]
+
+    def fuse(self, keyword_results: list[ScoredDocument], vector_results: list[ScoredDocument]) -> list[ScoredDocument]:
+        """キーワード検索とベクトル検索の結果を統合する(検索を別途まとめて行った場合に使う)"""
+        return fuse_results(
+            {self.KEYWORD: keyword_results, self.VECTOR: vector_results},
+            weights=self._weights,
+            method=self._method,
+            rrf_c=self._rrf_c,
+        )
+
+    def _search_by_vector(self, query: str, top_k: int, vector: list[float] | None) -> list[ScoredDocument]:
+        if vector is None:
+            vector = self._embed_query(query)
+        return self._vector_search(vector, top_k)
@@ -0,0 +1,72 @@
+import numpy as np
+
+from src.retrieval.tokenizer import JapaneseTokenizer
+from src.schema.retrieval import ScoredDocument
+
+
+class LocalReranker:
+    """LLM を使わずに、特徴量の重み付き和でハイブリッド検索の候補を並べ替える
+
+    特徴量(いずれも 0~1)
+        * fused: ハイブリッド検索の統合スコア(候補内の最大値で割る)
+        * vector: ベクトル検索の関連度
+        * coverage: クエリの単語のうちドキュメントに含まれるものの割合
+        * title: クエリの単語のうちドキュメントのタイトルに含まれるものの割合
+    """
+
+    FEATURES = ("fused", "vector", "coverage", "title")
+
+    def __init__(
+        self,
+        *,
+        tokenizer: JapaneseTokenizer,
+        weights: dict[str, float] | None = None,
+        min_score: float = 0.0,
+    ):
+        self._tokenizer = tokenizer
+        self._weights = weights or {"fused": 0.4, "vector": 0.2, "coverage": 0.3, "title": 0.1}
+        self._min_score = min_score
+
+    def rerank(self, query: str, candidates: list[ScoredDocument], top_n: int) -> list[ScoredDocument]:
+        """スコアの高い順に最大 top_n 件を返す。スコアが min_score 未満のものは除く
+
+        返すドキュメントの score は並べ替えに使ったスコアで、各特徴量は source_scores に入れる
+        """
+        if not candidates:
+            return []
+        features = self._features(query, candidates)
+        weights = np.array([self._weights.get(name, 0.0) for name in self.FEATURES])
+        scores = features @ weights
+        order = np.lexsort((np.arange(len(candidates)), -scores))
+        reranked = []
+        for i in order[:top_n]:
+            if scores[i] < self._min_score:
+                break
+            doc = candidates[i]
+            source_scores = {**doc.source_scores, **{name: float(value) for name, value in zip(self.FEATURES, features[i], strict=True)}}
+            reranked.append(ScoredDocument(page_content=doc.page_content, metadata=doc.metadata, score=float(scores[i]), source_scores=source_scores))
+        return reranked
+
+    def _features(self, query: str, candidates: list[ScoredDocument]) -> np.ndarray:
+        fused = np.array([doc.score for doc in candidates])
+        max_fused = fused.max()
+        fused = fused / max_fused if max_fused > 0 else np.zeros_like(fused)
+        vector = np.clip([doc.source_scores.get("vector", 0.0) for doc in candidates], 0.0, 1.0)
+
+        query_tokens = set(self._tokenizer.tokenize_query(query))
+        coverage = np.zeros(len(candidates))
+        title = np.zeros(len(candidates))
+        if query_tokens:
+            for i, doc in enumerate(candidates):
+                # 同じドキュメントが繰り返し候補になるので、キャッシュ付きの分かち書きを使う
+                doc_tokens = set(self._tokenizer.tokenize_query(doc.page_content))
+                title_tokens = set(self._tokenizer.tokenize_query(_title_of(doc.page_content)))
+                coverage[i] = len(query_tokens & doc_tokens) / len(query_tokens)
+                title[i] = len(query_tokens & title_tokens) / len(query_tokens)
+        return np.column_stack([fused, vector, coverage, title])
+
+
+def _title_of(page_content: str) -> str:
+    """ナレッジのチャンクのタイトル(「Title: 」で始まる1行目)を返す"""
+    first_line = page_content.split("\n", 1)[0]
+    return first_line.removeprefix("Title: ") if first_line.startswith("Title: ") else ""
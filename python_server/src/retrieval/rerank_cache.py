@@ -0,0 +1,47 @@
+import hashlib
+from collections.abc import Hashable, Iterable
+
+from src.normalize import normalize_text
+from src.ttl_cache import CacheStats, TTLCache
+
+
+def chunk_id(page_content: str) -> str:
+    """ドキュメントのチャンクを識別する id(本文のハッシュ)"""
+    return hashlib.sha256(page_content.encode("utf8")).hexdigest()
+
+
+class RerankDecisionCache:
+    """LLM によるリランクの結果(選ばれた候補の番号)をキャッシュする
+
+    LLM の判断はクエリと候補の並びだけで決まるので、正規化したクエリ、候補のチャンクの id の並び、
+    インデックスのバージョンをキーにする。インデックスが更新された場合は別のキーになる。
+    """
+
+    def __init__(self, *, max_size: int, ttl_sec: float):
+        self._cache: TTLCache[tuple[int, ...]] = TTLCache(max_size=max_size, ttl_sec=ttl_sec)
+
+    @staticmethod
+    def key(kind: str, query: str, candidates: Iterable[str], index_version: str) -> Hashable:
+        """キャッシュのキー
+
+        kind: リランクの種類(プロンプトや選ぶ件数が違うものを区別する)
+        candidates: 候補の本文(LLM に渡した順)
+        """
+        return (kind, normalize_text(query), tuple(chunk_id(content) for content in candidates), index_version)
+
+    def get(self, key: Hashable) -> tuple[int, ...] | None:
+        """キャッシュしたリランクの結果(LLM が選んだ候補の番号)を返す。存在しない場合は None"""
+        return self._cache.get(key)
+
+    def set(self, key: Hashable, decision: Iterable[int]) -> None:
+        """リランクの結果を保存する"""
+        self._cache.set(key, tuple(decision))
+
+    def clear(self) -> None:
+        """全て削除する"""
+        self._cache.clear()
+
+    @property
+    def stats(self) -> CacheStats:
+        """キャッシュの統計情報"""
+        return self._cache.stats
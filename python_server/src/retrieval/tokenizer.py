@@ -0,0 +1,92 @@
+import functools
+import pathlib
+import threading
+from collections.abc import Iterable
+
+import MeCab
+
+
+class JapaneseTokenizer:
+    """BM25 などで使う日本語の分かち書き
+
+    名詞・動詞・形状詞のうち ASCII のみでないものを取り出し、ストップワードを除く。
+    MeCab の Tagger は生成コストが高いのでスレッドごとに使い回す。
+    """
+
+    # 分かち書きの結果が変わる修正をした場合は上げる(保存済みのインデックスの作り直しが必要になる)
+    VERSION = "2"
+
+    TARGET_POS = frozenset({"名詞", "動詞", "形状詞"})
+
+    def __init__(self, *, stopwords: Iterable[str], query_cache_size: int = 4096):
+        self._stopwords = frozenset(stopwords)
+        self._local = threading.local()
+        self._tokenize_query_cached = functools.lru_cache(maxsize=query_cache_size)(self._tokenize_to_tuple)
+
+    @classmethod
+    def from_stopwords_file(cls, path: pathlib.Path, **kwargs) -> "JapaneseTokenizer":
+        """ストップワードのファイル(1行1単語)から作る"""
+        with open(path) as f:
+            stopwords = [line.strip() for line in f]
+        return cls(stopwords=[word for word in stopwords if word], **kwargs)
+
+    @property
+    def stopwords(self) -> frozenset[str]:
+        """ストップワード"""
+        return self._stopwords
+
+    def extract_content_words(self, text: str) -> list[str]:
+        """名詞動詞形状詞のみ抜く"""
+        words = []
+        node = self._tagger().parseToNode(text)
+        while node:
+            surface = node.surface
+            if surface and not surface.isascii() and node.feature.split(",", 1)[0] in self.TARGET_POS:
+                words.append(surface)
+            node = node.next
+        return words
+
+    def extract_proper_nouns(self, text: str) -> list[str]:
+        """固有名詞(人名・地名・組織名など)と、英字の名詞を抜く"""
+        words = []
+        node = self._tagger().parseToNode(text)
+        while node:
+            surface = node.surface
+            pos = node.feature.split(",", 2)
+            if surface and pos[0] == "名詞" and (pos[1:2] == ["固有名詞"] or (surface.isascii() and surface.isalpha() and len(surface) > 1)):
+                words.append(surface)
+            node = node.next
+        return words
+
+    def extract_nouns(self, text: str) -> list[str]:
+        """名詞(英字・数字を含む)のみ抜き、ストップワードを除く(質問の話題の比較用)"""
+        words = []
+        node = self._tagger().parseToNode(text)
+        while node:
+            surface = node.surface
+            if surface and node.feature.split(",", 1)[0] == "名詞" and surface not in self._stopwords:
+                words.append(surface)
+            node = node.next
+        return words
+
+    def tokenize(self, text: str) -> list[str]:
+        """ストップワードを除いて分かち書きする"""
+        return [word for word in self.extract_content_words(text) if word not in self._stopwords]
+
+    def tokenize_batch(self, texts: Iterable[str]) -> list[list[str]]:
+        """複数のテキストをまとめて分かち書きする(インデックス作成用)"""
+        return [self.tokenize(text) for text in texts]
+
+    def tokenize_query(self, text: str) -> list[str]:
+        """クエリを分かち書きする(結果は query_cache_size 件までキャッシュする)"""
+        return list(self._tokenize_query_cached(text))
+
+    def _tokenize_to_tuple(self, text: str) -> tuple[str, ...]:
+        return tuple(self.tokenize(text))
+
+    def _tagger(self) -> MeCab.Tagger:
+        tagger = getattr(self._local, "tagger", None)
+        if tagger is None:
+            tagger = MeCab.Tagger()
+            self._local.tagger = tagger
+        return tagger
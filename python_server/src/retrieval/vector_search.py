@@ -0,0 +1,32 @@
+import faiss
+import numpy as np
+from langchain.schema.document import Document
+from langchain_community.vectorstores import FAISS
+
+
+def similarity_search_with_score_by_vectors(store: FAISS, vectors: list[list[float]], *, k: int) -> list[list[tuple[Document, float]]]:
+    """複数のベクトルで FAISS のインデックスを一度に検索する
+
+    FAISS.similarity_search_with_score_by_vector をベクトルの数だけ呼ぶのと同じ結果を、
+    行列にまとめた一回の index.search で求める。スコアは距離(小さいほど類似度が高い)
+    """
+    if not vectors:
+        return []
+    matrix = np.asarray(vectors, dtype=np.float32)
+    if store._normalize_L2:
+        faiss.normalize_L2(matrix)
+    scores, indices = store.index.search(matrix, k)
+    results = []
+    for row_scores, row_indices in zip(scores, indices, strict=True):
+        docs = []
+        for score, i in zip(row_scores, row_indices, strict=True):
+            if i == -1:
+                # 文書数が k より少ない場合
+                continue
+            _id = store.index_to_docstore_id[i]
+            doc = store.docstore.search(_id)
+            if not isinstance(doc, Document):
+                raise ValueError(f"Could not find document for id {_id}, got {doc}")
+            docs.append((doc, float(score)))
+        results.append(docs)
+    return results
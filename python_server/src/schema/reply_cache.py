@@ -0,0 +1,12 @@
+from pydantic import BaseModel
+
+
+class CachedReply(BaseModel):
+    """キャッシュした回答"""
+
+    # 回答を生成したときの質問
+    query: str
+    reply: str
+    image_filename: str
+    # 質問との類似度(コサイン類似度。完全一致の場合は 1.0)
+    similarity: float
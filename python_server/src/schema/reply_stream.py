@@ -0,0 +1,42 @@
+from enum import Enum
+from typing import ClassVar
+
+from pydantic import BaseModel
+
+
+class HallucinationStatus(str, Enum):
+    """ハルシネーション判定の結果"""
+
+    # 判定して問題なかった
+    passed = "passed"
+    # ハルシネーションと判定され、回答をデフォルトのものに差し替えた
+    detected = "detected"
+    # 判定しなかった(check_hal=False、NG ワード、キャッシュした回答など)
+    not_checked = "not_checked"
+
+
+class ReplyDeltaEvent(BaseModel):
+    """POST /reply/stream で逐次送る回答の断片"""
+
+    EVENT: ClassVar[str] = "delta"
+
+    text: str
+
+
+class ReplyDoneEvent(BaseModel):
+    """POST /reply/stream の最後に送るイベント
+
+    response_text が確定した回答。ハルシネーションと判定された場合などは、それまでに送った断片とは異なる
+    """
+
+    EVENT: ClassVar[str] = "done"
+
+    response_text: str
+    image_filename: str
+    hallucination: HallucinationStatus
+    # 回答の出どころ(generated: 生成した, cache: キャッシュ, ng: NG ワード)
+    source: str
+    # 各処理にかかった時間(秒)
+    timings: dict[str, float]
+    # 予算に応じて行ったフォールバック(リランクの打ち切りなど)
+    fallbacks: list[str] = []
@@ -0,0 +1,23 @@
+from typing import Any
+
+from pydantic import BaseModel
+
+
+class ScoredDocument(BaseModel):
+    """検索でヒットしたドキュメントとそのスコア"""
+
+    page_content: str
+    metadata: dict[str, Any]
+    # 関連度(大きいほど関連が高い)
+    score: float
+    # 複数の検索結果を統合した場合の、統合前の検索結果ごとのスコア
+    source_scores: dict[str, float] = {}
+
+
+class IndexSearchResult(BaseModel):
+    """一度の埋め込みで複数のインデックスを検索した結果"""
+
+    # 検索に使ったクエリのベクトル。後段の検索で使い回せる
+    vector: list[float]
+    # インデックス名ごとの検索結果
+    results: dict[str, list[ScoredDocument]]
@@ -0,0 +1,63 @@
+import asyncio
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Generic, TypeVar
+
+from pydantic import BaseModel, computed_field
+
+T = TypeVar("T")
+
+
+class SingleFlightStats(BaseModel):
+    """SingleFlight の統計情報"""
+
+    # 実際に実行した数
+    executed: int
+    # 実行中の同じ処理の結果を待った(実行せずに済んだ)数
+    coalesced: int
+    # 実行中の処理の数
+    in_flight: int
+
+    @computed_field  # type: ignore[prop-decorator]
+    @property
+    def coalesced_rate(self) -> float:
+        """実行せずに済んだ割合"""
+        total = self.executed + self.coalesced
+        return self.coalesced / total if total else 0.0
+
+
+class SingleFlight(Generic[T]):
+    """同じキーの処理が実行中であれば、新たに実行せずにその結果を待つ
+
+    結果はキャッシュしない(処理が終わった後に呼ばれた場合は再び実行する)。
+    待っている呼び出し元の一つがキャンセルされても、他の呼び出し元のために処理は続ける。
+    例外も全ての呼び出し元に伝える。
+    """
+
+    def __init__(self):
+        self._in_flight: dict[Hashable, asyncio.Task[T]] = {}
+        self._executed = 0
+        self._coalesced = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """key の処理が実行中であればその結果を、なければ func を実行して結果を返す"""
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self._executed += 1
+        else:
+            self._coalesced += 1
+        return await asyncio.shield(task)
+
+    @property
+    def stats(self) -> SingleFlightStats:
+        """統計情報"""
+        return SingleFlightStats(executed=self._executed, coalesced=self._coalesced, in_flight=len(self._in_flight))
+
+    def _forget(self, key: Hashable, task: asyncio.Task[T]) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            # 呼び出し元が全てキャンセルされた場合に、取り出されない例外の警告を出さないようにする
+            task.exception()
@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Generic, TypeVar
+
+from pydantic import BaseModel, computed_field
+
+V = TypeVar("V")
+
+
+class CacheStats(BaseModel):
+    """キャッシュの統計情報"""
+
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+
+    @computed_field  # type: ignore[prop-decorator]
+    @property
+    def hit_rate(self) -> float:
+        """ヒット率"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class TTLCache(Generic[V]):
+    """LRU と TTL で破棄するスレッドセーフなインメモリキャッシュ"""
+
+    def __init__(self, *, max_size: int, ttl_sec: float):
+        self._max_size = max_size
+        self._ttl_sec = ttl_sec
+        self._items: OrderedDict[Hashable, tuple[V, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def get(self, key: Hashable) -> V | None:
+        """値を取得する。存在しない・期限切れの場合は None"""
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self._misses += 1
+                return None
+            value, expires_at = item
+            if expires_at <= now:
+                del self._items[key]
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._items.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def set(self, key: Hashable, value: V) -> None:
+        """値を保存する。上限を超えた場合は最も古くに使われたものから破棄する"""
+        expires_at = time.monotonic() + self._ttl_sec
+        with self._lock:
+            self._items[key] = (value, expires_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+                self._evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        """値を削除する"""
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self) -> None:
+        """全ての値を削除する"""
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def stats(self) -> CacheStats:
+        """統計情報"""
+        with self._lock:
+            return CacheStats(
+                size=len(self._items),
+                max_size=self._max_size,
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                expirations=self._expirations,
+            )
@@ -1,25 +1,64 @@
+import asyncio
 import datetime
+import logging
 import pathlib
 import random
-from collections.abc import Iterator
+from collections.abc import AsyncIterator, Iterator
+from contextlib import asynccontextmanager
 
 import uvicorn
 from fastapi import Depends, FastAPI, Form, HTTPException, Query, Request
-from fastapi.responses import ORJSONResponse, Response
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, model_validator
 from sqlalchemy.orm import Session
 
+from src.chat_clustering import ChatClusterer, ChatClusterStats
+from src.comment_filter import CommentFilterStats
+from src.comment_prefilter import CommentPrefilterStats
 from src.config import settings
 from src.databases.engine import session_scope
-from src.get_faiss_vector import get_hybrid_knowledge, get_multiple_qa
-from src.gpt import DocumentRetrievalType, filter_inappropriate_comments, generate_hallucination_response, generate_response
+from src.get_faiss_vector import (
+    QA_INDEX_NAME,
+    aembed_queries,
+    aembed_query,
+    aget_hybrid_knowledge,
+    aretrieval_index_version,
+    asearch_hybrid_knowledge_batch,
+    asearch_index_by_vectors,
+    asearch_indexes,
+    japanese_tokenizer,
+    query_embeddings,
+    rerank_decision_cache,
+    warm_up_retrieval,
+)
+from src.gpt import (
+    DocumentRetrievalType,
+    comment_filter,
+    comment_prefilter,
+    filter_inappropriate_comments,
+    generate_hallucination_response,
+    generate_response,
+    generate_response_stream,
+    grounding_checker,
+    hallucination_single_flight,
+    persistent_reply_cache,
+    prefetch_comment_prefilter,
+    reply_single_flight,
+    semantic_reply_cache,
+)
+from src.grounding import GroundingStats
+from src.llm import llm_scheduler
+from src.llm_scheduler import LLMPriority, LLMSchedulerStats, llm_priority
 from src.logger import setup_logger
+from src.reply_prefetch import PrefetchedReply, ReplyPrefetcher, ReplyPrefetchStats
 from src.repository.chat_message import YoutubeChatMessageRepository
 from src.repository.chat_message_cursor import YoutubeChatMessageCursorRepository
 from src.schema.hallucination import HallucinationRequest, HallucinationResponse
+from src.single_flight import SingleFlightStats
 from src.templates import TEMPLATE_MESSAGES, TEMPLATE_QUESTIONS
 from src.text_to_speech import TextToSpeech
+from src.ttl_cache import CacheStats
 from src.use_cases.find_youtube_chat_messages import FindYoutubeChatMessagesUseCase
 from src.use_cases.save_youtube_chat_message import SaveYoutubeChatMessageUseCase
 from src.web.schema.response_model.youtube import YouTubeChatMessageModel, YouTubeChatMessagesResponseModel
@@ -27,11 +66,29 @@ from src.youtube import YouTubeChatMessage, youtube_client
 
 setup_logger()
 
+LOGGER = logging.getLogger(__name__)
+
 
 class FilteringRequest(BaseModel):
     """POST /filter のRequestのJSON型"""
 
     messages: list[str]
+    # messages と同じ順の投稿者(チャンネル ID など)。渡した場合は同じ投稿者からの連投を落とす
+    authors: list[str] | None = None
+
+    @model_validator(mode="after")
+    def check_authors(self) -> "FilteringRequest":
+        """authors は messages と同じ長さであること"""
+        if self.authors is not None and len(self.authors) != len(self.messages):
+            raise ValueError("authors must have the same length as messages.")
+        return self
+
+
+class GetInfoBatchRequest(BaseModel):
+    """POST /get_info/batch のリクエストのJSON型"""
+
+    queries: list[str] = Field(..., min_length=1, max_length=100, description="The query texts for which to retrieve related information.")
+    top_k: int = Field(5, description="The number of top results to retrieve for each query.")
 
 
 class YouTubeCommentPostRequest(BaseModel):
@@ -44,8 +101,25 @@ class YouTubeCommentPostRequest(BaseModel):
     live_id: str
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """サーバー起動時にインデックスを読み込み、古い回答のキャッシュを削除し、回答の事前準備を始める"""
+    await asyncio.to_thread(warm_up_retrieval)
+    if settings.PERSISTENT_REPLY_CACHE_ENABLED:
+        try:
+            deleted = await asyncio.to_thread(persistent_reply_cache.purge, version=await aretrieval_index_version())
+            LOGGER.info("Purged %d stale reply caches.", deleted)
+        except Exception:
+            LOGGER.warning("Failed to purge the reply cache.", exc_info=True)
+    if settings.REPLY_PREFETCH_ENABLED:
+        reply_prefetcher.start()
+    yield
+    await reply_prefetcher.stop()
+
+
 app = FastAPI(
     default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 app.mount("/proxy", StaticFiles(directory="./comment_proxy"), name="comment_proxy")
 
@@ -80,12 +154,69 @@ def get_session(request: Request) -> Iterator[Session]:
         yield session
 
 
+async def _filter_comments_for_prefetch(comments: list[str], authors: list[str]) -> list[str]:
+    return await filter_inappropriate_comments(comments, authors, prefilter=prefetch_comment_prefilter)
+
+
+async def _generate_prefetched_reply(text: str) -> tuple[str, str]:
+    # /reply と同じ条件で生成しておく(キャッシュを使う場合は、後で同じ質問が /reply に来たときにも使える)
+    # 取り出されずに捨てられる回答もあるため、対話ログには残さない
+    res1, res2 = await generate_response(
+        text=text,
+        log_filename_json=log_filename_json,
+        log_filename_csv=log_filename_csv,
+        doc_retrieval_type=DocumentRetrievalType.multi,
+        check_hal=True,
+        use_cache=settings.REPLY_CACHE_ENABLED,
+        skip_logging=True,
+    )
+    if isinstance(res1, bytes):
+        res1 = res1.decode("utf-8")
+    if isinstance(res2, bytes):
+        res2 = res2.decode("utf-8")
+    return res1, res2
+
+
+async def _synthesize_prefetched_reply(text: str) -> bytes:
+    # REPLY_PREFETCH_VOICE に対応する /voice のエンドポイントと同じ方法で合成する
+    text_to_speech = TextToSpeech()
+    if settings.REPLY_PREFETCH_VOICE == "v2":
+        return await text_to_speech.text_to_speech_with_azure_tts(text)
+    if settings.REPLY_PREFETCH_VOICE == "azure":
+        return await text_to_speech.azure_text_to_speech(text)
+    if settings.REPLY_PREFETCH_VOICE == "male":
+        return await text_to_speech.azure_text_to_speech(text, voice_name="ja-JP-KeitaNeural")
+    return await text_to_speech.text_to_speech_stream(text)
+
+
+# 文字はほぼ同じでも話題(名詞)が違う質問はまとめない
+chat_clusterer = ChatClusterer(threshold=settings.CHAT_CLUSTER_THRESHOLD, window_sec=settings.CHAT_CLUSTER_WINDOW_SEC, keywords=japanese_tokenizer.extract_nouns)
+reply_prefetcher = ReplyPrefetcher(
+    filter_comments=_filter_comments_for_prefetch,
+    generate_reply=_generate_prefetched_reply,
+    synthesize=_synthesize_prefetched_reply,
+    max_queue_size=settings.REPLY_PREFETCH_MAX_QUEUE_SIZE,
+    batch_size=settings.REPLY_PREFETCH_BATCH_SIZE,
+    concurrency=settings.REPLY_PREFETCH_CONCURRENCY,
+    max_ready=settings.REPLY_PREFETCH_MAX_READY,
+    ttl_sec=settings.REPLY_PREFETCH_TTL_SEC,
+    clusterer=chat_clusterer if settings.CHAT_CLUSTERING_ENABLED else None,
+)
+
+
 @app.post("/reply")
 async def reply(inputtext: str = Form(...)):
     """GPT に問い合わせた回答結果を取得する"""
-    res1, res2 = await generate_response(
-        text=inputtext, log_filename_json=log_filename_json, log_filename_csv=log_filename_csv, doc_retrieval_type=DocumentRetrievalType.multi, check_hal=True
-    )
+    with llm_priority(LLMPriority.live_reply):
+        res1, res2 = await generate_response(
+            text=inputtext,
+            log_filename_json=log_filename_json,
+            log_filename_csv=log_filename_csv,
+            doc_retrieval_type=DocumentRetrievalType.multi,
+            check_hal=True,
+            use_cache=settings.REPLY_CACHE_ENABLED,
+            budget_sec=settings.REPLY_BUDGET_SEC,
+        )
 
     if isinstance(res1, bytes):
         res1 = res1.decode("utf-8")
@@ -97,11 +228,39 @@ async def reply(inputtext: str = Form(...)):
     return ORJSONResponse(content=response)
 
 
+@app.post("/reply/stream")
+async def reply_stream(inputtext: str = Form(...)):
+    """/reply のストリーミング版
+
+    回答の文章を生成された順に Server-Sent Events の delta イベントで返し、
+    最後に done イベントで回答の全文、画像のファイル名、ハルシネーションの判定結果、所要時間を返す
+    """
+    events = generate_response_stream(
+        text=inputtext,
+        log_filename_json=log_filename_json,
+        log_filename_csv=log_filename_csv,
+        doc_retrieval_type=DocumentRetrievalType.multi,
+        check_hal=True,
+        use_cache=settings.REPLY_CACHE_ENABLED,
+        budget_sec=settings.REPLY_BUDGET_SEC,
+    )
+
+    async def event_stream() -> AsyncIterator[str]:
+        # レスポンスを返した後に実行されるので、ここで優先度を設定する
+        with llm_priority(LLMPriority.live_reply):
+            async for event in events:
+                yield f"event: {event.EVENT}\ndata: {event.model_dump_json()}\n\n"
+
+    # プロキシ(nginx)にバッファリングさせず、届いた順にクライアントへ流す
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.post("/filter")
 async def filter(request: FilteringRequest):
     """コメントのフィルタリングを行う"""
     try:
-        filtered = await filter_inappropriate_comments(request.messages)
+        with llm_priority(LLMPriority.filter):
+            filtered = await filter_inappropriate_comments(request.messages, request.authors)
         return {"messages": filtered}
     except Exception as e:
         print(e)
@@ -135,9 +294,41 @@ async def post_chat_messages(request: YouTubeCommentPostRequest, session: Sessio
             created_at=datetime.datetime.now(datetime.UTC),
         )
     )
+    # 回答の事前準備を始めておく(GET /prefetch/next で取り出す)
+    reply_prefetcher.submit(request.message_id, request.message, request.name)
     return ORJSONResponse(content={})
 
 
+@app.get("/prefetch/next")
+async def get_next_prefetched_reply() -> PrefetchedReply | None:
+    """事前に用意した回答のうち、まだ取り出されていない最も古いものを取り出す
+
+    用意できた回答が無い場合は 204 を返す。音声は GET /prefetch/{message_id}/voice で取得する
+    """
+    reply = reply_prefetcher.pop_next()
+    if reply is None:
+        return Response(status_code=204)
+    return reply
+
+
+@app.get("/prefetch/{message_id}")
+async def get_prefetched_reply(message_id: str) -> PrefetchedReply:
+    """メッセージ ID から事前に用意した回答を取得する"""
+    bundle = reply_prefetcher.get(message_id)
+    if bundle is None:
+        raise HTTPException(status_code=404, detail="Prefetched reply not found")
+    return bundle.reply
+
+
+@app.get("/prefetch/{message_id}/voice", response_class=Response)
+async def get_prefetched_voice(message_id: str):
+    """メッセージ ID から事前に用意した回答の音声(WAV)を取得する"""
+    bundle = reply_prefetcher.get(message_id)
+    if bundle is None or bundle.audio is None:
+        raise HTTPException(status_code=404, detail="Prefetched voice not found")
+    return Response(content=bundle.audio, media_type="audio/wav")
+
+
 @app.get("/youtube/chat_message")
 async def chat_messages(
     request: Request,
@@ -232,8 +423,15 @@ async def get_information(
     """Retrieve and return information related to the provided query text using RAG."""
     try:
         # 与えられた質問文に関連する情報を取得する
-        knowledge_items = get_hybrid_knowledge(query=query, top_k=top_k)
-        qa_items = get_multiple_qa(query=query, top_k=top_k)
+        # クエリの埋め込みは一度だけ行い、QA とナレッジの検索で使い回す
+        # 電話での対話(phonecall)から回答中に呼ばれるので、配信中の回答と同じ優先度にする
+        with llm_priority(LLMPriority.live_reply):
+            vector = await aembed_query(query)
+            knowledge_items, search_result = await asyncio.gather(
+                aget_hybrid_knowledge(query=query, top_k=top_k, vector=vector),
+                asearch_indexes(query, top_k={QA_INDEX_NAME: top_k}, vector=vector),
+            )
+        qa_items = [doc.page_content for doc in search_result.results[QA_INDEX_NAME]]
     except Exception as e:
         # エラーハンドリング: RAG情報の取得に失敗した場合
         raise HTTPException(status_code=500, detail=f"Failed to retrieve information: {str(e)}") from e
@@ -241,13 +439,99 @@ async def get_information(
     return {"query": query, "knowledge_items": knowledge_items, "qa_items": qa_items}
 
 
+@app.post("/get_info/batch")
+async def get_information_batch(request: GetInfoBatchRequest):
+    """Retrieve and return information related to each of the provided query texts using RAG.
+
+    GET /get_info を複数のクエリについてまとめて行う。埋め込み・インデックスの検索は全クエリについて一度に行う
+    """
+    try:
+        # まとめて呼ぶのはオフラインの処理なので、配信中の回答のために空けてある枠を使わないよう batch の優先度にする
+        with llm_priority(LLMPriority.batch):
+            vectors = await aembed_queries(request.queries)
+            knowledge_results, qa_results = await asyncio.gather(
+                asearch_hybrid_knowledge_batch(request.queries, top_k=request.top_k, vectors=vectors),
+                asearch_index_by_vectors(QA_INDEX_NAME, vectors, top_k=request.top_k),
+            )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to retrieve information: {str(e)}") from e
+    # クエリごとに GET /get_info と同じ形式で返す
+    results = [
+        {
+            "query": query,
+            "knowledge_items": [(doc.page_content, doc.metadata) for doc in knowledge_docs],
+            "qa_items": [doc.page_content for doc in qa_docs],
+        }
+        for query, knowledge_docs, qa_docs in zip(request.queries, knowledge_results, qa_results, strict=True)
+    ]
+    return {"results": results}
+
+
 @app.post("/hallucination")
 async def hallucination(request: HallucinationRequest) -> HallucinationResponse:
     """ハルシネーション判定を実施"""
-    res = await generate_hallucination_response(text=request.text, doc_retrieval_type=DocumentRetrievalType.multi)
+    with llm_priority(LLMPriority.live_reply):
+        res = await generate_hallucination_response(text=request.text, doc_retrieval_type=DocumentRetrievalType.multi)
     return res
 
 
+@app.get("/cache_stats")
+async def get_cache_stats() -> dict[str, CacheStats]:
+    """プロセス内のキャッシュの統計情報(ヒット率や破棄された数)を取得する"""
+    return {
+        "query_embedding": query_embeddings.stats,
+        "rerank_decision": rerank_decision_cache.stats,
+        "semantic_reply": semantic_reply_cache.stats,
+        "persistent_reply_l1": persistent_reply_cache.stats,
+        "comment_filter": comment_filter.cache_stats,
+    }
+
+
+@app.get("/grounding_stats")
+async def get_grounding_stats() -> GroundingStats:
+    """ハルシネーションの事前チェックの統計情報(LLM によるチェックを省いた数など)を取得する"""
+    return grounding_checker.stats
+
+
+@app.get("/single_flight_stats")
+async def get_single_flight_stats() -> dict[str, SingleFlightStats]:
+    """同時に来た同じ質問をまとめた数(生成せずに済んだ数)を取得する"""
+    return {
+        "reply": reply_single_flight.stats,
+        "hallucination": hallucination_single_flight.stats,
+    }
+
+
+@app.get("/llm_scheduler_stats")
+async def get_llm_scheduler_stats() -> LLMSchedulerStats:
+    """LLM・埋め込みの API 呼び出しの実行中の数、優先度ごとの待ちの数と待ち時間を取得する"""
+    return llm_scheduler.stats
+
+
+@app.get("/comment_filter_stats")
+async def get_comment_filter_stats() -> CommentFilterStats:
+    """/filter で LLM に送ったコメントの数と呼び出し回数、キャッシュを使った数などを取得する"""
+    return comment_filter.stats
+
+
+@app.get("/comment_prefilter_stats")
+async def get_comment_prefilter_stats() -> CommentPrefilterStats:
+    """/filter で LLM に送る前に落としたコメントの数を、理由ごとに取得する"""
+    return comment_prefilter.stats
+
+
+@app.get("/reply_prefetch_stats")
+async def get_reply_prefetch_stats() -> ReplyPrefetchStats:
+    """チャットのコメントについて事前に用意した回答の数や、フィルタリングで対象外になった数などを取得する"""
+    return reply_prefetcher.stats
+
+
+@app.get("/chat_cluster_stats")
+async def get_chat_cluster_stats() -> ChatClusterStats:
+    """回答の事前準備で、ほぼ同じ質問としてまとめたコメントの数やクラスタの大きさを取得する"""
+    return chat_clusterer.stats
+
+
 @app.get("/template_message")
 async def get_template_message():
     """テンプレートメッセージを取得する
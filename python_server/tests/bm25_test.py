@@ -0,0 +1,73 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from rank_bm25 import BM25Okapi
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from langchain.schema.document import Document
+
+from src.retrieval.bm25 import BM25CorpusRegistry, BM25Index, save_bm25_index, top_k_scores
+from src.retrieval.tokenizer import JapaneseTokenizer
+
+CORPUS = [
+    ["東京", "政策", "柱"],
+    ["東京", "子育て", "支援", "支援"],
+    ["選挙", "政策", "デジタル"],
+    ["東京", "交通"],
+    [],
+]
+
+
+@pytest.mark.parametrize("query", [["政策"], ["東京", "支援"], ["支援", "支援"], ["未知語"], []])
+def test_scores_match_rank_bm25(query) -> None:
+    expected = BM25Okapi(CORPUS).get_scores(query)
+    actual = BM25Index.from_tokens(CORPUS).scores(query)
+    np.testing.assert_allclose(actual, expected)
+
+
+def test_scores_batch_matches_scores() -> None:
+    index = BM25Index.from_tokens(CORPUS)
+    queries = [["政策"], ["東京", "支援"], ["未知語"], [], ["支援", "支援"]]
+    np.testing.assert_allclose(index.scores_batch(queries), [index.scores(query) for query in queries])
+    assert index.scores_batch([[], ["未知語"]]).shape == (2, len(CORPUS))
+
+
+def test_search_returns_top_k_ids_and_scores() -> None:
+    index = BM25Index.from_tokens(CORPUS)
+    ids, scores = index.search(["東京", "支援"], top_k=2)
+    all_scores = index.scores(["東京", "支援"])
+    assert ids.tolist() == np.argsort(-all_scores, kind="stable")[:2].tolist()
+    assert scores.tolist() == all_scores[ids].tolist()
+
+
+def test_top_k_scores_breaks_ties_by_id() -> None:
+    ids, scores = top_k_scores(np.array([1.0, 3.0, 1.0, 3.0]), top_k=3)
+    assert ids.tolist() == [1, 3, 0]
+    assert scores.tolist() == [3.0, 3.0, 1.0]
+    assert top_k_scores(np.array([1.0]), top_k=5)[0].tolist() == [0]
+
+
+def test_registry_reloads_with_the_faiss_index_version(tmp_path) -> None:
+    tokenizer = JapaneseTokenizer(stopwords=[])
+    built = []
+
+    def build_documents() -> list[Document]:
+        built.append(1)
+        return [Document(page_content="CSV の文書")]
+
+    registry = BM25CorpusRegistry(path=tmp_path, tokenizer=tokenizer, build_documents=build_documents)
+    # 保存済みのインデックスが無ければ、その場で作る
+    assert [doc.page_content for doc in registry.get("v1").documents] == ["CSV の文書"]
+
+    save_bm25_index([Document(page_content="東京の政策")], tokenizer, tmp_path)
+    first = registry.get("v1")
+    assert [doc.page_content for doc in first.documents] == ["東京の政策"]
+    assert registry.get("v1") is first
+
+    # FAISS のインデックスのバージョンが変わったら読み込み直す
+    second = registry.get("v2")
+    assert second is not first
+    assert registry.get("v2") is second
+    assert len(built) == 1
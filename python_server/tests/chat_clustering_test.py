@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.chat_clustering import ChatClusterer
+from src.retrieval.tokenizer import JapaneseTokenizer
+
+
+def test_near_duplicate_questions_are_clustered() -> None:
+    clusterer = ChatClusterer()
+    assert clusterer.add("1", "消費税についてどう考えていますか？") == (0, "1", True)
+    assert clusterer.add("2", "子育て支援の政策を教えてください") == (1, "2", True)
+    # 表記ゆれや言い回しの少しの違いは同じ質問とみなす
+    assert clusterer.add("3", "消費税についてどう考えてますか") == (0, "1", False)
+    assert clusterer.add("4", "消費税についてどう考えていますか！！") == (0, "1", False)
+    assert clusterer.add("5", "好きな食べ物は？").is_new
+
+    stats = clusterer.stats
+    assert (stats.messages, stats.clusters, stats.clustered) == (5, 3, 2)
+    assert stats.active_clusters == 3
+    assert stats.largest_active_cluster == 3
+    assert stats.clustered_rate == 0.4
+
+
+def test_questions_on_different_topics_are_not_clustered() -> None:
+    clusterer = ChatClusterer(keywords=JapaneseTokenizer(stopwords=[]).extract_nouns)
+    # 文字はほぼ同じでも、話題(名詞)が違う質問はまとめない
+    assert clusterer.add("1", "消費税はどうしますか？").is_new
+    assert clusterer.add("2", "所得税はどうしますか？").is_new
+    assert clusterer.add("3", "子育て政策について教えてください").is_new
+    assert clusterer.add("4", "教育政策について教えてください").is_new
+    assert clusterer.add("5", "防災政策について教えてください").is_new
+    # 話題が同じで言い回しが少し違う質問はまとめる
+    assert clusterer.add("6", "子育て政策について教えて！") == (2, "3", False)
+    assert clusterer.add("7", "消費税はどうしますか") == (0, "1", False)
+    assert clusterer.stats.clustered == 2
+
+
+def test_join_does_not_create_clusters_and_removed_clusters_are_not_joined() -> None:
+    clusterer = ChatClusterer()
+    assert clusterer.join("消費税についてどう考えていますか？") is None
+    assert clusterer.stats.clusters == 0
+    assert clusterer.add("1", "消費税についてどう考えていますか？").is_new
+    assert clusterer.join("消費税についてどう考えていますか！！") == (0, "1", False)
+    clusterer.remove("1")
+    assert clusterer.join("消費税についてどう考えていますか？") is None
+    assert clusterer.stats.active_clusters == 0
+
+
+def test_clusters_expire_after_the_window() -> None:
+    clusterer = ChatClusterer(window_sec=0.05)
+    assert clusterer.add("1", "消費税についてどう考えていますか？").is_new
+    assert not clusterer.add("2", "消費税についてどう考えていますか？").is_new
+    time.sleep(0.06)
+    assert clusterer.add("3", "消費税についてどう考えていますか？") == (1, "3", True)
+    assert clusterer.stats.active_clusters == 1
+
+
+def test_signature_similarity_estimates_jaccard() -> None:
+    clusterer = ChatClusterer(num_perm=256, bands=64)
+    a = clusterer.signature("あいうえおかきくけこ")
+    b = clusterer.signature("あいうえおさしすせそ")
+    # 2-gram は 9 個ずつで 4 個が共通なので、Jaccard 係数は 4 / 14
+    assert abs((a == b).mean() - 4 / 14) < 0.1
+    assert (a == clusterer.signature("あいうえおかきくけこ")).all()
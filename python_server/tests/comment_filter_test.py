@@ -0,0 +1,64 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.comment_filter import CommentFilter
+
+
+def _make_filter(calls: list[list[str]], *, max_batch_size: int = 50) -> CommentFilter:
+    async def classify(comments: list[str]) -> list[bool]:
+        calls.append(comments)
+        await asyncio.sleep(0.01)
+        return ["?" in comment for comment in comments]
+
+    return CommentFilter(classify=classify, window_sec=0.02, max_batch_size=max_batch_size, cache_max_size=100, cache_ttl_sec=60)
+
+
+def test_concurrent_calls_are_classified_in_one_batch() -> None:
+    calls: list[list[str]] = []
+    comment_filter = _make_filter(calls)
+
+    async def run():
+        return await asyncio.gather(
+            comment_filter.filter(["好きな食べ物は?", "こんにちは"]),
+            comment_filter.filter(["こんにちは", "政策について教えて?"]),
+        )
+
+    assert asyncio.run(run()) == [["好きな食べ物は?"], ["政策について教えて?"]]
+    assert calls == [["好きな食べ物は?", "こんにちは", "政策について教えて?"]]
+    stats = comment_filter.stats
+    assert stats.comments == 4
+    assert stats.coalesced == 1
+    assert stats.llm_calls == 1
+
+
+def test_cached_comments_are_not_classified_again() -> None:
+    calls: list[list[str]] = []
+    comment_filter = _make_filter(calls, max_batch_size=2)
+
+    assert asyncio.run(comment_filter.filter(["a?", "b", "c?"])) == ["a?", "c?"]
+    # max_batch_size ごとに分けて判定する
+    assert calls == [["a?", "b"], ["c?"]]
+    # 正規化したテキストが同じコメントは判定結果を使い回す
+    assert asyncio.run(comment_filter.filter(["ａ?", "b", "d"])) == ["ａ?"]
+    assert calls[-1] == ["d"]
+    assert comment_filter.stats.cache_hits == 2
+
+
+def test_classify_error_is_propagated_to_all_callers() -> None:
+    async def classify(comments: list[str]) -> list[bool]:
+        raise RuntimeError("503")
+
+    comment_filter = CommentFilter(classify=classify, window_sec=0.01, max_batch_size=10, cache_max_size=10, cache_ttl_sec=60)
+
+    async def run():
+        return await asyncio.gather(comment_filter.filter(["a"]), comment_filter.filter(["b"]), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    # 失敗したコメントはキャッシュせず、次の呼び出しで判定し直す
+    with pytest.raises(RuntimeError):
+        asyncio.run(comment_filter.filter(["a"]))
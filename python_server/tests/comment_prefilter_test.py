@@ -0,0 +1,77 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.comment_prefilter import CommentPrefilter, comment_skeleton
+
+
+def _make_prefilter(**kwargs) -> CommentPrefilter:
+    return CommentPrefilter(**{"min_length": 2, "max_length": 50, "window_sec": 60, "max_comments_per_author": 2, **kwargs})
+
+
+def test_rules_drop_comments_that_are_not_worth_classifying() -> None:
+    prefilter = _make_prefilter()
+    comments = [
+        "#配信の音が小さいです",
+        " ＃テスト",
+        "https://example.com/foo",
+        "😊😊😊",
+        "wwwwwww",
+        "あ" + "い" * 60,
+        "政策について教えてください",
+        "政策について教えてください！！",
+        "消費税はどうしますか？",
+    ]
+    assert prefilter.filter(comments) == ["政策について教えてください", "消費税はどうしますか？"]
+    stats = prefilter.stats
+    assert stats.comments == 9
+    assert stats.passed == 2
+    assert stats.dropped == {"prefix": 2, "url_only": 1, "no_text": 1, "length": 2, "duplicate": 1, "author_spam": 0}
+
+
+def test_duplicates_across_calls_are_dropped_within_the_window() -> None:
+    prefilter = _make_prefilter()
+    assert prefilter.filter(["こんにちは"]) == ["こんにちは"]
+    assert prefilter.filter(["こんにちはーー😊", "こんばんは"]) == ["こんばんは"]
+
+    prefilter = _make_prefilter(window_sec=0)
+    assert prefilter.filter(["こんにちは"]) == ["こんにちは"]
+    assert prefilter.filter(["こんにちは"]) == ["こんにちは"]
+
+
+def test_author_spam_is_suppressed() -> None:
+    prefilter = _make_prefilter()
+    comments = ["質問1", "質問2", "質問3", "質問4"]
+    assert prefilter.filter(comments, ["a", "a", "a", "b"]) == ["質問1", "質問2", "質問4"]
+    assert prefilter.stats.dropped["author_spam"] == 1
+    with pytest.raises(ValueError):
+        prefilter.filter(comments, ["a"])
+
+
+def test_filtering_rolls_back_when_classification_fails() -> None:
+    prefilter = _make_prefilter(max_comments_per_author=1)
+
+    def classify_and_fail() -> None:
+        with prefilter.filtering(["消費税はどうしますか？"], ["a"]) as passed:
+            assert passed == ["消費税はどうしますか？"]
+            raise RuntimeError("LLM failed")
+
+    with pytest.raises(RuntimeError):
+        classify_and_fail()
+    # 送り直されたコメントは、重複や連投として落とさない
+    assert prefilter.filter(["消費税はどうしますか？"], ["a"]) == ["消費税はどうしますか？"]
+
+    # 判定に成功した場合は記録を残す
+    with prefilter.filtering(["こんにちは"], ["b"]) as passed:
+        assert passed == ["こんにちは"]
+    assert prefilter.filter(["こんにちは"], ["c"]) == []
+    assert prefilter.filter(["こんばんは"], ["b"]) == []
+    assert prefilter.stats.dropped["duplicate"] == 1
+    assert prefilter.stats.dropped["author_spam"] == 1
+
+
+def test_comment_skeleton() -> None:
+    assert comment_skeleton("こんにちはーー！！😊") == comment_skeleton("こんにちは") == "こんにちは"
+    assert comment_skeleton("ＡＢＣ https://example.com") == "abc"
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.deadline import Deadline, LatencyTracker, hedged
+
+
+def test_hedged_sends_second_request_when_first_is_slow() -> None:
+    delays = [0.2, 0.01]
+    started = []
+
+    async def call() -> int:
+        i = len(started)
+        started.append(i)
+        await asyncio.sleep(delays[i])
+        return i
+
+    tracker = LatencyTracker(min_samples=1)
+
+    async def main() -> tuple[tuple[int, bool], float | None]:
+        result = await hedged(call, delay_sec=0.02, latency_tracker=tracker)
+        recorded_before = tracker.percentile(0.0)
+        # 遅い方が終わるのを待つ
+        await asyncio.sleep(0.25)
+        return result, recorded_before
+
+    result, recorded_before = asyncio.run(main())
+    assert result == (1, True)
+    assert started == [0, 1]
+    # 所要時間は最初の call を実行した時点から測る
+    assert recorded_before == pytest.approx(0.03, abs=0.015)
+    # 遅かった方も、終わった時点で所要時間を記録する
+    assert tracker.percentile(0.0) == pytest.approx(0.03, abs=0.015)
+    assert tracker.percentile(0.99) == pytest.approx(0.2, abs=0.03)
+
+
+def test_hedged_cancels_calls_when_caller_is_cancelled() -> None:
+    cancelled = []
+
+    async def call() -> None:
+        try:
+            await asyncio.sleep(1.0)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def main() -> None:
+        with pytest.raises(TimeoutError):
+            await asyncio.wait_for(hedged(call, delay_sec=0.01), timeout=0.05)
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert cancelled == [1, 1]
+
+
+def test_hedged_does_not_send_second_request_when_first_is_fast() -> None:
+    calls = []
+
+    async def call() -> str:
+        calls.append(1)
+        return "ok"
+
+    assert asyncio.run(hedged(call, delay_sec=0.05)) == ("ok", False)
+    assert len(calls) == 1
+
+
+def test_hedged_uses_the_other_result_when_one_fails() -> None:
+    started = []
+
+    async def call() -> str:
+        i = len(started)
+        started.append(i)
+        await asyncio.sleep(0.03 if i == 0 else 0.05)
+        if i == 0:
+            raise RuntimeError("503")
+        return "second"
+
+    assert asyncio.run(hedged(call, delay_sec=0.01)) == ("second", True)
+
+
+def test_latency_tracker_and_deadline() -> None:
+    tracker = LatencyTracker(window=10, min_samples=5)
+    for latency in [1.0, 2.0, 3.0, 4.0]:
+        tracker.record(latency)
+    assert tracker.percentile(0.9) is None
+    for latency in [5.0, 6.0, 7.0, 8.0, 9.0, 10.0, 11.0]:
+        tracker.record(latency)
+    # 直近の 10 件(2~11)の 9 割
+    assert tracker.percentile(0.9) == 11.0
+    assert tracker.percentile(0.5) == 7.0
+
+    deadline = Deadline(0.0)
+    assert deadline.expired
+    assert deadline.remaining() == 0.0
+    assert not Deadline(10.0).expired
@@ -0,0 +1,77 @@
+import os
+import sys
+
+import pytest
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.retrieval.faiss_registry import FaissIndexRegistry
+from src.retrieval.vector_search import similarity_search_with_score_by_vectors
+
+
+def _save_index(path, texts):
+    FAISS.from_texts(texts, DeterministicFakeEmbedding(size=8)).save_local(path)
+
+
+def test_get_loads_once_and_reloads_on_change(tmp_path) -> None:
+    _save_index(tmp_path, ["りんご", "みかん"])
+    registry = FaissIndexRegistry(embeddings=DeterministicFakeEmbedding(size=8), check_interval_sec=0)
+    registry.register("knowledge", tmp_path)
+
+    first = registry.get("knowledge")
+    assert registry.get("knowledge") is first
+    version = registry.version("knowledge")
+
+    _save_index(tmp_path, ["りんご", "みかん", "ぶどう"])
+    # mtime の分解能が粗いファイルシステムでもサイズの変化で検知できる
+    second = registry.get("knowledge")
+    assert second is not first
+    assert second.index.ntotal == 3
+    assert registry.version("knowledge") != version
+
+
+def test_version_depends_only_on_the_content(tmp_path) -> None:
+    _save_index(tmp_path, ["りんご", "みかん"])
+    registry = FaissIndexRegistry(embeddings=DeterministicFakeEmbedding(size=8), check_interval_sec=0)
+    registry.register("knowledge", tmp_path)
+    first = registry.get("knowledge")
+    version = registry.version("knowledge")
+
+    # 同じ文書から作り直した場合(文書の id は変わる)は、読み込み直してもバージョンは変わらない
+    _save_index(tmp_path, ["りんご", "みかん"])
+    assert registry.get("knowledge") is not first
+    assert registry.version("knowledge") == version
+
+    _save_index(tmp_path, ["りんご", "ぶどう"])
+    assert registry.version("knowledge") != version
+
+
+def test_keeps_loaded_index_when_files_are_removed(tmp_path) -> None:
+    _save_index(tmp_path, ["りんご"])
+    registry = FaissIndexRegistry(embeddings=DeterministicFakeEmbedding(size=8), check_interval_sec=0)
+    registry.register("qa", tmp_path)
+    store = registry.get("qa")
+
+    (tmp_path / "index.faiss").unlink()
+    assert registry.get("qa") is store
+
+
+def test_raises_when_never_loaded(tmp_path) -> None:
+    registry = FaissIndexRegistry(embeddings=DeterministicFakeEmbedding(size=8))
+    registry.register("qa", tmp_path / "missing")
+    with pytest.raises(RuntimeError):
+        registry.get("qa")
+
+
+def test_search_by_vectors_matches_search_by_vector() -> None:
+    embeddings = DeterministicFakeEmbedding(size=8)
+    store = FAISS.from_texts(["りんご", "みかん", "ぶどう"], embeddings)
+    vectors = [embeddings.embed_query("りんご"), embeddings.embed_query("メロン")]
+
+    results = similarity_search_with_score_by_vectors(store, vectors, k=5)
+    for vector, docs_and_scores in zip(vectors, results, strict=True):
+        expected = store.similarity_search_with_score_by_vector(vector, k=5)
+        assert [doc.page_content for doc, _ in docs_and_scores] == [doc.page_content for doc, _ in expected]
+        assert [score for _, score in docs_and_scores] == pytest.approx([score for _, score in expected])
+    assert len(results[0]) == 3
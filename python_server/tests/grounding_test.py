@@ -0,0 +1,36 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.grounding import GroundingChecker
+from src.retrieval.tokenizer import JapaneseTokenizer
+
+KNOWLEDGE = "Title: 子育て支援\n東京都では、第二子以降の保育料を無償化し、子育て世帯の負担を軽減します。"
+
+
+def _checker() -> GroundingChecker:
+    return GroundingChecker(tokenizer=JapaneseTokenizer(stopwords=["こと", "する"]), min_token_coverage=0.8, min_ngram_coverage=0.5)
+
+
+def test_reply_paraphrasing_knowledge_is_grounded() -> None:
+    checker = _checker()
+    score = checker.check("第二子以降の保育料を無償化して、子育て世帯の負担を軽減します！", [KNOWLEDGE, ""])
+    assert score.grounded
+    assert score.token_coverage == 1.0
+    assert score.unknown_proper_nouns == []
+
+
+def test_reply_with_unknown_proper_noun_is_escalated() -> None:
+    checker = _checker()
+    score = checker.check("大阪府では第二子以降の保育料を無償化し、子育て世帯の負担を軽減します。", [KNOWLEDGE])
+    assert not score.grounded
+    assert score.unknown_proper_nouns == ["大阪"]
+
+    score = checker.check("公園を増やして遊び場を整備します。", [KNOWLEDGE])
+    assert not score.grounded
+    assert score.token_coverage < 0.8
+
+    checker.record_llm_result(hallucinated=True)
+    stats = checker.stats
+    assert (stats.checked, stats.grounded, stats.escalated, stats.escalated_hallucinated) == (2, 0, 2, 1)
+    assert stats.llm_check_avoided_rate == 0.0
@@ -0,0 +1,54 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.retrieval.hybrid import FusionMethod, HybridRetriever, fuse_results
+from src.schema.retrieval import ScoredDocument
+
+
+def _docs(*pairs):
+    return [ScoredDocument(page_content=content, metadata={"image": f"{content}.png"}, score=score) for content, score in pairs]
+
+
+def test_rrf_matches_ensemble_retriever_order() -> None:
+    fused = fuse_results(
+        {"bm25": _docs(("a", 3.0), ("b", 2.0)), "vector": _docs(("c", 0.9), ("b", 0.8))},
+        weights={"bm25": 0.5, "vector": 0.5},
+    )
+    assert [doc.page_content for doc in fused] == ["b", "a", "c"]
+    assert fused[0].score == pytest.approx(0.5 / 62 + 0.5 / 62)
+    assert fused[0].source_scores == {"bm25": 2.0, "vector": 0.8}
+    # 同点の場合は先に現れたものが優先される
+    assert fused[1].score == fused[2].score
+
+
+def test_weighted_fusion_normalizes_scores() -> None:
+    fused = fuse_results(
+        {"bm25": _docs(("a", 10.0), ("b", 0.0)), "vector": _docs(("b", 0.9), ("a", 0.7))},
+        weights={"bm25": 0.3, "vector": 0.7},
+        method=FusionMethod.weighted,
+    )
+    assert [(doc.page_content, doc.score) for doc in fused] == [("b", pytest.approx(0.7)), ("a", pytest.approx(0.3))]
+
+
+def test_hybrid_retriever_uses_given_vector() -> None:
+    embedded = []
+
+    def embed_query(query):
+        embedded.append(query)
+        return [1.0]
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        retriever = HybridRetriever(
+            keyword_search=lambda query, top_k: _docs(("a", 1.0), ("b", 0.5))[:top_k],
+            vector_search=lambda vector, top_k: _docs(("c", vector[0]))[:top_k],
+            embed_query=embed_query,
+            executor=executor,
+        )
+        assert [doc.page_content for doc in retriever.search("質問", top_k=2, vector=[0.5])] == ["a", "c"]
+        assert embedded == []
+        retriever.search("質問", top_k=2)
+        assert embedded == ["質問"]
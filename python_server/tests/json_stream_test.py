@@ -0,0 +1,32 @@
+import json
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.json_stream import JsonStringFieldExtractor
+
+
+def _feed_by_chars(extractor: JsonStringFieldExtractor, text: str) -> list[str]:
+    return [extractor.feed(char) for char in text]
+
+
+def test_extracts_field_value_as_chunks_arrive() -> None:
+    extractor = JsonStringFieldExtractor("response")
+    assert extractor.feed('{"resp') == ""
+    assert extractor.feed('onse": "子育て') == "子育て"
+    assert extractor.feed("支援を") == "支援を"
+    assert not extractor.done
+    assert extractor.feed('拡充します。"}') == "拡充します。"
+    assert extractor.done
+    assert extractor.feed(" ") == ""
+
+
+def test_escapes_split_across_chunks_are_decoded_once_complete() -> None:
+    value = '改行\nタブ\t引用符"バックスラッシュ\\絵文字😀'
+    document = json.dumps({"other": "x", "response": value}, ensure_ascii=True)
+    extractor = JsonStringFieldExtractor("response")
+    deltas = _feed_by_chars(extractor, document)
+    assert "".join(deltas) == value
+    # エスケープやサロゲートペアの途中では取り出さず、揃ったところで 1 文字ずつ取り出す
+    assert [delta for delta in deltas if delta] == list(value)
+    assert extractor.done
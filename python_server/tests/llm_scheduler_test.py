@@ -0,0 +1,105 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.llm_scheduler import LLMPriority, LLMScheduler, current_llm_priority, llm_priority
+
+
+def test_waiting_calls_run_in_priority_order() -> None:
+    scheduler = LLMScheduler(max_concurrency=1)
+    order = []
+
+    async def call(name: str, priority: LLMPriority):
+        async with scheduler.slot(priority):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def run():
+        first = asyncio.ensure_future(call("first", LLMPriority.batch))
+        await asyncio.sleep(0)
+        waiting = [
+            asyncio.ensure_future(call("batch", LLMPriority.batch)),
+            asyncio.ensure_future(call("filter", LLMPriority.filter)),
+            asyncio.ensure_future(call("live", LLMPriority.live_reply)),
+        ]
+        await asyncio.sleep(0.001)
+        assert scheduler.stats.queue_depth == {"live_reply": 1, "tts_prep": 0, "filter": 1, "batch": 1}
+        await asyncio.gather(first, *waiting)
+
+    asyncio.run(run())
+    assert order == ["first", "live", "filter", "batch"]
+    stats = scheduler.stats
+    assert stats.in_flight == 0
+    assert stats.wait_time["batch"].count == 2
+    assert stats.wait_time["batch"].max_sec >= stats.wait_time["live_reply"].max_sec
+
+
+def test_reserved_slots_are_only_used_by_live_replies() -> None:
+    scheduler = LLMScheduler(max_concurrency=2, reserved_concurrency=1)
+
+    async def run():
+        async with scheduler.slot(LLMPriority.batch):
+            blocked = asyncio.ensure_future(scheduler.slot(LLMPriority.batch).__aenter__())
+            await asyncio.sleep(0.01)
+            assert not blocked.done()
+            # live_reply は予約した枠で実行できる
+            async with scheduler.slot(LLMPriority.live_reply):
+                assert scheduler.stats.in_flight == 2
+            blocked.cancel()
+            await asyncio.gather(blocked, return_exceptions=True)
+        assert scheduler.stats.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_batch_requests_cannot_take_the_reserved_slot() -> None:
+    scheduler = LLMScheduler(max_concurrency=3, reserved_concurrency=1)
+    started = []
+
+    async def request(name: str):
+        async with scheduler.slot():
+            started.append(name)
+            await asyncio.sleep(0.02)
+
+    async def run():
+        # /get_info/batch のように、ブロック内の呼び出しを batch の優先度にする
+        with llm_priority(LLMPriority.batch):
+            batch = [asyncio.ensure_future(request(f"batch{i}")) for i in range(3)]
+        await asyncio.sleep(0.005)
+        assert started == ["batch0", "batch1"]
+        assert scheduler.stats.queue_depth["batch"] == 1
+        with llm_priority(LLMPriority.live_reply):
+            live = asyncio.ensure_future(request("live"))
+        await asyncio.sleep(0.005)
+        # 予約した枠は live_reply だけが使える
+        assert started == ["batch0", "batch1", "live"]
+        await asyncio.gather(*batch, live)
+
+    asyncio.run(run())
+    assert started[-1] == "batch2"
+
+
+def test_rate_limit_and_priority_from_context() -> None:
+    scheduler = LLMScheduler(max_concurrency=10, rate_per_sec=50, burst=1)
+    priorities = []
+
+    def call():
+        with scheduler.slot_sync():
+            priorities.append(current_llm_priority())
+
+    start = time.monotonic()
+    with llm_priority(LLMPriority.tts_prep):
+        call()
+        threads = [threading.Thread(target=call) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    # 1 回目はバーストで即座に、残りは 1/50 秒ごと
+    assert time.monotonic() - start >= 0.035
+    assert priorities[0] == LLMPriority.tts_prep
+    assert scheduler.stats.wait_time["tts_prep"].count == 1
+    assert scheduler.stats.wait_time["batch"].count == 2
@@ -0,0 +1,52 @@
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src import llm
+
+
+def test_get_model_reuses_instances() -> None:
+    assert llm.get_model() is llm.get_model()
+    assert llm.get_model(json_mode=False) is not llm.get_model()
+    assert llm.get_model()._generation_config == {"response_mime_type": "application/json"}
+    assert llm.get_model(system_instruction="静的なプロンプト") is llm.get_model(llm.DEFAULT_MODEL_NAME, system_instruction="静的なプロンプト")
+    assert llm.get_model(system_instruction="静的なプロンプト") is not llm.get_model()
+
+
+def test_generate_content_does_not_block_the_event_loop(monkeypatch) -> None:
+    async def fake_generate_content_async(contents):
+        await asyncio.sleep(0.05)
+        return contents
+
+    monkeypatch.setattr(llm.get_model(), "generate_content_async", fake_generate_content_async)
+
+    async def run():
+        return await asyncio.wait_for(asyncio.gather(*(llm.generate_content(str(i)) for i in range(10))), timeout=0.3)
+
+    assert asyncio.run(run()) == [str(i) for i in range(10)]
+
+
+def test_stream_content_releases_the_slot_before_the_stream_is_read(monkeypatch) -> None:
+    class FakeChunk:
+        def __init__(self, text: str):
+            self.text = text
+
+    async def fake_stream():
+        for text in ["あ", "い", "う"]:
+            yield FakeChunk(text)
+
+    async def fake_generate_content_async(contents, stream):
+        return fake_stream()
+
+    monkeypatch.setattr(llm.get_model(), "generate_content_async", fake_generate_content_async)
+
+    async def run():
+        stream = llm.stream_content("質問")
+        first = await stream.__anext__()
+        await asyncio.sleep(0.01)
+        # 読み終わる前でも、生成が終わっていれば枠は返している
+        assert llm.llm_scheduler.stats.in_flight == 0
+        return [first] + [chunk async for chunk in stream]
+
+    assert asyncio.run(run()) == ["あ", "い", "う"]
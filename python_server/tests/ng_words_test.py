@@ -0,0 +1,41 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.ng_words import AhoCorasick, NGWord, NGWordList, NGWordMatcher
+
+
+def test_aho_corasick_finds_overlapping_patterns() -> None:
+    automaton = AhoCorasick(["he", "she", "his", "hers"])
+    assert sorted(automaton.iter_matches("ushers")) == [(1, 4, 1), (2, 4, 0), (2, 6, 3)]
+
+
+def test_matcher_returns_first_ng_word_in_list_order() -> None:
+    matcher = NGWordMatcher([NGWord("原発", ""), NGWord("PFAS", "PFAS については回答できません"), NGWord("核", "")])
+    assert matcher.match("pfas と原発") == NGWord("原発", "")
+    assert matcher.match("PfAs の影響") == NGWord("PFAS", "PFAS については回答できません")
+    assert matcher.match("子育て支援") is None
+
+
+def test_matcher_ignores_ng_words_inside_whitelisted_words() -> None:
+    matcher = NGWordMatcher([NGWord("核", ""), NGWord("予算", "")])
+    assert matcher.match("核家族の支援") is None
+    assert matcher.match("政策の核心") is None
+    assert matcher.match("核家族と核兵器") == NGWord("核", "")
+    # whitelist の語を含んでいても、別の NG ワードは NG
+    assert matcher.match("中核市の予算") == NGWord("予算", "")
+
+
+def test_ng_word_list_reloads_when_csv_changes(tmp_path) -> None:
+    path = tmp_path / "NG.csv"
+    path.write_text('ng,reply\n"原発",""\n', encoding="utf8")
+    ng_word_list = NGWordList(path=path, check_interval_sec=0)
+    assert ng_word_list.match("原発") == NGWord("原発", "")
+    assert ng_word_list.match("横田基地") is None
+
+    path.write_text('ng,reply\n"原発",""\n"横田基地","その質問には答えられません"\n', encoding="utf8")
+    assert ng_word_list.match("横田基地") == NGWord("横田基地", "その質問には答えられません")
+
+    # 読み込めなくなった場合はそれまでの一覧を使い続ける
+    path.unlink()
+    assert ng_word_list.match("横田基地") == NGWord("横田基地", "その質問には答えられません")
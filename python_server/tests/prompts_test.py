@@ -0,0 +1,23 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.prompts import ALL_PROMPTS, HALLUCINATION_CHECK_PROMPT, N_BEST_KNOWLEDGE_PROMPT, REPLY_PROMPT
+
+
+def test_prefix_is_static_and_reused() -> None:
+    prefix = REPLY_PROMPT.prefix(ng_message="答えられません")
+    assert prefix is REPLY_PROMPT.prefix(ng_message="答えられません")
+    assert "{'response': str}" in prefix
+    assert "「こんにちは、答えられません」" in prefix
+    assert N_BEST_KNOWLEDGE_PROMPT.prefix(top_k=5, top_n=3).startswith("質問と、その質問に対して関連性が高いと判定された5件のドキュメントを与えるので、その中から関連度の高い3件")
+    assert '"results": [7, 3, 6]' in N_BEST_KNOWLEDGE_PROMPT.prefix(top_k=5, top_n=3)
+
+
+def test_request_specific_values_only_go_to_the_suffix() -> None:
+    # 検索結果や質問はプレフィックスに含めない(含めるとリクエストごとにプレフィックスが変わる)
+    for prompt in ALL_PROMPTS:
+        assert not {"rag_qa", "rag_knowledge", "question", "query", "docs", "comments", "generated_text"} & set(prompt.prefix_variables)
+
+    suffix = HALLUCINATION_CHECK_PROMPT.suffix(rag_knowledge="知識", rag_qa="FAQ", generated_text="返答")
+    assert suffix == "# 検索された知識\n知識\n\n# 検索された想定FAQ\nFAQ\n\n# 生成された返答\n返答"
@@ -0,0 +1,81 @@
+import contextlib
+import os
+import sys
+import time
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.reply_cache import PersistentReplyCache, SemanticReplyCache
+
+
+def _store(cache, query, vector, namespace="multi", version="v1"):
+    cache.store(query, vector, namespace=namespace, version=version, reply=f"{query}への回答", image_filename="slide_1.png")
+
+
+def test_lookup_returns_most_similar_reply_above_threshold() -> None:
+    cache = SemanticReplyCache(threshold=0.9, ttl_sec=60, max_size=10)
+    _store(cache, "子育て支援は？", [1.0, 0.0, 0.0])
+    _store(cache, "交通政策は？", [0.0, 1.0, 0.0])
+
+    hit = cache.lookup([0.95, 0.1, 0.0], namespace="multi", version="v1")
+    assert hit is not None
+    assert hit.reply == "子育て支援は？への回答"
+    assert hit.similarity == pytest.approx(0.95 / (0.95**2 + 0.1**2) ** 0.5)
+
+    assert cache.lookup([0.5, 0.5, 0.7], namespace="multi", version="v1") is None
+    # 回答の作り方が違うものは使わない
+    assert cache.lookup([1.0, 0.0, 0.0], namespace="legacy", version="v1") is None
+    assert (cache.stats.hits, cache.stats.misses) == (1, 2)
+
+
+def test_index_version_change_invalidates_all_entries() -> None:
+    cache = SemanticReplyCache(threshold=0.9, ttl_sec=60, max_size=10)
+    _store(cache, "子育て支援は？", [1.0, 0.0])
+    assert cache.lookup([1.0, 0.0], namespace="multi", version="v2") is None
+    assert cache.stats.size == 0
+
+
+def test_expires_and_evicts_oldest_entries() -> None:
+    cache = SemanticReplyCache(threshold=0.9, ttl_sec=60, max_size=2)
+    _store(cache, "a", [1.0, 0.0, 0.0])
+    _store(cache, "b", [0.0, 1.0, 0.0])
+    _store(cache, "c", [0.0, 0.0, 1.0])
+    assert cache.lookup([1.0, 0.0, 0.0], namespace="multi", version="v1") is None
+    assert cache.stats.evictions == 1
+
+    short_lived = SemanticReplyCache(threshold=0.9, ttl_sec=0.01, max_size=2)
+    _store(short_lived, "a", [1.0, 0.0])
+    time.sleep(0.02)
+    assert short_lived.lookup([1.0, 0.0], namespace="multi", version="v1") is None
+    assert short_lived.stats.expirations == 1
+
+
+class _RecordingSession:
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, stmt):
+        self.statements.append(str(stmt.compile(dialect=postgresql.dialect())))
+        raise RuntimeError("database is not available")
+
+
+def test_persistent_cache_falls_back_to_l1_when_database_is_unavailable() -> None:
+    session = _RecordingSession()
+
+    @contextlib.contextmanager
+    def session_factory():
+        yield session
+
+    cache = PersistentReplyCache(session_factory=session_factory, ttl_sec=60, l1_max_size=10, l1_ttl_sec=60)
+    assert cache.get("政策を教えて！", namespace="multi:True", version="v1") is None
+    cache.set("政策を教えて！", namespace="multi:True", version="v1", reply="回答", image_filename="slide_1.png")
+    assert "ON CONFLICT ON CONSTRAINT unique_namespace_normalized_text DO UPDATE" in session.statements[-1]
+
+    # 正規化した質問文の完全一致で L1 から引ける
+    hit = cache.get(" 政策を教えて!", namespace="multi:True", version="v1")
+    assert hit is not None
+    assert (hit.reply, hit.image_filename, hit.similarity) == ("回答", "slide_1.png", 1.0)
+    assert cache.get("政策を教えて!", namespace="multi:True", version="v2") is None
+    assert len(session.statements) == 3
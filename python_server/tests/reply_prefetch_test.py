@@ -0,0 +1,192 @@
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.chat_clustering import ChatClusterer
+from src.comment_prefilter import CommentPrefilter
+from src.llm_scheduler import LLMPriority, current_llm_priority
+from src.reply_prefetch import ReplyPrefetcher
+
+
+def _make_prefetcher(
+    priorities: list[LLMPriority],
+    *,
+    fail_synthesis: bool = False,
+    failing_question: str | None = None,
+    clusterer: ChatClusterer | None = None,
+    prefilter: CommentPrefilter | None = None,
+) -> ReplyPrefetcher:
+    async def filter_comments(comments: list[str], authors: list[str]) -> list[str]:
+        priorities.append(current_llm_priority())
+        if prefilter is not None:
+            comments = prefilter.filter(comments, authors)
+        return [comment for comment in comments if "?" in comment and not comment.startswith("#")]
+
+    async def generate_reply(text: str) -> tuple[str, str]:
+        priorities.append(current_llm_priority())
+        if text == failing_question:
+            await asyncio.sleep(0.03)
+            raise RuntimeError("LLM error")
+        return f"回答: {text}", "image.png"
+
+    async def synthesize(text: str) -> bytes:
+        if fail_synthesis:
+            raise RuntimeError("TTS error")
+        return text.encode()
+
+    return ReplyPrefetcher(
+        filter_comments=filter_comments,
+        generate_reply=generate_reply,
+        synthesize=synthesize,
+        max_queue_size=10,
+        batch_size=10,
+        concurrency=2,
+        max_ready=10,
+        ttl_sec=60,
+        clusterer=clusterer,
+    )
+
+
+def test_prefetched_replies_are_ready_in_order() -> None:
+    priorities: list[LLMPriority] = []
+    prefetcher = _make_prefetcher(priorities)
+
+    async def run():
+        assert not prefetcher.submit("0", "質問?", "a")
+        prefetcher.start()
+        assert prefetcher.submit("1", "政策は?", "a")
+        assert prefetcher.submit("2", "こんにちは", "b")
+        assert prefetcher.submit("3", "財源は?", "c")
+        # 同じメッセージは二度処理しない
+        assert not prefetcher.submit("1", "政策は?", "a")
+        await asyncio.sleep(0.05)
+        await prefetcher.stop()
+
+    asyncio.run(run())
+    first = prefetcher.pop_next()
+    assert first is not None
+    assert (first.message_id, first.response_text, first.has_audio) == ("1", "回答: 政策は?", True)
+    assert prefetcher.pop_next().message_id == "3"
+    assert prefetcher.pop_next() is None
+    # 取り出した後も音声は取得できる
+    assert prefetcher.get("1").audio == "回答: 政策は?".encode()
+    assert prefetcher.get("2") is None
+    assert priorities == [LLMPriority.filter, LLMPriority.tts_prep, LLMPriority.tts_prep]
+    stats = prefetcher.stats
+    assert (stats.submitted, stats.filtered_out, stats.prefetched, stats.failed) == (3, 1, 2, 0)
+
+
+def test_reply_is_kept_when_synthesis_fails() -> None:
+    prefetcher = _make_prefetcher([], fail_synthesis=True)
+
+    async def run():
+        prefetcher.start()
+        prefetcher.submit("1", "政策は?", "a")
+        await asyncio.sleep(0.05)
+        await prefetcher.stop()
+
+    asyncio.run(run())
+    reply = prefetcher.pop_next()
+    assert reply is not None
+    assert not reply.has_audio
+    assert prefetcher.get("1").audio is None
+
+
+def test_reply_is_shared_by_near_duplicate_questions() -> None:
+    priorities: list[LLMPriority] = []
+    prefetcher = _make_prefetcher(priorities, clusterer=ChatClusterer())
+
+    async def run():
+        prefetcher.start()
+        prefetcher.submit("1", "消費税についてどう考えていますか?", "a")
+        await asyncio.sleep(0.05)
+        # 回答を用意した後に来たほぼ同じ質問も、同じ回答にまとめる
+        prefetcher.submit("2", "消費税についてどう考えてますか?", "b")
+        prefetcher.submit("3", "#消費税についてどう考えていますか?", "c")
+        await asyncio.sleep(0.05)
+        await prefetcher.stop()
+
+    asyncio.run(run())
+    reply = prefetcher.pop_next()
+    assert reply is not None
+    assert (reply.message_ids, reply.authors) == (["1", "2"], ["a", "b"])
+    assert prefetcher.pop_next() is None
+    assert prefetcher.get("2").reply.message_id == "1"
+    # 回答の生成は一度だけ
+    assert priorities.count(LLMPriority.tts_prep) == 1
+    stats = prefetcher.stats
+    assert (stats.submitted, stats.clustered, stats.filtered_out, stats.prefetched) == (3, 1, 1, 1)
+
+
+def test_questions_do_not_join_a_representative_that_was_filtered_out() -> None:
+    prefetcher = _make_prefetcher([], clusterer=ChatClusterer())
+
+    async def run():
+        prefetcher.start()
+        # フィルタリングで落とされる
+        prefetcher.submit("1", "消費税についてどう考えていますか", "a")
+        await asyncio.sleep(0.05)
+        # 同じバッチでフィルタリングを通ったほぼ同じ質問は、先のコメントの回答にまとめる
+        prefetcher.submit("2", "消費税についてどう考えてますか?", "b")
+        prefetcher.submit("3", "消費税についてどう考えていますか?", "c")
+        await asyncio.sleep(0.05)
+        await prefetcher.stop()
+
+    asyncio.run(run())
+    reply = prefetcher.pop_next()
+    assert reply is not None
+    assert (reply.message_id, reply.message_ids) == ("2", ["2", "3"])
+    assert prefetcher.get("1") is None
+    stats = prefetcher.stats
+    assert (stats.clustered, stats.filtered_out, stats.prefetched) == (1, 1, 1)
+
+
+def test_members_get_their_own_reply_when_the_representative_fails() -> None:
+    prefetcher = _make_prefetcher([], failing_question="消費税についてどう考えていますか?", clusterer=ChatClusterer())
+
+    async def run():
+        prefetcher.start()
+        prefetcher.submit("1", "消費税についてどう考えていますか?", "a")
+        await asyncio.sleep(0.01)
+        # 回答を用意している間に来たほぼ同じ質問は、その回答にまとめる
+        prefetcher.submit("2", "消費税についてどう考えてますか?", "b")
+        prefetcher.submit("3", "消費税についてどう考えてますか？?", "c")
+        await asyncio.sleep(0.1)
+        await prefetcher.stop()
+
+    asyncio.run(run())
+    # 回答を用意できなかった場合は、まとめたコメントの回答を改めて用意する
+    reply = prefetcher.pop_next()
+    assert reply is not None
+    assert (reply.message_id, reply.message_ids, reply.authors) == ("2", ["2", "3"], ["b", "c"])
+    assert prefetcher.get("3").reply.message_id == "2"
+    assert prefetcher.get("1") is None
+    stats = prefetcher.stats
+    assert (stats.clustered, stats.prefetched, stats.failed) == (1, 1, 1)
+
+
+def test_identical_questions_in_one_batch_share_the_reply() -> None:
+    priorities: list[LLMPriority] = []
+    # 重複を落とす prefilter を通しても、同じバッチの同じ質問は回答にまとめる
+    prefilter = CommentPrefilter(min_length=2, max_length=50, window_sec=60, max_comments_per_author=5)
+    prefetcher = _make_prefetcher(priorities, clusterer=ChatClusterer(), prefilter=prefilter)
+
+    async def run():
+        prefetcher.start()
+        for i in range(4):
+            prefetcher.submit(f"m{i}", "消費税はどうしますか?", f"author{i}")
+        prefetcher.submit("m4", "#消費税はどうしますか?", "author4")
+        await asyncio.sleep(0.05)
+        await prefetcher.stop()
+
+    asyncio.run(run())
+    reply = prefetcher.pop_next()
+    assert reply is not None
+    assert (reply.message_ids, reply.authors) == (["m0", "m1", "m2", "m3"], ["author0", "author1", "author2", "author3"])
+    assert prefetcher.pop_next() is None
+    assert all(prefetcher.get(f"m{i}").reply.message_id == "m0" for i in range(4))
+    assert prefetcher.get("m4") is None
+    assert priorities.count(LLMPriority.tts_prep) == 1
+    stats = prefetcher.stats
+    assert (stats.clustered, stats.filtered_out, stats.prefetched) == (3, 1, 1)
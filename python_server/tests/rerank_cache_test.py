@@ -0,0 +1,21 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.retrieval.rerank_cache import RerankDecisionCache
+
+
+def test_key_depends_on_normalized_query_candidates_and_index_version() -> None:
+    cache = RerankDecisionCache(max_size=10, ttl_sec=60)
+    key = cache.key("n_best:5:5", "政策を教えて！", ["a", "b"], "v1")
+    cache.set(key, [2, 1])
+
+    # 全角・半角や前後の空白の違いは同じ質問とみなす
+    assert cache.get(cache.key("n_best:5:5", " 政策を教えて!", ["a", "b"], "v1")) == (2, 1)
+    # 候補の並びやインデックスのバージョンが違う場合はヒットしない
+    assert cache.get(cache.key("n_best:5:5", "政策を教えて！", ["b", "a"], "v1")) is None
+    assert cache.get(cache.key("n_best:5:5", "政策を教えて！", ["a", "b"], "v2")) is None
+    assert cache.get(cache.key("best:5", "政策を教えて！", ["a", "b"], "v1")) is None
+    stats = cache.stats
+    assert (stats.hits, stats.misses) == (1, 3)
+    assert stats.model_dump()["hit_rate"] == 0.25
@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.retrieval.rerank import LocalReranker
+from src.retrieval.tokenizer import JapaneseTokenizer
+from src.schema.retrieval import ScoredDocument
+
+
+def _doc(content, score, vector=0.0):
+    return ScoredDocument(page_content=content, metadata={"image": "slide.png"}, score=score, source_scores={"vector": vector})
+
+
+def test_rerank_prefers_documents_covering_the_query() -> None:
+    reranker = LocalReranker(tokenizer=JapaneseTokenizer(stopwords=[]), weights={"fused": 0.5, "coverage": 0.5})
+    candidates = [
+        _doc("Title: 交通\n 道路を整備します", 0.03, vector=0.6),
+        _doc("Title: 子育て\n 子育て支援の政策を拡充します", 0.02, vector=0.5),
+    ]
+    reranked = reranker.rerank("子育て支援の政策", candidates, top_n=2)
+    assert [doc.page_content.split("\n")[0] for doc in reranked] == ["Title: 子育て", "Title: 交通"]
+    assert reranked[0].source_scores["coverage"] == 1.0
+    assert reranked[0].source_scores["title"] > 0
+    # 元のスコアも残る
+    assert reranked[0].source_scores["vector"] == 0.5
+
+
+def test_rerank_drops_documents_below_min_score() -> None:
+    reranker = LocalReranker(tokenizer=JapaneseTokenizer(stopwords=[]), weights={"coverage": 1.0}, min_score=0.5)
+    candidates = [_doc("Title: 交通\n 道路を整備します", 0.03), _doc("Title: 子育て\n 子育て支援", 0.02)]
+    assert [doc.page_content for doc in reranker.rerank("子育て支援", candidates, top_n=5)] == ["Title: 子育て\n 子育て支援"]
+    assert reranker.rerank("天気", candidates, top_n=5) == []
+    assert reranker.rerank("子育て", [], top_n=5) == []
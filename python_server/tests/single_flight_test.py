@@ -0,0 +1,57 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.single_flight import SingleFlight
+
+
+def test_concurrent_calls_with_same_key_share_one_execution() -> None:
+    single_flight: SingleFlight[str] = SingleFlight()
+    calls = []
+
+    async def work(key: str) -> str:
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return f"{key}の回答"
+
+    async def run():
+        keys = ["a", "a", "b", "a"]
+        return await asyncio.gather(*(single_flight.do(key, lambda key=key: work(key)) for key in keys))
+
+    assert asyncio.run(run()) == ["aの回答", "aの回答", "bの回答", "aの回答"]
+    assert sorted(calls) == ["a", "b"]
+    stats = single_flight.stats
+    assert (stats.executed, stats.coalesced, stats.in_flight) == (2, 2, 0)
+
+    # 終わった処理の結果は使い回さない
+    assert asyncio.run(single_flight.do("a", lambda: work("a"))) == "aの回答"
+    assert calls.count("a") == 2
+
+
+def test_exception_is_shared_and_cancelled_waiter_does_not_cancel_others() -> None:
+    single_flight: SingleFlight[str] = SingleFlight()
+
+    async def fail() -> str:
+        await asyncio.sleep(0.01)
+        raise RuntimeError("LLM error")
+
+    async def slow() -> str:
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def run():
+        results = await asyncio.gather(single_flight.do("x", fail), single_flight.do("x", fail), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+
+        first = asyncio.ensure_future(single_flight.do("y", slow))
+        second = asyncio.ensure_future(single_flight.do("y", slow))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run()) == "done"
@@ -0,0 +1,41 @@
+import os
+import sys
+import threading
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.retrieval.tokenizer import JapaneseTokenizer
+
+
+def test_tokenize_keeps_content_words_only() -> None:
+    tokenizer = JapaneseTokenizer(stopwords=["柱"])
+    # 助詞・助動詞・代名詞・ASCII・ストップワードは除かれる
+    assert tokenizer.tokenize("私はAIで政策の柱を教えてです") == ["政策", "教え"]
+
+
+def test_extract_nouns() -> None:
+    tokenizer = JapaneseTokenizer(stopwords=["柱"])
+    # 英字の名詞は残し、動詞・代名詞・ストップワードは除く
+    assert tokenizer.extract_nouns("私はAIで政策の柱を教えてです") == ["AI", "政策"]
+
+
+def test_tokenize_query_is_cached() -> None:
+    tokenizer = JapaneseTokenizer(stopwords=[])
+    first = tokenizer.tokenize_query("政策を教えて")
+    first.append("破壊的変更")
+    assert tokenizer.tokenize_query("政策を教えて") == ["政策", "教え"]
+
+
+def test_tokenize_batch_from_multiple_threads() -> None:
+    tokenizer = JapaneseTokenizer(stopwords=[])
+    results = {}
+
+    def run(i):
+        results[i] = tokenizer.tokenize_batch(["政策を教えて", "東京を変える"])
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(result == [["政策", "教え"], ["東京", "変える"]] for result in results.values())
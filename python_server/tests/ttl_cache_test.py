@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from src.retrieval.embeddings import CachedQueryEmbeddings
+from src.ttl_cache import TTLCache
+
+
+def test_evicts_least_recently_used() -> None:
+    cache: TTLCache[int] = TTLCache(max_size=2, ttl_sec=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    stats = cache.stats
+    assert (stats.hits, stats.misses, stats.evictions) == (3, 1, 1)
+
+
+def test_expires_after_ttl() -> None:
+    cache: TTLCache[int] = TTLCache(max_size=2, ttl_sec=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+    assert cache.get("a") is None
+    assert cache.stats.expirations == 1
+
+
+class _CountingEmbeddings:
+    def __init__(self):
+        self.calls = 0
+
+    def embed_query(self, text):
+        self.calls += 1
+        return [float(len(text))]
+
+    def embed_documents(self, texts, task_type=None):
+        self.calls += 1
+        return [[float(len(text))] for text in texts]
+
+
+def test_cached_query_embeddings_normalizes_query() -> None:
+    inner = _CountingEmbeddings()
+    embeddings = CachedQueryEmbeddings(embeddings=inner, model_name="test", max_size=10, ttl_sec=60)
+
+    assert embeddings.embed_query("政策を教えて") == [6.0]
+    assert embeddings.embed_query(" 政策を教えて ") == [6.0]
+    assert inner.calls == 1
+    assert embeddings.stats.hits == 1
+
+
+def test_embed_queries_embeds_only_missing_queries_at_once() -> None:
+    inner = _CountingEmbeddings()
+    embeddings = CachedQueryEmbeddings(embeddings=inner, model_name="test", max_size=10, ttl_sec=60, query_task_type="RETRIEVAL_QUERY")
+    embeddings.embed_query("政策")
+
+    assert embeddings.embed_queries(["政策", "子育て支援", " 子育て支援", "交通"]) == [[2.0], [5.0], [5.0], [2.0]]
+    # 最初の embed_query と、キャッシュになかった2件をまとめた1回
+    assert inner.calls == 2
+    assert embeddings.embed_queries(["交通", "子育て支援"]) == [[2.0], [5.0]]
+    assert inner.calls == 2